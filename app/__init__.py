@@ -4,16 +4,19 @@ import logging
 from logging.handlers import SMTPHandler, RotatingFileHandler
 
 from flask import Flask, request, current_app
-from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
 from flask_mail import Mail
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
 from flask_babel import Babel, lazy_gettext as _l
+from flask_jwt_extended import JWTManager
+from werkzeug.middleware.proxy_fix import ProxyFix
 from elasticsearch import Elasticsearch
 
 from config import Config
+from app import availability, database, fragments, graph, tags, \
+    trending, updates
 
 ## =========================================================
 ## Utilities
@@ -72,7 +75,16 @@ def setup_email_log_handler(config):
 ## ---------------------------------------------------------
 
 # Database
-db = SQLAlchemy()
+# Routing the reads of views decorated with @read_replica
+# to the read replicas (see app/database.py)
+db = database.RoutingSQLAlchemy()
+database.register_events(db)
+availability.register_events(db)
+fragments.register_events(db)
+graph.register_events(db)
+tags.register_events(db)
+trending.register_events(db)
+updates.register_events(db)
 
 # Database migration engine
 migrate = Migrate()
@@ -102,6 +114,11 @@ moment = Moment()
 # i18n and l10n support
 babel = Babel()
 
+# Flask-JWT-Extended
+# Access tokens of the JSON API (see app/api)
+# NOTE: Not named 'jwt' to not shadow the PyJWT module.
+jwt_manager = JWTManager()
+
 
 def create_app(config_class=Config):
 
@@ -110,7 +127,29 @@ def create_app(config_class=Config):
 
     # Application config
     app.config.from_object(config_class)
+
+    # The address of the client as seen by the reverse proxies
+    # (see app/limits.py)
+    if app.config['PROXY_FIX_X_FOR']:
+        app.wsgi_app = ProxyFix(app.wsgi_app,
+                                x_for=app.config['PROXY_FIX_X_FOR'])
     
+    # Metrics providers
+    # Name -> function returning the metrics (see app/metrics)
+    app.metrics = {}
+
+    # Register the read replicas and the database metrics
+    database.init_app(app)
+
+    # Rate limits and admission control of the expensive endpoints
+    # (checked before any other request hook)
+    from app import limits
+    limits.init_app(app)
+
+    # Password hashing
+    from app import passwords
+    passwords.init_app(app)
+
     # Init components
     db.init_app(app)
     migrate.init_app(app, db)
@@ -119,6 +158,39 @@ def create_app(config_class=Config):
     bootstrap.init_app(app)
     moment.init_app(app)
     babel.init_app(app)
+    jwt_manager.init_app(app)
+
+    # Cache of the rendered posts
+    fragments.init_app(app)
+
+    # In-process index of the follow graph
+    graph.init_app(app)
+
+    # Streamed rendering of the post lists
+    from app import streaming
+    streaming.init_app(app)
+
+    # Statistics of the task queue
+    from app import tasks
+    tasks.init_app(app)
+
+    # Shards of the posts
+    from app import shards
+    shards.init_app(app)
+
+    # Snapshot of the first pages of the explore feed
+    from app import explore
+    explore.init_app(app)
+
+    # Counters of the trending posts and tags
+    trending.init_app(app)
+
+    # Index of the usernames and email addresses in use
+    availability.init_app(app)
+
+    # Jinja bytecode cache and preloaded translation catalogs
+    from app import warmup
+    warmup.init_app(app)
 
     # Init Elasticsearch
     app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) \
@@ -134,6 +206,15 @@ def create_app(config_class=Config):
     from app.main import bp as main_bp
     app.register_blueprint(main_bp)
 
+    from app.avatars import bp as avatars_bp
+    app.register_blueprint(avatars_bp)
+
+    from app.api import bp as api_bp
+    app.register_blueprint(api_bp, url_prefix='/api/v1')
+
+    from app.metrics import bp as metrics_bp
+    app.register_blueprint(metrics_bp)
+
     # Setup log handlers
     # when neither in debug nor test mode
     if not app.debug and not app.testing:
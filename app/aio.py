@@ -0,0 +1,423 @@
+## =========================================================
+## app/aio.py
+## ---------------------------------------------------------
+##
+## Asynchronous serving of the I/O-bound endpoints.
+##
+## POST /translate and GET /search spend nearly all their time
+## waiting for Google Translate and Elasticsearch - holding a whole
+## sync worker while they wait.  The ASGI application of asgi.py
+## serves them on an asyncio event loop instead:
+##
+##   uvicorn asgi:app
+##   gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:app
+##
+## All other requests are passed on to the WSGI application
+## (riji:app) unchanged - run in a thread.  A reverse proxy may as
+## well send only /translate and /search to the ASGI workers and keep
+## the rest on the sync workers.
+##
+## A request to one of the endpoints is served in three steps:
+##
+##   1. In a thread of the pool: the request hooks of the application
+##      (session, login, rate limits - see app/limits.py) and the
+##      parsing of the request.
+##
+##   2. On the event loop: the call of the service, awaited without
+##      holding a thread.  Every call has a deadline
+##      (AIO_TRANSLATE_TIMEOUT, AIO_SEARCH_TIMEOUT) - a call running
+##      past it is answered with '504 Gateway Timeout', a failing one
+##      with '502 Bad Gateway'.
+##
+##   3. In a thread of the pool: the database reads, the rendering of
+##      the response and the after-request hooks (session cookie).
+##
+## The steps share the request and application contexts; the
+## database session is closed after each of them, so neither a
+## thread nor a database connection is held while the service is
+## awaited.  The admission control of app/limits.py counts the
+## requests in the first step only; a worker waits on up to
+## AIO_MAX_CONCURRENT requests per endpoint at once - further ones
+## are answered with '503 Service Unavailable'.
+##
+## Services:
+##
+##   - Elasticsearch: the asyncio client of elasticsearch-py (on
+##     aiohttp) with up to AIO_POOL_SIZE connections.
+##
+##   - Google Translate: the REST API v3 (translateText) over a
+##     pooled aiohttp session, authenticated with the application
+##     default credentials (GOOGLE_APPLICATION_CREDENTIALS).  The
+##     installed google-cloud-translate has no asyncio client - the
+##     credentials are refreshed in a thread of the pool.
+##
+## The capacity of a worker is measured by
+## benchmarks/async_capacity.py.
+##
+## ---------------------------------------------------------
+
+import asyncio
+import sys
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from flask import current_app, g, jsonify, redirect, request, url_for
+from flask_babel import _
+from flask_login import current_user
+from werkzeug.exceptions import BadGateway, GatewayTimeout
+from werkzeug.middleware.proxy_fix import ProxyFix
+from app.archive import search_hits
+from app.database import read_replica
+from app.main.routes import render_search
+from app.models import Post
+from app.search import search_body, search_result
+from app.trending import record_translation
+
+# The Google Translate API v3
+TRANSLATE_URL = 'https://translation.googleapis.com/v3/projects/{}' \
+                '/locations/global:translateText'
+TRANSLATE_SCOPE = 'https://www.googleapis.com/auth/cloud-translation'
+
+# The response of a step: status, headers and body
+Reply = namedtuple('Reply', ['status', 'headers', 'body'])
+
+
+class ServiceCall(object):
+    """Returned by the first step of a request: the call of a service
+    to await.
+    """
+
+    def __init__(self, service, *args):
+        self.service = service
+        self.args = args
+
+
+## =========================================================
+## Services
+## ---------------------------------------------------------
+
+def refreshed_credentials(credentials):
+    """Get and refresh the application default credentials
+    (blocking - run in a thread).
+    """
+    import google.auth
+    from google.auth.transport.requests import Request
+    if credentials is None:
+        credentials, _ = google.auth.default(scopes=[TRANSLATE_SCOPE])
+    credentials.refresh(Request())
+    return credentials
+
+
+class Services(object):
+    """The asynchronous clients of a worker.
+
+    They are created on the event loop of the worker - on startup or
+    by the first request.
+
+    """
+
+    def __init__(self, config, executor):
+        self.config = config
+        self.executor = executor
+        self.http = None
+        self.elasticsearch = None
+        self.credentials = None
+        self._credentials_lock = None
+
+    def start(self):
+        if self.http is not None:
+            return
+        import aiohttp
+        self.http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+            limit=self.config['AIO_POOL_SIZE']))
+        if self.config['ELASTICSEARCH_URL']:
+            from elasticsearch import AsyncElasticsearch
+            self.elasticsearch = AsyncElasticsearch(
+                [self.config['ELASTICSEARCH_URL']],
+                maxsize=self.config['AIO_POOL_SIZE'])
+        self._credentials_lock = asyncio.Lock()
+
+    async def close(self):
+        if self.http is not None:
+            await self.http.close()
+        if self.elasticsearch is not None:
+            await self.elasticsearch.close()
+        self.http = self.elasticsearch = None
+
+    async def search(self, index, query, page, per_page):
+        """The ids of a page of hits and the number of hits."""
+        if self.elasticsearch is None:
+            return [], 0
+        search = await self.elasticsearch.search(
+            index=index, body=search_body(query, page, per_page))
+        return search_result(search)
+
+    async def access_token(self):
+        async with self._credentials_lock:
+            if self.credentials is None or not self.credentials.valid:
+                self.credentials = await asyncio.get_running_loop()\
+                    .run_in_executor(self.executor, refreshed_credentials,
+                                     self.credentials)
+            return self.credentials.token
+
+    async def translate(self, text, source_language, target_language):
+        """Translate a text with Google Translate."""
+        token = await self.access_token()
+        async with self.http.post(
+                TRANSLATE_URL.format(
+                    self.config['GOOGLE_TRANSLATION_PROJECT_ID']),
+                json={'contents':           [text],
+                      'mimeType':           'text/plain',
+                      'sourceLanguageCode': source_language,
+                      'targetLanguageCode': target_language},
+                headers={'Authorization': 'Bearer ' + token}) as response:
+            response.raise_for_status()
+            result = await response.json()
+        return ' '.join(translation['translatedText']
+                        for translation in result['translations'])
+
+
+## =========================================================
+## Steps of the requests
+## ---------------------------------------------------------
+
+def prepare_translate():
+    """The first step of POST /translate (see main.translate_text())."""
+    if not current_user.is_authenticated:
+        return current_app.login_manager.unauthorized()
+    if not current_app.config['GOOGLE_TRANSLATION_PROJECT_ID']:
+        return jsonify(
+            {'text': _('ERROR The translation service is not configured.')})
+
+    # Count the translation for the trending posts
+    # (see app/trending.py)
+    record_translation(current_user,
+                       request.form.get('post_id', type=int))
+
+    return ServiceCall('translate', request.form['text'],
+                       request.form['source_language'],
+                       request.form['target_language'])
+
+
+def finish_translate(translation):
+    return jsonify({'text': translation})
+
+
+def prepare_search():
+    """The first step of GET /search (see main.search())."""
+    if not current_user.is_authenticated:
+        return current_app.login_manager.unauthorized()
+    if not g.search_form.validate():
+        return redirect(url_for('main.explore'))
+    page = request.args.get('page', 1, type=int)
+    return ServiceCall('search', Post.__tablename__, g.search_form.q.data,
+                       page, current_app.config['POSTS_PER_PAGE'])
+
+
+@read_replica
+def finish_search(result):
+    ids, total = result
+    return render_search(search_hits(ids), total,
+                         request.args.get('page', 1, type=int))
+
+
+## =========================================================
+## ASGI application
+## ---------------------------------------------------------
+
+def build_environ(scope, body):
+    """The WSGI environ of an ASGI request."""
+    environ = {
+        'REQUEST_METHOD':  scope['method'],
+        'SCRIPT_NAME':     scope.get('root_path', ''),
+        'PATH_INFO':       scope['path'],
+        'QUERY_STRING':    scope['query_string'].decode('latin1'),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope['http_version']),
+        'SERVER_NAME':     (scope.get('server') or ('localhost', 80))[0],
+        'SERVER_PORT':     str((scope.get('server') or ('localhost', 80))[1]),
+        'REMOTE_ADDR':     (scope.get('client') or ('', 0))[0],
+        'wsgi.version':    (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input':      BytesIO(body),
+        'wsgi.errors':     sys.stderr,
+        'wsgi.multithread':  True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once':     False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = value.decode('latin1')
+        environ[name] = environ[name] + ',' + value \
+            if name in environ else value
+    return environ
+
+
+async def read_body(receive):
+    body = []
+    while True:
+        message = await receive()
+        body.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(body)
+
+
+async def send_reply(send, reply):
+    await send({'type': 'http.response.start', 'status': reply.status,
+                'headers': [(name.lower().encode('latin1'),
+                             value.encode('latin1'))
+                            for name, value in reply.headers]})
+    await send({'type': 'http.response.body', 'body': reply.body})
+
+
+class AsyncApp(object):
+    """The ASGI application serving the I/O-bound endpoints of a Flask
+    application on the event loop and passing all other requests on
+    to the Flask application.
+    """
+
+    def __init__(self, flask_app):
+        from asgiref.wsgi import WsgiToAsgi
+        config = flask_app.config
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.executor = ThreadPoolExecutor(config['AIO_THREADS'],
+                                           thread_name_prefix='aio')
+        self.services = Services(config, self.executor)
+        self.routes = {
+            ('POST', '/translate'): ('translate', prepare_translate,
+                                     finish_translate,
+                                     config['AIO_TRANSLATE_TIMEOUT']),
+            ('GET', '/search'):     ('search', prepare_search,
+                                     finish_search,
+                                     config['AIO_SEARCH_TIMEOUT']),
+        }
+        self.max_concurrent = config['AIO_MAX_CONCURRENT']
+
+        # The requests served here do not pass the WSGI middleware of
+        # the application - the client address behind reverse proxies
+        # is fixed the same way (see create_app())
+        self.proxy_fix = None
+        if config['PROXY_FIX_X_FOR']:
+            self.proxy_fix = ProxyFix(lambda environ, _: environ,
+                                      x_for=config['PROXY_FIX_X_FOR'])
+        self.in_flight = Counter()
+        self.served = Counter()
+        self.shed = Counter()
+        self.timeouts = Counter()
+        self.failures = Counter()
+        flask_app.metrics['aio'] = self.stats
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        route = self.routes.get((scope.get('method'), scope.get('path'))) \
+            if scope['type'] == 'http' else None
+        if route is None:
+            return await self.wsgi(scope, receive, send)
+        return await self.serve(route, scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.services.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.services.close()
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def serve(self, route, scope, receive, send):
+        name, prepare, finish, timeout = route
+        if self.in_flight[name] >= self.max_concurrent:
+            self.shed[name] += 1
+            return await send_reply(send, Reply(
+                503, [('Content-Type', 'text/plain'), ('Retry-After', '5')],
+                b'Service Unavailable'))
+
+        self.in_flight[name] += 1
+        try:
+            self.services.start()
+            environ = build_environ(scope, await read_body(receive))
+            if self.proxy_fix is not None:
+                environ = self.proxy_fix(environ, None)
+            app_context = self.flask_app.app_context()
+            request_context = self.flask_app.request_context(environ)
+            loop = asyncio.get_running_loop()
+
+            reply = await loop.run_in_executor(
+                self.executor, self.step, app_context, request_context,
+                prepare, (), None, True)
+            if isinstance(reply, ServiceCall):
+                result, error = None, None
+                try:
+                    result = await asyncio.wait_for(
+                        getattr(self.services, reply.service)(*reply.args),
+                        timeout)
+                except asyncio.TimeoutError:
+                    self.timeouts[name] += 1
+                    error = GatewayTimeout()
+                except Exception:
+                    self.failures[name] += 1
+                    self.flask_app.logger.exception(
+                        'The {} service failed'.format(name))
+                    error = BadGateway()
+                reply = await loop.run_in_executor(
+                    self.executor, self.step, app_context, request_context,
+                    finish, (result,), error, False)
+
+            self.served[name] += 1
+            await send_reply(send, reply)
+        finally:
+            self.in_flight[name] -= 1
+
+    def step(self, app_context, request_context, function, args, error,
+             hooks):
+        """Run a step of a request in its contexts - in a thread of the
+        pool.
+
+        Returns the ServiceCall of the step or the Reply to send.
+
+        """
+        app = self.flask_app
+        app_context.push()
+        request_context.push()
+        if not hooks:
+            # The user loaded by the first step belongs to the database
+            # session closed at its end - load it again when needed
+            request_context.__dict__.pop('user', None)
+        try:
+            try:
+                try:
+                    rv = app.preprocess_request() if hooks else None
+                    if rv is None:
+                        if error is not None:
+                            raise error
+                        rv = function(*args)
+                    if isinstance(rv, ServiceCall):
+                        return rv
+                except Exception as e:
+                    rv = app.handle_user_exception(e)
+                response = app.finalize_request(rv)
+            except Exception as e:
+                response = app.handle_exception(e)
+            return Reply(response.status_code, list(response.headers),
+                         response.get_data())
+        finally:
+            request_context.pop()
+            app_context.pop()
+
+    def stats(self):
+        return {
+            'in_flight': dict(self.in_flight),
+            'served':    dict(self.served),
+            'shed':      dict(self.shed),
+            'timeouts':  dict(self.timeouts),
+            'failures':  dict(self.failures),
+        }
+
+
+## fin.
@@ -0,0 +1,261 @@
+## =========================================================
+## app/api/posts.py
+## ---------------------------------------------------------
+##
+## Pages of posts as returned by the API.
+##
+## Sparse fields:
+##
+##   The client selects the fields of the posts it needs with the
+##   'fields' argument (e.g. ?fields=id,body) - only these columns are
+##   queried.  All fields are returned when no fields are given.
+##
+## Cursor pagination:
+##
+##   The feeds are ordered by (timestamp, id), newest first.  A page
+##   ends with an opaque 'next_cursor' encoding the position of its
+##   last post; the next page starts right after this position:
+##
+##     WHERE timestamp < :timestamp
+##        OR timestamp = :timestamp AND id < :id
+##     ORDER BY timestamp DESC, id DESC
+##     LIMIT :limit
+##
+##   Unlike OFFSET pagination the database does not have to skip the
+##   posts of the previous pages, and no post is shown twice when new
+##   posts are written between two requests.
+##
+## Shards:
+##
+##   When the posts are sharded (see app/shards.py) the pages are
+##   gathered from the shards with the same cursors - the newest
+##   'limit' posts after the position of each shard, merged - and the
+##   authors are read from the application database.
+##
+## Serialization:
+##
+##   The posts are serialized directly from the rows returned by the
+##   database - no model instances are created.
+##
+## ---------------------------------------------------------
+
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from datetime import datetime
+from flask import abort, current_app, request
+from app import db
+from app.models import User, Post
+from app.search import query_index
+from app.shards import sharding_enabled, newest_rows, rows_by_id
+
+# The fields of a post and the columns they are read from
+POST_FIELDS = OrderedDict([
+    ('id',        Post.id),
+    ('body',      Post.body),
+    ('timestamp', Post.timestamp),
+    ('language',  Post.language),
+    ('author',    User.username),
+])
+
+# Timestamps in the cursors
+CURSOR_TIMESTAMP_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+## =========================================================
+## Request arguments
+## ---------------------------------------------------------
+
+def page_arguments():
+    """Get the fields, the cursor and the page size requested."""
+    fields = request.args.get('fields')
+    if fields:
+        fields = list(OrderedDict.fromkeys(
+            name for name in fields.split(',') if name))
+        unknown = [name for name in fields if name not in POST_FIELDS]
+        if unknown or not fields:
+            abort(400, 'Unknown fields: {}.'.format(', '.join(unknown)))
+    else:
+        fields = list(POST_FIELDS)
+
+    cursor = request.args.get('cursor')
+    cursor = decode_cursor(cursor) if cursor else None
+
+    limit = request.args.get('limit',
+                             current_app.config['POSTS_PER_PAGE'], type=int)
+    limit = max(1, min(limit, current_app.config['API_MAX_PAGE_SIZE']))
+
+    return fields, cursor, limit
+
+
+def encode_cursor(*values):
+    data = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        data = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(data.decode('utf-8'))
+    except ValueError:
+        values = None
+    if not isinstance(values, list):
+        abort(400, 'Invalid cursor.')
+    return values
+
+
+## =========================================================
+## Queries
+## ---------------------------------------------------------
+
+def post_query(fields):
+    """A query of the rows (timestamp, id, *fields) of the posts."""
+    query = db.session.query(
+        Post.timestamp, Post.id, *[POST_FIELDS[name] for name in fields])
+    if 'author' in fields:
+        query = query.join(User, User.id == Post.user_id)
+    return query
+
+
+def cursor_position(cursor):
+    """The position (timestamp, id) of a feed cursor."""
+    try:
+        timestamp, id = cursor
+        return datetime.strptime(timestamp, CURSOR_TIMESTAMP_FORMAT), int(id)
+    except (TypeError, ValueError):
+        abort(400, 'Invalid cursor.')
+
+
+def shard_rows(rows, fields):
+    """Turn rows (id, body, timestamp, language, user_id) read from the
+    shards into rows (timestamp, id, *fields).
+    """
+    authors = dict(db.session.query(User.id, User.username).filter(
+        User.id.in_({row[4] for row in rows}))) \
+        if rows and 'author' in fields else {}
+    result = []
+    for id, body, timestamp, language, user_id in rows:
+        values = {'id': id, 'body': body, 'timestamp': timestamp,
+                  'language': language, 'author': authors.get(user_id)}
+        result.append((timestamp, id) + tuple(values[name]
+                                              for name in fields))
+    return result
+
+
+def feed_page(user_ids, cursor, limit, fields):
+    """Get the page of the feed of the users 'user_ids' (of all users
+    when None) starting after the cursor.
+    """
+    if sharding_enabled():
+        position = cursor_position(cursor) if cursor is not None else None
+        rows = shard_rows(newest_rows(user_ids, position, limit + 1), fields)
+        return page_result(rows, limit, fields)
+
+    query = post_query(fields)
+    if user_ids is not None:
+        query = query.filter(Post.user_id.in_(user_ids))
+    return keyset_page(query, cursor, limit, fields)
+
+
+def post_rows(ids, fields):
+    """The rows (timestamp, id, *fields) of the posts 'ids', in the
+    order of the ids.
+    """
+    if not ids:
+        return []
+    if sharding_enabled():
+        found = rows_by_id(ids)
+        rows = shard_rows([found[id] for id in ids if id in found], fields)
+    else:
+        rows = post_query(fields).filter(Post.id.in_(ids)).all()
+    rank = {id: i for i, id in enumerate(ids)}
+    return sorted(rows, key=lambda row: rank[row[1]])
+
+
+def keyset_page(query, cursor, limit, fields):
+    """Get the page of a feed starting after the cursor."""
+    if cursor is not None:
+        timestamp, id = cursor_position(cursor)
+        query = query.filter(db.or_(
+            Post.timestamp < timestamp,
+            db.and_(Post.timestamp == timestamp, Post.id < id)))
+
+    # One more row tells whether there is a next page
+    rows = query.order_by(Post.timestamp.desc(), Post.id.desc())\
+                .limit(limit + 1).all()
+    return page_result(rows, limit, fields)
+
+
+def page_result(rows, limit, fields):
+    """The page of up to 'limit + 1' rows (timestamp, id, *fields) -
+    the extra row tells whether there is a next page.
+    """
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        timestamp, id = rows[-1][:2]
+        next_cursor = encode_cursor(
+            timestamp.strftime(CURSOR_TIMESTAMP_FORMAT), id)
+
+    return {'items': serialize(rows, fields), 'next_cursor': next_cursor}
+
+
+def search_page(expression, cursor, limit, fields):
+    """Get a page of the posts matching the search expression.
+
+    The matches are ordered by relevance - the cursor is the page
+    number of the search index and the page size.
+
+    """
+    page, per_page = 1, limit
+    if cursor is not None:
+        try:
+            page, per_page = [int(value) for value in cursor]
+        except (TypeError, ValueError):
+            abort(400, 'Invalid cursor.')
+        if page < 1 or not 1 <= per_page <= limit:
+            abort(400, 'Invalid cursor.')
+
+    ids, total = query_index(Post.__tablename__, expression, page, per_page)
+
+    # Keep the order by relevance
+    rows = post_rows(ids, fields)
+
+    next_cursor = encode_cursor(page + 1, per_page) \
+        if total > page * per_page else None
+
+    return {'items': serialize(rows, fields), 'next_cursor': next_cursor}
+
+
+## =========================================================
+## Serialization
+## ---------------------------------------------------------
+
+def format_timestamp(timestamp):
+    """ISO 8601 in UTC."""
+    return timestamp.isoformat() + 'Z'
+
+# Fields which are not serialized as they are
+# (the post ids as strings - see app/api/routes.py)
+FORMATTERS = {
+    'id':        str,
+    'timestamp': format_timestamp,
+}
+
+
+def serialize(rows, fields):
+    """Turn the rows (timestamp, id, *fields) into dictionaries."""
+    formatters = [(i + 2, name, FORMATTERS.get(name))
+                  for i, name in enumerate(fields)]
+    items = []
+    for row in rows:
+        item = {}
+        for i, name, format in formatters:
+            value = row[i]
+            item[name] = format(value) \
+                if format is not None and value is not None else value
+        items.append(item)
+    return items
+
+
+## fin.
@@ -0,0 +1,82 @@
+## =========================================================
+## app/api/responses.py
+## ---------------------------------------------------------
+##
+## JSON responses of the API.
+##
+## - The payload is serialized without any whitespace.
+## - GET responses carry an ETag computed from the payload and are
+##   answered with '304 Not Modified' when the client already has
+##   them (If-None-Match).
+## - Payloads of at least API_GZIP_MIN_SIZE bytes are gzip
+##   compressed when the client accepts it.
+##
+## The ETag is weak: the compressed and the uncompressed response
+## carry the same one as they represent the same payload.
+##
+## ---------------------------------------------------------
+
+import gzip
+import json
+from flask import current_app, request
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import HTTP_STATUS_CODES
+from app.api import bp
+
+
+def api_response(payload, status=200):
+    """Create the response of an API endpoint."""
+    data = json.dumps(payload, ensure_ascii=False,
+                      separators=(',', ':')).encode('utf-8')
+    response = current_app.response_class(
+        data, status=status, mimetype='application/json')
+
+    # The response depends on the token
+    # and on the encodings accepted by the client
+    response.vary.add('Authorization')
+    response.vary.add('Accept-Encoding')
+
+    if request.method == 'GET' and status == 200:
+        response.add_etag(weak=True)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.make_conditional(request)
+
+    if response.status_code == 200 or response.status_code == 201:
+        compress(response)
+
+    return response
+
+
+def compress(response):
+    """Gzip the payload when the client accepts it."""
+    config = current_app.config
+    data = response.get_data()
+    if len(data) < config['API_GZIP_MIN_SIZE'] or \
+       not request.accept_encodings['gzip']:
+        return
+
+    response.set_data(gzip.compress(data, config['API_GZIP_LEVEL']))
+    response.headers['Content-Encoding'] = 'gzip'
+
+
+def error_response(status, message=None):
+    payload = {'error': HTTP_STATUS_CODES.get(status, 'Unknown error')}
+    if message:
+        payload['message'] = message
+    return api_response(payload, status)
+
+
+@bp.errorhandler(HTTPException)
+def http_error(error):
+    """Answer the errors of the API endpoints with JSON
+    (see abort() in app/api/routes.py).
+    """
+    response = error_response(error.code, error.description)
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after is not None:
+        response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+## fin.
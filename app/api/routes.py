@@ -0,0 +1,139 @@
+## =========================================================
+## app/api/routes.py
+## ---------------------------------------------------------
+##
+## The endpoints of the JSON API - all of them require an access
+## token (see app/api/tokens.py):
+##
+##   GET    /api/v1/timeline                  home timeline
+##   GET    /api/v1/explore                   posts of all users
+##   GET    /api/v1/users/<username>/posts    posts of a user
+##   GET    /api/v1/search?q=<expression>     search posts
+##   POST   /api/v1/users/<username>/follow   follow a user
+##   DELETE /api/v1/users/<username>/follow   unfollow a user
+##   POST   /api/v1/posts                     write a post
+##
+## The feeds accept the arguments 'fields', 'cursor' and 'limit'
+## (see app/api/posts.py) and return
+##
+##   {"items": [{"id": "...", "body": ..., ...}, ...],
+##    "next_cursor": "..." or null}
+##
+## The post ids are strings: the ids of the posts in the shards
+## (see app/shards.py) are above 2**53 and would lose precision as
+## JavaScript numbers.
+##
+## ---------------------------------------------------------
+
+from flask import abort, request
+from flask_jwt_extended import current_user, jwt_required
+from app import db
+from app.api import bp
+from app.api.posts import POST_FIELDS, page_arguments, feed_page, \
+    post_rows, search_page, serialize
+from app.api.responses import api_response
+from app.database import read_replica
+from app.models import User
+from app.shards import sharding_enabled, write_post
+from app.translate import detect_language
+from app.trending import record_follow
+
+# Maximal length of a post (as in app/main/forms.py)
+MAX_POST_LENGTH = 1000
+
+
+def get_user_or_404(username):
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        abort(404, 'User {} not found.'.format(username))
+    return user
+
+
+## =========================================================
+## Feeds
+## ---------------------------------------------------------
+
+@bp.route('/timeline')
+@jwt_required
+@read_replica
+def timeline():
+    fields, cursor, limit = page_arguments()
+    # (the ids for the shards - see app/shards.py)
+    authors = current_user.followed_ids() + [current_user.id] \
+        if sharding_enabled() else current_user.followed_authors()
+    return api_response(feed_page(authors, cursor, limit, fields))
+
+
+@bp.route('/explore')
+@jwt_required
+@read_replica
+def explore():
+    fields, cursor, limit = page_arguments()
+    return api_response(feed_page(None, cursor, limit, fields))
+
+
+@bp.route('/users/<username>/posts')
+@jwt_required
+@read_replica
+def user_posts(username):
+    fields, cursor, limit = page_arguments()
+    user_id = db.session.query(User.id).filter_by(username=username).scalar()
+    if user_id is None:
+        abort(404, 'User {} not found.'.format(username))
+    return api_response(feed_page([user_id], cursor, limit, fields))
+
+
+@bp.route('/search')
+@jwt_required
+@read_replica
+def search():
+    expression = request.args.get('q', '').strip()
+    if not expression:
+        abort(400, 'The search expression q is required.')
+    fields, cursor, limit = page_arguments()
+    return api_response(search_page(expression, cursor, limit, fields))
+
+
+## =========================================================
+## Writes
+## ---------------------------------------------------------
+
+@bp.route('/users/<username>/follow', methods=['POST', 'DELETE'])
+@jwt_required
+def follow(username):
+    user = get_user_or_404(username)
+    if user.id == current_user.id:
+        abort(400, 'You cannot follow yourself.')
+
+    if request.method == 'POST':
+        current_user.follow(user)
+    else:
+        current_user.unfollow(user)
+    db.session.commit()
+    if request.method == 'POST':
+        record_follow(user)
+
+    return api_response({'username': user.username,
+                         'following': request.method == 'POST'})
+
+
+@bp.route('/posts', methods=['POST'])
+@jwt_required
+def create_post():
+    data = request.get_json(silent=True) or {}
+    body = data.get('body')
+    if not isinstance(body, str) or not body.strip():
+        abort(400, 'The body of the post is required.')
+    if len(body) > MAX_POST_LENGTH:
+        abort(400, 'Posts are limited to {} characters.'.format(
+            MAX_POST_LENGTH))
+
+    # The same write path as the web pages (see app/shards.py)
+    id = write_post(current_user._get_current_object(), body,
+                    detect_language(body))
+
+    fields = list(POST_FIELDS)
+    return api_response(serialize(post_rows([id], fields), fields)[0], 201)
+
+
+## fin.
@@ -0,0 +1,63 @@
+## =========================================================
+## app/api/tokens.py
+## ---------------------------------------------------------
+##
+## Access tokens of the API.
+##
+## A client gets a token by posting the username and the password
+## of the user:
+##
+##   POST /api/v1/tokens  {"username": "susan", "password": "..."}
+##
+## and sends it with each request:
+##
+##   Authorization: Bearer <access_token>
+##
+## The token carries the id of the user; the user is loaded for
+## each request by the endpoints decorated with @jwt_required and
+## available as flask_jwt_extended.current_user.
+##
+## ---------------------------------------------------------
+
+from flask import abort, current_app, request
+from flask_jwt_extended import create_access_token
+from app import db, jwt_manager
+from app.api import bp
+from app.api.responses import api_response
+from app.models import User
+
+
+@jwt_manager.user_loader_callback_loader
+def load_user(id):
+    """Load the user of an access token.
+
+    Tokens of deleted users are rejected with '401 Unauthorized'.
+
+    """
+    return User.query.get(id)
+
+
+@bp.route('/tokens', methods=['POST'])
+def get_token():
+    data = request.get_json(silent=True) or {}
+    username = data.get('username')
+    password = data.get('password')
+    if not isinstance(username, str) or not isinstance(password, str):
+        abort(400, 'username and password are required.')
+
+    user = User.query.filter_by(username=username).first()
+    if user is None or not user.check_password(password):
+        abort(401, 'Invalid username or password.')
+
+    # The password hash might have been replaced (see app/passwords.py)
+    db.session.commit()
+
+    expires = current_app.config['JWT_ACCESS_TOKEN_EXPIRES']
+    return api_response({
+        'access_token': create_access_token(identity=user.id),
+        'token_type':   'Bearer',
+        'expires_in':   int(expires.total_seconds()),
+    })
+
+
+## fin.
@@ -0,0 +1,197 @@
+## =========================================================
+## app/archive.py
+## ---------------------------------------------------------
+##
+## Hot and cold storage of the posts.
+##
+## Nearly all reads - the first pages of the timeline, of the explore
+## feed and of the user pages - only touch recent posts.  When
+## POST_ARCHIVE_AFTER_DAYS is set, the posts older than that are
+## moved from the post table ('hot') to the post_archive table
+## ('cold', see models.ArchivedPost) by the batch job
+##
+##   flask archive posts [--batch 500]
+##
+## which moves the oldest posts first, POST_ARCHIVE_BATCH posts per
+## transaction.  The archive is kept in the database given by
+## ARCHIVE_DATABASE_URL - or in the application database when it is
+## not set.  (The migrations create the archive table in the
+## application database; in another database it is created with
+## 'flask archive init'.)  All archived posts are older than all
+## posts in the post table.
+##
+## Reading:
+##
+##   The post lists are paginated over the hot posts followed by the
+##   archived ones.  As long as a page lies within the hot posts, only
+##   the post table is queried; the archive is counted and read only
+##   by the pages reaching past the newest archived post.
+##
+##   The archived posts are returned as the same read models as the
+##   hot ones (see app/readmodels.py) with their authors read from the
+##   application database - the archive may be another database.
+##
+##   The search index keeps the archived posts (the move bypasses the
+##   SearchableMixin hooks); the search results are read from both
+##   tables.
+##
+## ---------------------------------------------------------
+
+from datetime import datetime, timedelta
+from flask import current_app
+from flask_sqlalchemy import Pagination
+from app import db
+from app.models import Post, ArchivedPost
+from app.readmodels import post_views, row_views
+from app.search import query_index
+from app.streaming import paginate
+
+
+def archive_enabled(app=None):
+    app = app or current_app
+    return bool(app.config['POST_ARCHIVE_AFTER_DAYS'])
+
+
+## =========================================================
+## Moving the posts
+## ---------------------------------------------------------
+
+def archive_posts(days, batch, progress=None):
+    """Move the posts older than 'days' days to the archive.
+
+    Each batch is copied to the archive and committed before it is
+    deleted from the post table - an interrupted run leaves posts in
+    both tables, which the next run deletes from the post table
+    without copying them again.
+
+    Returns the number of posts moved.  'progress' is called with
+    the number of posts moved so far after each batch.
+
+    """
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    hot = Post.__table__
+    cold = ArchivedPost.__table__
+    moved = 0
+    while True:
+        rows = [dict(row) for row in db.session.execute(
+            db.select([hot]).where(hot.c.timestamp < cutoff)
+            .order_by(hot.c.timestamp, hot.c.id).limit(batch))]
+        if not rows:
+            break
+        ids = [row['id'] for row in rows]
+
+        # Statements without mapper go to the application database
+        copied = {id for id, in db.session.execute(
+            db.select([cold.c.id]).where(cold.c.id.in_(ids)),
+            mapper=ArchivedPost)}
+        rows = [row for row in rows if row['id'] not in copied]
+        if rows:
+            db.session.execute(cold.insert(), rows, mapper=ArchivedPost)
+        db.session.commit()
+
+        db.session.execute(hot.delete().where(hot.c.id.in_(ids)))
+        db.session.commit()
+
+        moved += len(ids)
+        if progress is not None:
+            progress(moved)
+    return moved
+
+
+## =========================================================
+## Reading
+## ---------------------------------------------------------
+
+def archived_posts(user_ids=None):
+    """A query of the archived posts (of the users 'user_ids'),
+    newest first.
+    """
+    query = ArchivedPost.query
+    if user_ids is not None:
+        query = query.filter(ArchivedPost.user_id.in_(user_ids))
+    return query.order_by(ArchivedPost.timestamp.desc(),
+                          ArchivedPost.id.desc())
+
+
+def archived_views(query):
+    """The PostViews of a query of archived posts."""
+    return row_views(query.with_entities(
+        ArchivedPost.id, ArchivedPost.body, ArchivedPost.timestamp,
+        ArchivedPost.language, ArchivedPost.user_id).all())
+
+
+def posts_by_id(ids):
+    """The PostViews of the posts 'ids' - hot, archived or stored in
+    the shards (see app/shards.py) - by id.
+    """
+    from app.shards import sharding_enabled, shard_posts_by_id
+    posts = {post.id: post for post in
+             post_views(Post.query.filter(Post.id.in_(ids)))} if ids else {}
+    missing = [id for id in ids if id not in posts]
+    if missing and archive_enabled():
+        posts.update((post.id, post) for post in archived_views(
+            ArchivedPost.query.filter(ArchivedPost.id.in_(missing))))
+    elif missing and sharding_enabled():
+        posts.update(shard_posts_by_id(missing))
+    return posts
+
+
+def paginate_posts(posts, archived, page, per_page):
+    """Get a page of the hot posts 'posts' followed by the archived
+    ones.
+
+    'posts' is a query of Post, newest first.  'archived' is a
+    function returning the matching query of ArchivedPost (see
+    archived_posts()) - it is only called when the page reaches past
+    the hot posts.
+
+    """
+    if not archive_enabled():
+        return paginate(post_views(posts), page, per_page)
+
+    page = max(page, 1)
+    start = (page - 1) * per_page
+    hot_total = posts.order_by(None).count()
+
+    # The page and the first post of the next one are hot
+    if start + per_page < hot_total:
+        return paginate(post_views(posts), page, per_page, total=hot_total)
+
+    query = archived()
+    archived_total = query.order_by(None).count()
+    items = post_views(posts).limit(per_page).offset(start).all() \
+        if start < hot_total else []
+    if len(items) < per_page and archived_total:
+        items += archived_views(query.limit(per_page - len(items))
+                                .offset(max(0, start - hot_total)))
+    return Pagination(None, page, per_page, hot_total + archived_total,
+                      items)
+
+
+def archived_count():
+    """The number of archived posts - 0 without archive."""
+    if not archive_enabled():
+        return 0
+    return db.session.query(db.func.count(ArchivedPost.id)).scalar()
+
+
+def search_posts(expression, page, per_page):
+    """Search the posts - hot and archived.
+
+    Returns the PostViews of the page, ordered by relevance, and the
+    total number of matches.
+
+    """
+    ids, total = query_index(Post.__tablename__, expression, page, per_page)
+    return search_hits(ids), total
+
+
+def search_hits(ids):
+    """The PostViews of the search hits 'ids', in the order of the
+    hits.
+    """
+    posts = posts_by_id(ids)
+    return [posts[id] for id in ids if id in posts]
+
+
+## fin.
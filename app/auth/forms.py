@@ -3,7 +3,7 @@ from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, BooleanField, SubmitField
 from wtforms.validators import ValidationError, DataRequired, Email, EqualTo
 from flask_babel import _, lazy_gettext as _l
-from app.models import User
+from app.availability import username_available, email_available
 
 
 class LoginForm(FlaskForm):
@@ -29,16 +29,18 @@ class RegistrationForm(FlaskForm):
     # When the 'ValidationError' is thrown its error message is
     # displayed next to the respective field for the user to see.
 
+    #
+    # The names are looked up in the index of the worker - only the
+    # names possibly in use are queried (see app/availability.py).
+
     def validate_username(self, username):
         """Ensure that the username is not used yet."""
-        user = User.query.filter_by(username=username.data).first()
-        if user is not None:
+        if not username_available(username.data):
             raise ValidationError(_('Please use a different username.'))
 
     def validate_email(self, email):
         """Ensure that the email is not used yet."""
-        user = User.query.filter_by(email=email.data).first()
-        if user is not None:
+        if not email_available(email.data):
             raise ValidationError(_('Please use a different email address.'))
 
 
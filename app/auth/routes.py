@@ -1,10 +1,13 @@
 
-from flask import render_template, redirect, url_for, flash, request
+from flask import render_template, redirect, url_for, flash, request, \
+    jsonify, abort
+from sqlalchemy.exc import IntegrityError
 from werkzeug.urls import url_parse
 from flask_login import login_user, logout_user, current_user
 from flask_babel import _
 from app import db
 from app.auth import bp
+from app.availability import username_available
 from app.auth.forms import LoginForm, RegistrationForm, \
     ResetPasswordRequestForm, ResetPasswordForm
 from app.models import User
@@ -42,6 +45,10 @@ def login():
             flash(_('Invalid username or password'))
             return redirect(url_for('auth.login'))
 
+        # Store the password hash when it has been replaced by a hash
+        # with the current parameters (see app/passwords.py)
+        db.session.commit()
+
         # Authentication successfull
         # The credentials are correct: 
         # A user with the given username and password exists.
@@ -89,12 +96,39 @@ def register():
         user = User(username=form.username.data, email=form.email.data)
         user.set_password(form.password.data)
         db.session.add(user)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Taken meanwhile (see app/availability.py)
+            db.session.rollback()
+            form.username.errors.append(
+                _('Please use a different username or email address.'))
+            return render_template('auth/register.html',
+                                   title=_('Register'), form=form)
         flash(_('Congratulations, you are now a registered user!'))
         return redirect(url_for('auth.login'))
     return render_template('auth/register.html', title=_('Register'), form=form)
 
 
+@bp.route('/available')
+def available():
+    """Whether the username given is not used yet
+    (see app/availability.py).
+
+    Email addresses are only checked when the registration form is
+    submitted - answering for any address would tell anybody who has
+    an account.
+
+    """
+    username = request.args.get('username', '').strip()
+    if not username:
+        abort(400)
+    response = jsonify({'username': username,
+                        'available': username_available(username)})
+    response.cache_control.no_store = True
+    return response
+
+
 @bp.route('/reset_password_request', methods=['GET', 'POST'])
 def reset_password_request():
     if current_user.is_authenticated:
@@ -104,6 +138,8 @@ def reset_password_request():
         user = User.query.filter_by(email=form.email.data).first()
         if user:
             send_password_reset_email(user)
+            # Commit the queued email (see app/tasks.py)
+            db.session.commit()
         flash(
             _('Check your email for the instructions to reset your password'))
         return redirect(url_for('auth.login'))
@@ -0,0 +1,310 @@
+## =========================================================
+## app/availability.py
+## ---------------------------------------------------------
+##
+## Availability of usernames and email addresses.
+##
+## The registration and profile forms check that a username or an
+## email address is not used yet - and the registration page asks
+## for the username while the user is typing:
+##
+##   GET /auth/available?username=susan  ->  {"available": false}
+##
+## (Not for the email address: the endpoint needs no login, and would
+## tell anybody whether an address has an account.)
+##
+## Instead of querying the user table for every check, each worker
+## keeps in memory
+##
+##   - a Bloom filter of the case-folded usernames and one of the
+##     lower-case email addresses - "definitely free" when the name is
+##     not in the filter, "maybe used" otherwise,
+##   - a sorted list of the case-folded usernames, telling the names
+##     merely sharing the bits of the filter (about
+##     AVAILABILITY_ERROR_RATE of the free names) from the names used
+##     with any capitalisation.
+##
+## Only the remaining candidates - a name used with some
+## capitalisation, an email address maybe used - are checked with a
+## query of the user table.
+##
+## Updates:
+##
+##   The structures are loaded from the user table on first use in
+##   the worker.  The users registered or renamed by the worker are
+##   added when they are committed; the users registered by the other
+##   workers are read every AVAILABILITY_REFRESH seconds (the users
+##   with ids above the largest one seen - a range scan of the
+##   primary key).  A username given up stays in the filter but is
+##   dropped from the sorted list.
+##
+##   A name taken by a rename in another worker may be answered as
+##   free until the worker is restarted - the unique indexes of the
+##   user table reject it when the form is saved.
+##
+## ---------------------------------------------------------
+
+import math
+from bisect import bisect_left, insort
+from hashlib import blake2b
+from threading import Lock
+from time import time
+from flask import current_app
+
+
+def fold_username(username):
+    return username.casefold()
+
+
+def fold_email(email):
+    return email.lower()
+
+
+class BloomFilter(object):
+    """A Bloom filter of strings for 'capacity' strings with the
+    false positive rate 'error_rate'.
+    """
+
+    def __init__(self, capacity, error_rate):
+        capacity = max(capacity, 1)
+        self.size = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, value):
+        # Double hashing: the positions h1 + i * h2
+        digest = blake2b(value.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self.positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self.positions(value))
+
+
+class AvailabilityIndex(object):
+    """The usernames and email addresses known to a worker."""
+
+    def __init__(self, capacity, error_rate, refresh):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.refresh = refresh
+        self._lock = Lock()
+        self._loaded = None
+        self.last_id = 0
+        # Users registered by this worker since the last refresh
+        self.added_ids = set()
+        self.names = None
+        self.emails = None
+        self.sorted_names = []
+        self.checks = 0
+        self.queries = 0
+
+    ## ---------------------------------------------------------
+    ## Loading
+
+    def load(self):
+        """Read all users.  Needs an application context."""
+        from app import db
+        from app.models import User
+        count = db.session.query(db.func.count(User.id)).scalar()
+
+        # Room for the users registered until the worker is restarted
+        capacity = max(self.capacity, 2 * count)
+        names = BloomFilter(capacity, self.error_rate)
+        emails = BloomFilter(capacity, self.error_rate)
+        sorted_names = []
+        last_id = 0
+        for id, username, email in db.session.query(
+                User.id, User.username, User.email).yield_per(1000):
+            if username is not None:
+                names.add(fold_username(username))
+                sorted_names.append(fold_username(username))
+            if email is not None:
+                emails.add(fold_email(email))
+            last_id = max(last_id, id)
+        sorted_names.sort()
+
+        with self._lock:
+            self.names, self.emails = names, emails
+            self.sorted_names = sorted_names
+            self.last_id = last_id
+            self.added_ids = set()
+            self._loaded = time()
+
+    def update(self):
+        """Load the structures on first use, and the users registered
+        by the other workers every 'refresh' seconds.
+        """
+        if self._loaded is None:
+            self.load()
+            return
+        if self.refresh and self._loaded + self.refresh < time():
+            from app import db
+            from app.models import User
+            self._loaded = time()
+            rows = db.session.query(User.id, User.username, User.email)\
+                .filter(User.id > self.last_id).order_by(User.id).all()
+            for id, username, email in rows:
+                if id not in self.added_ids:
+                    self.add(username, email)
+                self.last_id = max(self.last_id, id)
+            self.added_ids.clear()
+
+    def add(self, username=None, email=None, old_username=None, id=None):
+        """Add a username and / or an email address in use - and drop
+        the username given up from the sorted names.  'id' is the id
+        of a user registered by this worker.
+        """
+        if self.names is None:
+            return
+        with self._lock:
+            if id is not None:
+                self.added_ids.add(id)
+            if old_username is not None:
+                folded = fold_username(old_username)
+                index = bisect_left(self.sorted_names, folded)
+                if index < len(self.sorted_names) and \
+                   self.sorted_names[index] == folded:
+                    del self.sorted_names[index]
+            if username is not None:
+                self.names.add(fold_username(username))
+                insort(self.sorted_names, fold_username(username))
+            if email is not None:
+                self.emails.add(fold_email(email))
+
+    ## ---------------------------------------------------------
+    ## Checks
+
+    def username_available(self, username):
+        """Whether a username is not used yet."""
+        from app.models import User
+        self.update()
+        self.checks += 1
+        folded = fold_username(username)
+        if folded not in self.names:
+            return True
+        index = bisect_left(self.sorted_names, folded)
+        if index == len(self.sorted_names) or \
+           self.sorted_names[index] != folded:
+            return True
+        self.queries += 1
+        return User.query.filter_by(username=username).first() is None
+
+    def email_available(self, email):
+        """Whether an email address is not used yet."""
+        from app.models import User
+        self.update()
+        self.checks += 1
+        if fold_email(email) not in self.emails:
+            return True
+        self.queries += 1
+        return User.query.filter_by(email=email).first() is None
+
+    def stats(self):
+        return {
+            'users':   len(self.sorted_names),
+            'checks':  self.checks,
+            'queries': self.queries,
+        }
+
+
+## =========================================================
+## Checks of the forms
+## ---------------------------------------------------------
+
+def username_available(username):
+    return current_app.availability.username_available(username)
+
+
+def email_available(email):
+    return current_app.availability.email_available(email)
+
+
+## =========================================================
+## Keeping the index up to date
+## ---------------------------------------------------------
+
+def after_flush(session, flush_context):
+    """Remember the usernames and email addresses which have been
+    written.
+
+    This is intended to be used as event handler and has to be
+    bound to the 'after_flush' event of the database.
+
+    """
+    # NOTE:
+    # The attribute history still shows the changes of the flush
+    # when 'after_flush' is triggered.
+    from app import db
+    from app.models import User
+    changes = [(user.username, user.email, None, user.id)
+               for user in session.new if isinstance(user, User)]
+    for user in session.dirty:
+        if not isinstance(user, User):
+            continue
+        state = db.inspect(user)
+        username = state.attrs.username.history
+        email = state.attrs.email.history
+        if username.added or email.added:
+            changes.append((
+                username.added[0] if username.added else None,
+                email.added[0] if email.added else None,
+                username.deleted[0] if username.deleted else None,
+                None))
+    if changes:
+        session.info.setdefault('availability', []).extend(changes)
+
+
+def after_commit(session):
+    """Add the committed usernames and email addresses to the index
+    of the worker.
+
+    This is intended to be used as event handler and has to be
+    bound to the 'after_commit' event of the database.
+
+    """
+    changes = session.info.pop('availability', None)
+    if changes:
+        index = current_app.availability
+        for username, email, old_username, id in changes:
+            index.add(username, email, old_username, id)
+
+
+def after_rollback(session):
+    """Forget the changes which have been rolled back.
+
+    This is intended to be used as event handler and has to be
+    bound to the 'after_rollback' event of the database.
+
+    """
+    session.info.pop('availability', None)
+
+
+def register_events(db):
+    """Bind the indexing handlers to the database events."""
+    db.event.listen(db.session, 'after_flush',    after_flush)
+    db.event.listen(db.session, 'after_commit',   after_commit)
+    db.event.listen(db.session, 'after_rollback', after_rollback)
+
+
+def init_app(app):
+    """Create the (empty) index of the worker - it is loaded on first
+    use.
+    """
+    app.availability = AvailabilityIndex(
+        app.config['AVAILABILITY_CAPACITY'],
+        app.config['AVAILABILITY_ERROR_RATE'],
+        app.config['AVAILABILITY_REFRESH'])
+    app.metrics['availability'] = app.availability.stats
+
+
+## fin.
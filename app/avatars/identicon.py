@@ -0,0 +1,96 @@
+## =========================================================
+## app/avatars/identicon.py
+## ---------------------------------------------------------
+##
+## Identicons: avatars generated from the email hash of a user.
+##
+## The hash determines a color and a horizontally symmetric pattern
+## of 5x5 cells, drawn in the color on a light background.  The same
+## hash always gives the same image, so the images can be cached
+## forever.
+##
+## The PNG image is encoded directly with zlib and struct - as
+## palette image with two colors, one byte per pixel.
+##
+## ---------------------------------------------------------
+
+import struct
+import zlib
+
+# Number of cells per row and column
+GRID = 5
+
+# Background color
+BACKGROUND = (240, 240, 240)
+
+
+def pattern(digest):
+    """The cells of the identicon which are drawn in the foreground
+    color, as rows of booleans.
+
+    The left three columns are taken from the bits of the hash,
+    the right two columns mirror the left two ones.
+
+    """
+    bits = int(digest, 16)
+    half = (GRID + 1) // 2
+    rows = []
+    for y in range(GRID):
+        left = [bool(bits >> (y * half + x) & 1) for x in range(half)]
+        rows.append(left + left[:GRID - half][::-1])
+    return rows
+
+
+def color(digest):
+    """The foreground color taken from the last bytes of the hash."""
+    r, g, b = bytes.fromhex(digest[-6:])
+    # Not too light on the light background
+    return (r * 3 // 4, g * 3 // 4, b * 3 // 4)
+
+
+def identicon(digest, size):
+    """The identicon of the hash as PNG image of size x size pixels."""
+    cell = size // (GRID + 1)
+    margin = (size - cell * GRID) // 2
+
+    # One row of pixels per row of cells
+    lines = []
+    for row in pattern(digest):
+        line = bytearray(size)
+        for x, filled in enumerate(row):
+            if filled:
+                start = margin + x * cell
+                line[start:start + cell] = b'\x01' * cell
+        lines.append(bytes(line))
+
+    empty = bytes(size)
+    scanlines = []
+    for y in range(size):
+        row = (y - margin) // cell
+        line = lines[row] if y >= margin and row < GRID else empty
+        # Filter type 0 (None) for each scanline
+        scanlines.append(b'\x00' + line)
+
+    return png(size, size, [BACKGROUND, color(digest)],
+               b''.join(scanlines))
+
+
+def png(width, height, palette, data):
+    """Encode a palette image with 8 bits per pixel as PNG."""
+
+    def chunk(kind, content):
+        return struct.pack('>I', len(content)) + kind + content + \
+            struct.pack('>I', zlib.crc32(kind + content) & 0xffffffff)
+
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        # Width, height, bit depth 8, color type 3 (palette),
+        # compression, filter and interlace method 0
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0)),
+        chunk(b'PLTE', b''.join(bytes(rgb) for rgb in palette)),
+        chunk(b'IDAT', zlib.compress(data, 9)),
+        chunk(b'IEND', b''),
+    ])
+
+
+## fin.
@@ -0,0 +1,180 @@
+## =========================================================
+## app/avatars/routes.py
+## ---------------------------------------------------------
+##
+## The avatars of the users:
+##
+##   /avatar/<email hash>/<size>
+##
+## Without upstream service the avatar is the identicon of the hash
+## (see app/avatars/identicon.py).  As it never changes, it is sent
+## with a Cache-Control header allowing the browser to keep it for a
+## year without revalidating it.
+##
+## With an upstream service (AVATAR_UPSTREAM, e.g. Gravatar) the
+## avatar is fetched from the service, falling back to the identicon
+## when the user has not registered an avatar there.  These avatars
+## are cached for AVATAR_UPSTREAM_MAX_AGE seconds only.
+##
+## The images are stored in an on-disk cache (AVATAR_CACHE_DIR) with
+## a directory per source and size:
+##
+##   <AVATAR_CACHE_DIR>/<source>/<size>/<hash[:2]>/<hash>
+##
+## Only the sizes listed in AVATAR_SIZES are served - User.avatar()
+## rounds the requested sizes up to one of them - so that the cache
+## holds a bounded number of images per user.
+##
+## Only the avatars of the users are stored: the endpoint needs no
+## login, and any hash is accepted.  The avatars of unknown hashes are
+## rendered (or fetched) on each request without being stored - and
+## the endpoint is rate limited (see RATE_LIMITS in config.py).
+##
+## ---------------------------------------------------------
+
+import os
+import re
+import tempfile
+from io import BytesIO
+from time import time
+import requests
+from flask import abort, current_app, send_file
+from app import db
+from app.avatars import bp
+from app.avatars.identicon import identicon
+from app.models import User, email_hash
+
+# Email hashes (md5 in hex)
+HASH = re.compile(r'^[0-9a-f]{32}$')
+
+# Cache-Control of the identicons
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+@bp.route('/avatar/<digest>/<int:size>')
+def avatar(digest, size):
+    config = current_app.config
+    if not HASH.match(digest) or size not in config['AVATAR_SIZES']:
+        abort(404)
+
+    upstream = config['AVATAR_UPSTREAM']
+    if upstream:
+        source = 'upstream'
+        max_age = config['AVATAR_UPSTREAM_MAX_AGE']
+        cache_control = 'public, max-age={}'.format(max_age)
+    else:
+        source = 'identicon'
+        max_age = None
+        cache_control = IMMUTABLE
+
+    path = cache_path(source, digest, size)
+    if not is_cached(path, max_age):
+        image = None
+        if upstream:
+            image = fetch_upstream(upstream, digest, size)
+        if image is None:
+            image = identicon(digest, size)
+        if not is_known(digest) or not store(path, image):
+            # Not cached - send the image from memory
+            path = None
+
+    if path is not None:
+        response = send_file(path, mimetype=image_type(path),
+                             conditional=True)
+    else:
+        response = send_file(BytesIO(image), mimetype=image_type(image))
+
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+
+## =========================================================
+## On-disk cache
+## ---------------------------------------------------------
+
+def cache_path(source, digest, size):
+    return os.path.join(
+        os.path.abspath(current_app.config['AVATAR_CACHE_DIR']),
+        source, str(size), digest[:2], digest)
+
+
+def is_known(digest):
+    """Is the hash the one of a user (or of the default avatar)?  The
+    avatars of other hashes are not stored.
+    """
+    return digest == email_hash('') or db.session.query(
+        User.query.filter_by(email_hash=digest).exists()).scalar()
+
+
+def is_cached(path, max_age):
+    """Is the image in the cache and - for images which expire - not
+    older than max_age seconds?
+    """
+    try:
+        modified = os.path.getmtime(path)
+    except OSError:
+        return False
+    return max_age is None or modified + max_age > time()
+
+
+def store(path, image):
+    """Write the image to the cache.
+
+    The image is written to a temporary file which is then renamed,
+    so that concurrent requests never read a partially written image.
+
+    Returns False when the image could not be written.
+
+    """
+    try:
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as file:
+            file.write(image)
+        os.replace(tmp, path)
+    except OSError:
+        current_app.logger.warning('Could not cache avatar %s', path)
+        return False
+    return True
+
+
+def image_type(image):
+    """The mimetype of an image (given as path or as bytes)."""
+    if isinstance(image, str):
+        with open(image, 'rb') as file:
+            image = file.read(8)
+    if image.startswith(b'\x89PNG'):
+        return 'image/png'
+    if image.startswith(b'GIF8'):
+        return 'image/gif'
+    return 'image/jpeg'
+
+
+## =========================================================
+## Upstream service
+## ---------------------------------------------------------
+
+def fetch_upstream(url, digest, size):
+    """Fetch the avatar from the upstream service.
+
+    'url' is a template like
+    'https://www.gravatar.com/avatar/{hash}?d=404&s={size}'.
+
+    Returns None when the service has no avatar for the hash or
+    cannot be reached in time.
+
+    """
+    try:
+        response = requests.get(
+            url.format(hash=digest, size=size),
+            timeout=current_app.config['AVATAR_UPSTREAM_TIMEOUT'])
+    except requests.RequestException:
+        return None
+    if response.status_code != 200 or \
+       not response.headers.get('Content-Type', '').startswith('image/'):
+        return None
+    return response.content
+
+
+## fin.
@@ -0,0 +1,286 @@
+## =========================================================
+## app/backfills.py
+## ---------------------------------------------------------
+##
+## Online backfills of the data of the migrations.
+##
+## A migration adding a column only changes the schema - filling the
+## new column for the existing rows in the same revision would run
+## as a single transaction inside 'flask db upgrade', locking a large
+## table for minutes on every deploy (see boot.sh).  The data is
+## filled in by a backfill instead, registered with the revision
+## adding the column:
+##
+##   @backfill('email_hash', 'user', revision='3dc066c37417')
+##   def hash_emails(low, high):
+##       ... update the rows with low < id <= high ...
+##       return <number of rows updated>
+##
+## and run separately from the schema change with
+##
+##   flask backfill run [NAME ...] [--batch 1000] [--pause 0.1]
+##   flask backfill list
+##
+## Runs:
+##
+##   - The table is walked in ranges of --batch primary keys up to
+##     the largest key at the start of the run - rows written later
+##     are written by the application code, which fills the column.
+##
+##   - Each range is updated and its position recorded in the
+##     backfill_progress table in one transaction, so that an
+##     interrupted run resumes after the last committed range.
+##
+##   - The run sleeps --pause seconds between the ranges to leave the
+##     database to the application.
+##
+##   - A backfill is run only once its revision has been applied, and
+##     by one process at a time: the runner holds a lease on its
+##     progress row, renewed with every range.
+##
+## The backfills have to be idempotent - a range may be updated
+## again after a crash - and should skip the rows already filled.
+##
+## The updates bypass the session, and with it the invalidation of
+## the cached post fragments (see app/fragments.py).  A backfill
+## changing what is shown with the posts bumps the profile version of
+## their authors (see touch_profiles()) - part of the cache keys of
+## the fragments in every worker.
+##
+## ---------------------------------------------------------
+
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
+from time import sleep
+from uuid import uuid4
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from app import db
+
+# Registered backfills: name -> BackfillJob
+BACKFILLS = OrderedDict()
+
+# Seconds a runner holds a backfill without renewing its lease
+LEASE = 60
+
+BackfillJob = namedtuple('BackfillJob', [
+    'name', 'table', 'revision', 'function'])
+
+
+class BackfillBusy(Exception):
+    """The backfill is being run by another process."""
+
+
+def backfill(name, table, revision):
+    """Register a function as backfill 'name' of the table 'table',
+    run once the migration 'revision' has been applied.
+    """
+    def decorator(f):
+        BACKFILLS[name] = BackfillJob(name, table, revision, f)
+        return f
+    return decorator
+
+
+## =========================================================
+## Revisions
+## ---------------------------------------------------------
+
+def applied_revisions():
+    """The revisions applied to the application database: the current
+    heads and their ancestors.
+    """
+    from alembic.runtime.migration import MigrationContext
+    from alembic.script import ScriptDirectory
+
+    migrate = current_app.extensions['migrate']
+    script = ScriptDirectory.from_config(
+        migrate.migrate.get_config(migrate.directory))
+    heads = MigrationContext.configure(
+        db.session.connection()).get_current_heads()
+    db.session.commit()
+    return {revision.revision for head in heads
+            for revision in script.iterate_revisions(head, 'base')}
+
+
+## =========================================================
+## Progress
+## ---------------------------------------------------------
+
+def get_progress(name):
+    """The progress of a backfill - created when it is missing."""
+    from app.models import BackfillProgress
+    progress = BackfillProgress.query.get(name)
+    if progress is None:
+        progress = BackfillProgress(name=name, position=0, rows=0)
+        db.session.add(progress)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Created concurrently by another runner
+            db.session.rollback()
+            progress = BackfillProgress.query.get(name)
+    return progress
+
+
+def acquire(name, token, now):
+    """Take the lease on a backfill - unless another runner holds it.
+    Returns whether the lease has been taken.
+    """
+    from app.models import BackfillProgress
+    table = BackfillProgress.__table__
+    taken = db.session.execute(table.update().where(db.and_(
+        table.c.name == name,
+        db.or_(table.c.claim.is_(None), table.c.claim == token,
+               table.c.claimed_until < now))).values(
+            claim=token, claimed_until=now + timedelta(seconds=LEASE),
+            started=db.func.coalesce(table.c.started, now))).rowcount
+    db.session.commit()
+    return bool(taken)
+
+
+def advance(name, token, position, rows, finished=None):
+    """Record the progress of a backfill and renew the lease - in the
+    transaction of the range just updated.
+    """
+    from app.models import BackfillProgress
+    table = BackfillProgress.__table__
+    now = datetime.utcnow()
+    updated = db.session.execute(table.update().where(db.and_(
+        table.c.name == name, table.c.claim == token)).values(
+            position=position, rows=table.c.rows + rows,
+            claimed_until=now + timedelta(seconds=LEASE),
+            finished=finished,
+            claim=None if finished else token)).rowcount
+    if not updated:
+        db.session.rollback()
+        raise BackfillBusy(name)
+
+
+## =========================================================
+## Running the backfills
+## ---------------------------------------------------------
+
+def primary_key(table):
+    return list(db.Model.metadata.tables[table].primary_key.columns)[0]
+
+
+def run_backfill(job, batch, pause, progress=None):
+    """Run a backfill to its end.
+
+    Returns the number of rows updated by this run.  'progress' is
+    called with the position and the number of rows updated after
+    each range.
+
+    """
+    state = get_progress(job.name)
+    if state.finished is not None:
+        return 0
+
+    token = uuid4().hex
+    if not acquire(job.name, token, datetime.utcnow()):
+        raise BackfillBusy(job.name)
+
+    key = primary_key(job.table)
+    high_water = db.session.query(db.func.max(key)).scalar() or 0
+    position = state.position
+    db.session.commit()
+
+    updated = 0
+    while position < high_water:
+        high = min(position + batch, high_water)
+        count = job.function(position, high) or 0
+        advance(job.name, token, high, count)
+        db.session.commit()
+        position = high
+        updated += count
+        if progress is not None:
+            progress(position, updated)
+        if pause and position < high_water:
+            sleep(pause)
+
+    advance(job.name, token, position, 0, finished=datetime.utcnow())
+    db.session.commit()
+    return updated
+
+
+def pending_backfills(names=None):
+    """The registered backfills (or those named) whose revision has
+    been applied.
+    """
+    applied = applied_revisions()
+    jobs = [BACKFILLS[name] for name in names] if names \
+        else list(BACKFILLS.values())
+    return [job for job in jobs if job.revision in applied]
+
+
+## =========================================================
+## Backfills
+## ---------------------------------------------------------
+
+def touch_profiles(user_ids):
+    """Bump the profile versions of users - the cached fragments of
+    their posts are not used anymore (see app/fragments.py).
+    """
+    from app.models import User
+    if user_ids:
+        table = User.__table__
+        db.session.execute(table.update()
+                           .where(table.c.id.in_(list(user_ids)))
+                           .values(profile_updated=datetime.utcnow()))
+
+
+@backfill('email_hash', 'user', revision='3dc066c37417')
+def hash_emails(low, high):
+    """Hash the emails of the users (see models.email_hash()) - the
+    avatars shown with their posts change.
+    """
+    from app.models import User, email_hash
+    rows = db.session.query(User.id, User.email).filter(
+        User.id > low, User.id <= high, User.email.isnot(None),
+        User.email_hash.is_(None)).all()
+    if rows:
+        table = User.__table__
+        db.session.execute(
+            table.update().where(table.c.id == db.bindparam('_id'))
+            .values(email_hash=db.bindparam('_hash'),
+                    profile_updated=datetime.utcnow()),
+            [{'_id': id, '_hash': email_hash(email)} for id, email in rows])
+    return len(rows)
+
+
+@backfill('post_language', 'post', revision='defd9ffc7c65')
+def detect_post_languages(low, high):
+    """Detect the language of the posts written before the language
+    has been stored with them ('' when it cannot be detected).
+    """
+    from app.models import Post
+    from app.translate import detect_language
+    rows = db.session.query(Post.id, Post.body, Post.user_id).filter(
+        Post.id > low, Post.id <= high, Post.language.is_(None)).all()
+    if rows:
+        table = Post.__table__
+        db.session.execute(
+            table.update().where(table.c.id == db.bindparam('_id'))
+            .values(language=db.bindparam('_language')),
+            [{'_id': id, '_language': detect_language(body or '')}
+             for id, body, _ in rows])
+
+        # The posts show a 'Translate' link now
+        touch_profiles({user_id for _, _, user_id in rows})
+    return len(rows)
+
+
+@backfill('post_tags', 'post', revision='965aec5c06e6')
+def index_post_tags(low, high):
+    """Store the hashtags and mentions of the posts written before
+    they have been parsed (see app/tags.py).
+    """
+    from app.models import Post
+    from app.tags import index_posts
+    rows = db.session.query(Post.id, Post.body, Post.timestamp).filter(
+        Post.id > low, Post.id <= high).all()
+    index_posts(db.session, rows)
+    return len(rows)
+
+
+## fin.
@@ -0,0 +1,272 @@
+## =========================================================
+## app/cache.py
+## ---------------------------------------------------------
+##
+## Caches used by the application:
+##
+## - LRUCache:       An in-process cache with a bounded number of
+##                   entries, evicting the least recently used ones.
+## - MemcachedCache: A cache shared by all worker processes, stored
+##                   in a local memcached daemon.
+## - TieredCache:    A combination of both: lookups go to the
+##                   in-process tier first and fall back to the
+##                   shared tier.
+##
+## SingleFlight makes concurrent callers wait for a single
+## computation of a missing value instead of each computing it.
+##
+## The memcached tier is optional: it is only used when the
+## address of the memcached daemon has been configured
+## (see MEMCACHED_SERVER in config.py).
+##
+## ---------------------------------------------------------
+
+from collections import OrderedDict
+from threading import Event, Lock
+
+
+## =========================================================
+## In-process LRU cache
+## ---------------------------------------------------------
+
+class LRUCache(object):
+    """An in-process cache holding up to 'size' entries."""
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get_many(self, keys):
+        """Get the values of the given keys as dictionary.
+
+        Keys which are not in the cache are missing in the result.
+
+        """
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    found[key] = self._entries[key]
+        return found
+
+    def set_many(self, mapping):
+        with self._lock:
+            for key, value in mapping.items():
+                self._entries[key] = value
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+## =========================================================
+## Shared memcached cache
+## ---------------------------------------------------------
+
+class MemcachedCache(object):
+    """A cache stored in a memcached daemon shared by all workers.
+
+    'server' is the address of the daemon as 'host:port'.
+    The entries expire after 'ttl' seconds.
+
+    Errors of the memcached daemon are not fatal: the cache behaves
+    as if it was empty.
+
+    """
+
+    def __init__(self, server, ttl):
+        # pymemcache is only needed when memcached is used
+        from pymemcache import serde
+        from pymemcache.client.base import PooledClient
+        from pymemcache.exceptions import MemcacheError
+
+        host, port = server.rsplit(':', 1)
+        self.ttl = ttl
+        self.client = PooledClient(
+            (host, int(port)),
+            serde=serde.pickle_serde,
+            connect_timeout=0.1,
+            timeout=0.1,
+            ignore_exc=True,
+            no_delay=True)
+        self.errors = (OSError, MemcacheError)
+
+    def get_many(self, keys):
+        if not keys:
+            return {}
+        try:
+            return self.client.get_many(keys) or {}
+        except self.errors:
+            return {}
+
+    def set_many(self, mapping):
+        if not mapping:
+            return
+        try:
+            self.client.set_many(mapping, expire=self.ttl, noreply=True)
+        except self.errors:
+            pass
+
+    def delete_many(self, keys):
+        if not keys:
+            return
+        try:
+            self.client.delete_many(keys, noreply=True)
+        except self.errors:
+            pass
+
+    def clear(self):
+        try:
+            self.client.flush_all(noreply=True)
+        except self.errors:
+            pass
+
+
+## =========================================================
+## Tiered cache
+## ---------------------------------------------------------
+
+class TieredCache(object):
+    """An in-process LRU cache backed by an optional shared cache.
+
+    Values found in the shared tier are copied to the in-process
+    tier.  The number of hits of each tier and the number of misses
+    are counted.
+
+    """
+
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def get_many(self, keys):
+        found = self.local.get_many(keys)
+        self.hits += len(found)
+
+        if self.shared is not None and len(found) < len(keys):
+            missing = [key for key in keys if key not in found]
+            shared = self.shared.get_many(missing)
+            if shared:
+                self.local.set_many(shared)
+                found.update(shared)
+                self.shared_hits += len(shared)
+
+        self.misses += len(keys) - len(found)
+        return found
+
+    def set_many(self, mapping):
+        self.local.set_many(mapping)
+        if self.shared is not None:
+            self.shared.set_many(mapping)
+
+    def delete_many(self, keys):
+        self.local.delete_many(keys)
+        if self.shared is not None:
+            self.shared.delete_many(keys)
+
+    def clear(self):
+        self.local.clear()
+        if self.shared is not None:
+            self.shared.clear()
+
+    def stats(self):
+        return {
+            'entries':     len(self.local),
+            'hits':        self.hits,
+            'shared_hits': self.shared_hits,
+            'misses':      self.misses,
+        }
+
+
+## =========================================================
+## Single flight
+## ---------------------------------------------------------
+
+class _Call(object):
+    """A computation in progress."""
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Make concurrent calls with the same key share one computation.
+
+    The first caller computes the value; callers arriving while the
+    computation is in progress wait for it and get the same result
+    (or the same exception).
+
+    Example:
+
+        flight = SingleFlight()
+        value = flight.do('explore', rebuild)
+
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._calls = {}
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, function):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+            else:
+                self.shared += 1
+
+        # Wait for the computation of the first caller
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result
+
+
+def create_cache(app, size):
+    """Create a tiered cache with an in-process tier of 'size'
+    entries, using the configured memcached daemon as shared tier.
+    """
+    shared = None
+    if app.config['MEMCACHED_SERVER']:
+        shared = MemcachedCache(app.config['MEMCACHED_SERVER'],
+                                app.config['MEMCACHED_TTL'])
+
+    return TieredCache(LRUCache(size), shared)
+
+
+## fin.
@@ -1,5 +1,6 @@
 
 import os
+from time import perf_counter
 import click
 
 
@@ -35,3 +36,204 @@ def register(app):
         if os.system('pybabel compile -d app/translations'):
             raise RuntimeError('compile command failed')
 
+    @app.cli.group()
+    def graph():
+        """Follow graph commands."""
+        pass
+
+    @graph.command()
+    @click.option('--all', 'full', is_flag=True,
+                  help='Refresh the suggestions of all users.')
+    @click.option('--top', type=int,
+                  help='Number of suggestions per user.')
+    @click.option('--chunk', type=int, default=10000,
+                  help='Number of users computed at once.')
+    def suggest(full, top, chunk):
+        """Compute the "who to follow" suggestions."""
+        from app.suggestions import compute_suggestions
+        stats = compute_suggestions(full=full, top=top, chunk_size=chunk)
+        click.echo('{follows} follows, {users} users refreshed, '
+                   '{suggestions} suggestions'.format(**stats))
+        for step in ('load', 'select', 'multiply', 'store', 'total'):
+            if step in stats:
+                click.echo('  {:<10} {:8.3f}s'.format(step, stats[step]))
+
+    @app.cli.command()
+    @click.option('--threads', type=int, default=4,
+                  help='Worker threads per process.')
+    @click.option('--processes', type=int, default=1,
+                  help='Worker processes.')
+    @click.option('--batch', type=int, default=10,
+                  help='Number of tasks claimed at once.')
+    def worker(threads, processes, batch):
+        """Run the tasks of the task queue."""
+        from flask import current_app
+        from app.tasks import run_workers
+        run_workers(current_app._get_current_object(),
+                    threads, processes, batch)
+
+    @app.cli.group()
+    def data():
+        """Bulk export and import of users, posts and follows."""
+        pass
+
+    @data.command('export')
+    @click.argument('path')
+    @click.option('--chunk', type=int, default=1000,
+                  help='Number of rows read at once.')
+    def export_command(path, chunk):
+        """Export the data as NDJSON to PATH ('.gz': compressed)."""
+        from app.transfer import open_file, export_data, transfer_rates
+        start = perf_counter()
+        with open_file(path, 'w') as out:
+            counts = export_data(out, chunk, progress=lambda table, count:
+                                 click.echo('{} {} rows'.format(table, count),
+                                            err=True))
+        for line in transfer_rates(counts, perf_counter() - start):
+            click.echo(line, err=True)
+
+    @data.command('import')
+    @click.argument('path')
+    @click.option('--batch', type=int, default=1000,
+                  help='Number of lines committed at once.')
+    @click.option('--offset', type=int, default=0,
+                  help='Number of lines to skip (to resume an import).')
+    def import_command(path, batch, offset):
+        """Import NDJSON data from PATH ('.gz': compressed)."""
+        from app.transfer import open_file, import_data, reindex_posts, \
+            transfer_rates
+        committed = [offset]
+
+        def progress(lines):
+            committed[0] = lines
+            click.echo('{} lines committed'.format(lines), err=True)
+
+        start = perf_counter()
+        try:
+            with open_file(path, 'r') as lines:
+                counts = import_data(lines, batch, offset, progress)
+        except Exception:
+            click.echo('Import failed - resume with --offset {}'.format(
+                committed[0]), err=True)
+            raise
+        for line in transfer_rates(counts, perf_counter() - start):
+            click.echo(line, err=True)
+
+        start = perf_counter()
+        indexed = reindex_posts()
+        if indexed:
+            click.echo('{} posts indexed in {:.1f}s'.format(
+                indexed, perf_counter() - start), err=True)
+
+    @app.cli.group()
+    def archive():
+        """Archive of the old posts."""
+        pass
+
+    @archive.command('init')
+    def archive_init():
+        """Create the archive table in ARCHIVE_DATABASE_URL."""
+        from app import db
+        db.create_all(bind='archive')
+
+    @archive.command('posts')
+    @click.option('--batch', type=int,
+                  help='Number of posts moved per transaction.')
+    def archive_posts_command(batch):
+        """Move the posts older than POST_ARCHIVE_AFTER_DAYS days to the
+        archive."""
+        from flask import current_app
+        from app.archive import archive_posts
+        days = current_app.config['POST_ARCHIVE_AFTER_DAYS']
+        if not days:
+            raise click.UsageError('POST_ARCHIVE_AFTER_DAYS is not set.')
+        start = perf_counter()
+        moved = archive_posts(
+            days, batch or current_app.config['POST_ARCHIVE_BATCH'],
+            progress=lambda moved: click.echo(
+                '{} posts moved'.format(moved), err=True))
+        seconds = perf_counter() - start
+        click.echo('{} posts archived in {:.1f}s, {:.0f} posts/s'.format(
+            moved, seconds, moved / seconds if seconds else 0))
+
+    @app.cli.group()
+    def shards():
+        """Shards of the posts."""
+        pass
+
+    @shards.command('init')
+    def shards_init():
+        """Create the post table in the shards of POST_SHARDS."""
+        from app.shards import create_shards
+        create_shards()
+
+    @shards.command()
+    @click.option('--batch', type=int, default=500,
+                  help='Number of posts moved per transaction.')
+    def rebalance(batch):
+        """Move the posts to the shards of their authors."""
+        from flask import current_app
+        from app.shards import sharding_enabled, rebalance
+        if not sharding_enabled(current_app):
+            raise click.UsageError('POST_SHARDS is not set.')
+        start = perf_counter()
+        moved = rebalance(batch, progress=lambda source, moved: click.echo(
+            '{}: {} posts moved'.format(source, moved), err=True))
+        seconds = perf_counter() - start
+        total = sum(moved.values())
+        click.echo('{} posts moved in {:.1f}s, {:.0f} posts/s'.format(
+            total, seconds, total / seconds if seconds else 0))
+
+    @app.cli.group()
+    def backfill():
+        """Online backfills of the data of the migrations."""
+        pass
+
+    @backfill.command('list')
+    def backfill_list():
+        """Show the backfills and their progress."""
+        from app.backfills import BACKFILLS, applied_revisions
+        from app.models import BackfillProgress
+        applied = applied_revisions()
+        progress = {p.name: p for p in BackfillProgress.query}
+        for name, job in BACKFILLS.items():
+            state = progress.get(name)
+            if job.revision not in applied:
+                status = 'waiting for revision {}'.format(job.revision)
+            elif state is None:
+                status = 'pending'
+            elif state.finished is not None:
+                status = 'done, {} rows'.format(state.rows)
+            else:
+                status = 'at {} {}, {} rows'.format(
+                    job.table, state.position, state.rows)
+            click.echo('{:<20} {}'.format(name, status))
+
+    @backfill.command('run')
+    @click.argument('names', nargs=-1)
+    @click.option('--batch', type=int, default=1000,
+                  help='Number of primary keys updated per transaction.')
+    @click.option('--pause', type=float, default=0.1,
+                  help='Seconds to sleep between the transactions.')
+    def backfill_run(names, batch, pause):
+        """Run the backfills (all pending ones when no NAMES are given)."""
+        from app.backfills import BACKFILLS, BackfillBusy, \
+            pending_backfills, run_backfill
+        unknown = [name for name in names if name not in BACKFILLS]
+        if unknown:
+            raise click.UsageError('Unknown backfills: {}'.format(
+                ', '.join(unknown)))
+        for job in pending_backfills(names):
+            start = perf_counter()
+            try:
+                updated = run_backfill(
+                    job, batch, pause, progress=lambda position, rows:
+                    click.echo('{}: {} {}, {} rows'.format(
+                        job.name, job.table, position, rows), err=True))
+            except BackfillBusy:
+                click.echo('{}: run by another process'.format(job.name))
+                continue
+            seconds = perf_counter() - start
+            click.echo('{}: {} rows in {:.1f}s, {:.0f} rows/s'.format(
+                job.name, updated, seconds,
+                updated / seconds if seconds else 0))
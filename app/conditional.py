@@ -0,0 +1,170 @@
+## =========================================================
+## app/conditional.py
+## ---------------------------------------------------------
+##
+## HTTP conditional GET for the feeds and the profile pages.
+##
+## Each page gets a cheap version stamp, computed from a few
+## indexed values only:
+##
+## - the global feed:   the newest post, the trending posts and
+##                      tags and the newest change of any profile,
+## - an author:         her newest post, her profile, her follows
+##                      and the time she has been seen last,
+## - a user's timeline: the newest post and the newest profile
+##                      change of the followed users, her profile
+##                      and her follows.
+##
+## Together with what the page shows about the current user (her
+## profile, her follows, her suggestions, the locale) the stamp is
+## sent as ETag.  When the browser asks for a page with a matching
+## If-None-Match header, '304 Not Modified' is answered before any
+## feed query or template rendering has been done.
+##
+## Only the ETag is used: most parts of a stamp are ids, keys or
+## counters rather than times, a Last-Modified date derived from it
+## would miss their changes.
+##
+## ---------------------------------------------------------
+
+from functools import wraps
+from hashlib import sha1
+from time import time
+from flask import current_app, g, make_response, request, session
+from flask_login import current_user
+from app import db
+from app.models import User, Post
+from app.shards import sharding_enabled
+from app.trending import trending_version
+
+
+## =========================================================
+## Version stamps
+## ---------------------------------------------------------
+
+def global_feed_version():
+    """Version of the explore feed: its newest post, the trending
+    posts and tags (see app/trending.py) and the profiles of the
+    authors shown with the posts.
+    """
+    newest, last_id = db.session.query(
+        db.func.max(Post.timestamp), db.func.max(Post.id)).one()
+    profiles = db.session.query(db.func.max(User.profile_updated)).scalar()
+    return (newest, last_id, profiles) + trending_version()
+
+
+def author_version(username):
+    """Version of the profile page of an author.
+
+    Returns None when the user does not exist.
+
+    """
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        return None
+
+    newest = db.session.query(db.func.max(Post.timestamp)).filter(
+        Post.user_id == user.id).scalar()
+
+    # The page shows the minute the user was last seen - which is
+    # updated on each of her requests
+    last_seen = user.last_seen and \
+        user.last_seen.replace(second=0, microsecond=0)
+    return (user.id, newest, user.profile_updated, user.follows_updated,
+            last_seen)
+
+
+def timeline_version():
+    """Version of the timeline of the current user."""
+    authors = current_user.followed_authors()
+    newest = db.session.query(db.func.max(Post.timestamp)).filter(
+        Post.user_id.in_(authors)).scalar()
+    profiles = db.session.query(db.func.max(User.profile_updated)).filter(
+        User.id.in_(authors)).scalar()
+
+    # The page contains a form with a CSRF token - which expires after
+    # WTF_CSRF_TIME_LIMIT seconds.  Make sure the browser does not
+    # reuse a page with an expired token.
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT') or 3600
+    csrf_period = int(time() // (limit // 2))
+
+    return (newest, profiles, csrf_period)
+
+
+def viewer_version():
+    """Version of what a page shows about the current user and her
+    request.
+    """
+    if not current_user.is_authenticated:
+        return (g.locale,)
+
+    return (g.locale, current_user.id, current_user.profile_updated,
+            current_user.follows_updated, current_user.suggestions_updated)
+
+
+## =========================================================
+## Conditional responses
+## ---------------------------------------------------------
+
+def conditional(version):
+    """Answer GET requests with '304 Not Modified' when the version
+    stamp of the page has not changed.
+
+    'version' is called with the arguments of the view and returns
+    the version stamp of the page as tuple - or None to answer the
+    request without using the stamp.
+
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+
+            # Flashed messages are shown only once -
+            # a page showing them must not be reused.
+            if request.method != 'GET' or session.get('_flashes'):
+                return f(*args, **kwargs)
+
+            # The versions are computed from the post table of the
+            # application database (see app/shards.py)
+            if sharding_enabled():
+                return f(*args, **kwargs)
+
+            stamp = version(**kwargs)
+            if stamp is None:
+                return f(*args, **kwargs)
+
+            stamp = (request.full_path,) + stamp + viewer_version()
+            etag = sha1(repr(stamp).encode('utf-8')).hexdigest()
+
+            if not_modified(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(f(*args, **kwargs))
+
+            response.set_etag(etag)
+
+            # The browser has to revalidate the page every time
+            # and must not share it with other users
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            response.vary.add('Cookie')
+            response.vary.add('Accept-Language')
+
+            return response
+        return decorated_function
+    return decorator
+
+
+def not_modified(etag):
+    """Does the request show that the browser has the current version
+    of the page?
+
+    If-Modified-Since is not honoured - the pages are not sent with
+    a Last-Modified date.
+
+    """
+    return bool(request.if_none_match) and \
+        request.if_none_match.contains(etag)
+
+
+## fin.
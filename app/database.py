@@ -0,0 +1,477 @@
+## =========================================================
+## app/database.py
+## ---------------------------------------------------------
+##
+## Database layer: Flask-SQLAlchemy with read replica routing
+## and engine tuning profiles.
+##
+## Read replicas are configured with the configuration variable
+## SQLALCHEMY_REPLICAS - a list of database URIs.  They are
+## registered as additional binds 'replica_0', 'replica_1', ...
+##
+## Views decorated with @read_replica send their queries to one of
+## the replicas when they are requested with GET or HEAD.
+## Everything else - all other views, flushes and commits - uses the
+## primary database given by SQLALCHEMY_DATABASE_URI.
+##
+## As replicas lag behind the primary, a user who has just written
+## something is sent to the primary for a few seconds after her own
+## commit ('read-your-writes' window, see
+## REPLICA_READ_YOUR_WRITES_WINDOW).
+##
+## The engines are tuned by the engine profile selected with the
+## configuration variable DATABASE_ENGINE_PROFILE (pool options and
+## statements run on every new connection, like the SQLite pragmas
+## or statement timeouts - see DATABASE_ENGINE_PROFILES in config.py).
+## The pools of all engines are instrumented to collect checkout
+## wait times and saturation metrics.
+##
+## ---------------------------------------------------------
+
+import random
+from functools import wraps
+from threading import Lock
+from time import time, perf_counter
+from flask import current_app, request, has_request_context, \
+    session as flask_session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import event, exc, inspect, orm, pool as sa_pool
+
+# Prefix of the bind keys used for the read replicas
+REPLICA_BIND_PREFIX = 'replica_'
+
+# Prefix of the bind keys used for the shards of the posts
+SHARD_BIND_PREFIX = 'shard_'
+
+# Key of the end of the read-your-writes window in the flask session
+READ_YOUR_WRITES_KEY = '_replica_rw_until'
+
+
+## =========================================================
+## Routing session
+## ---------------------------------------------------------
+
+class RoutingSession(SignallingSession):
+    """A session sending the queries either to the primary database
+    or to a read replica.
+
+    The replica is used only when it has been requested by setting
+    session.info['use_replica'] - see @read_replica - and the
+    session has not written anything yet.  A replica, once chosen, is
+    used for all following queries of the session, so that all reads
+    of a request see the same state of the database.
+
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+
+        # session.execute(..., mapper=Model) passes the model class
+        if mapper is not None:
+            mapper = inspect(mapper)
+
+        # Models with an explicit bind key (__bind_key__)
+        # are never routed to a replica
+        if mapper is not None and \
+           mapper.persist_selectable.info.get('bind_key') is not None:
+            return SignallingSession.get_bind(self, mapper, clause)
+
+        # Writes and reads following a write go to the primary
+        if self._flushing or self.info.get('wrote') or \
+           not self.info.get('use_replica'):
+            return SignallingSession.get_bind(self, mapper, clause)
+
+        replica = self.info.get('replica')
+        if replica is None:
+            replica = choose_replica(self.app)
+            if replica is None:
+                return SignallingSession.get_bind(self, mapper, clause)
+            self.info['replica'] = replica
+
+        state = get_state(self.app)
+        return state.db.get_engine(self.app, bind=replica)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy using the RoutingSession and tuning the
+    engines with the selected engine profile.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(RoutingSQLAlchemy, self).__init__(*args, **kwargs)
+        self._tuned_engines = set()
+        self._tuning_lock = Lock()
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+
+        # Pool options of the engine profile
+        # have to be set before the driver hacks of Flask-SQLAlchemy
+        # are applied, which decide about the pool used for SQLite
+        # depending on the 'pool_size' option
+        profile = get_engine_profile(app, sa_url)
+        if profile is not None:
+            options.update(profile.get('engine_options', {}))
+            if isinstance(options.get('poolclass'), str):
+                options['poolclass'] = getattr(sa_pool, options['poolclass'])
+
+        super(RoutingSQLAlchemy, self).apply_driver_hacks(app, sa_url, options)
+
+        # Collect pool metrics
+        poolclass = options.get('poolclass') or \
+            sa_url.get_dialect().get_pool_class(sa_url)
+        options['poolclass'] = instrumented_pool_class(poolclass)
+
+    def get_engine(self, app=None, bind=None):
+        engine = super(RoutingSQLAlchemy, self).get_engine(app, bind)
+
+        # Set up a new engine before its first connection is opened
+        if engine not in self._tuned_engines:
+            with self._tuning_lock:
+                if engine not in self._tuned_engines:
+                    tune_engine(engine, self.get_app(app))
+                    self._tuned_engines.add(engine)
+
+        return engine
+
+
+## =========================================================
+## Replicas
+## ---------------------------------------------------------
+
+def replica_binds(app):
+    """Get the bind keys of the configured replicas."""
+    return ['{}{}'.format(REPLICA_BIND_PREFIX, i)
+            for i in range(len(app.config['SQLALCHEMY_REPLICAS']))]
+
+
+def shard_binds(app):
+    """Get the bind keys of the configured shards (see app/shards.py)."""
+    return ['{}{}'.format(SHARD_BIND_PREFIX, i)
+            for i in range(len(app.config['POST_SHARDS']))]
+
+
+def choose_replica(app):
+    """Choose one of the replicas at random.
+
+    Returns None when no replicas are configured.
+
+    """
+    binds = replica_binds(app)
+    if not binds:
+        return None
+
+    return random.choice(binds)
+
+
+def read_replica(f):
+    """Send the reads of a GET or HEAD request to a read replica.
+
+    Requests of the current user during the read-your-writes window
+    following one of her own commits are still answered from the
+    primary database.
+
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if request.method in ('GET', 'HEAD') and \
+           flask_session.get(READ_YOUR_WRITES_KEY, 0) < time():
+            db = current_app.extensions['sqlalchemy'].db
+            db.session().info['use_replica'] = True
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+## =========================================================
+## Read-your-writes
+## ---------------------------------------------------------
+
+def is_visible_write(session):
+    """Does the current flush write anything other users or the
+    user herself would notice?
+
+    Changes of attributes listed in the configuration variable
+    REPLICA_IGNORED_ATTRIBUTES (like User.last_seen, which is updated
+    on every request) do not count.
+
+    """
+    if session.new or session.deleted:
+        return True
+
+    ignored = session.app.config['REPLICA_IGNORED_ATTRIBUTES']
+    for obj in session.dirty:
+        state = inspect(obj)
+        for attr in state.attrs:
+            if attr.key not in ignored and attr.history.has_changes():
+                return True
+
+    return False
+
+
+def after_flush(session, flush_context):
+    """Remember that the session has written to the primary.
+
+    This is intended to be used as event handler and has to be
+    bound to the 'after_flush' event of the database.
+
+    """
+    # NOTE:
+    # session.new, session.dirty and session.deleted still contain
+    # the state before the flush when 'after_flush' is triggered.
+    session.info['wrote'] = True
+    if is_visible_write(session):
+        session.info['visible_write'] = True
+
+
+def after_commit(session):
+    """Start the read-your-writes window of the current user.
+
+    This is intended to be used as event handler and has to be
+    bound to the 'after_commit' event of the database.
+
+    """
+    if session.info.pop('visible_write', False):
+
+        # Stop using the replica for the rest of the request
+        session.info.pop('use_replica', None)
+        session.info.pop('replica', None)
+
+        # Send the following requests of the user to the primary
+        if has_request_context():
+            window = session.app.config['REPLICA_READ_YOUR_WRITES_WINDOW']
+            flask_session[READ_YOUR_WRITES_KEY] = time() + window
+
+    session.info.pop('wrote', None)
+
+
+def after_rollback(session):
+    """Forget the writes which have been rolled back.
+
+    This is intended to be used as event handler and has to be
+    bound to the 'after_rollback' event of the database.
+
+    """
+    session.info.pop('wrote', None)
+    session.info.pop('visible_write', None)
+
+
+## =========================================================
+## Engine profiles
+## ---------------------------------------------------------
+
+def get_engine_profile(app, sa_url):
+    """Get the engine profile selected by DATABASE_ENGINE_PROFILE.
+
+    A profile is only used for the engines of the database backend
+    it has been written for (its 'dialect').  Returns None when no
+    profile has been selected or the profile does not fit the
+    backend.
+
+    """
+    name = app.config['DATABASE_ENGINE_PROFILE']
+    if not name:
+        return None
+
+    profile = app.config['DATABASE_ENGINE_PROFILES'][name]
+    if profile['dialect'] != sa_url.get_backend_name():
+        return None
+
+    return profile
+
+
+def tune_engine(engine, app):
+    """Set up a new engine: run the statements of the engine profile
+    on each new connection and collect the pool metrics.
+    """
+    profile = get_engine_profile(app, engine.url)
+    statements = profile.get('on_connect', []) if profile else []
+
+    # A pool class given explicitly in SQLALCHEMY_ENGINE_OPTIONS
+    # is not instrumented - collect at least the counters
+    if not hasattr(engine.pool, 'metrics'):
+        engine.pool.metrics = PoolMetrics()
+
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
+        engine.pool.metrics.connected()
+
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        engine.pool.metrics.checked_out()
+
+    def on_checkin(dbapi_connection, connection_record):
+        engine.pool.metrics.checked_in()
+
+    # NOTE:
+    # Listeners registered with the engine are kept
+    # when the pool is recreated by engine.dispose().
+    event.listen(engine, 'connect',  on_connect)
+    event.listen(engine, 'checkout', on_checkout)
+    event.listen(engine, 'checkin',  on_checkin)
+
+
+## =========================================================
+## Pool metrics
+## ---------------------------------------------------------
+
+class PoolMetrics(object):
+    """Checkout wait times and saturation of a connection pool."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def connected(self):
+        with self._lock:
+            self.connects += 1
+
+    def checked_out(self):
+        with self._lock:
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+
+    def checked_in(self):
+        with self._lock:
+            self.in_use -= 1
+
+    def waited(self, seconds, timeout=False):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+            if timeout:
+                self.timeouts += 1
+
+    def snapshot(self, pool):
+        """Get the metrics as dictionary."""
+        with self._lock:
+            metrics = {
+                'pool':         pool.__class__.__name__,
+                'connects':     self.connects,
+                'checkouts':    self.checkouts,
+                'in_use':       self.in_use,
+                'peak_in_use':  self.peak_in_use,
+                'timeouts':     self.timeouts,
+                'wait_avg_ms':  1000 * self.wait_total / self.checkouts
+                                if self.checkouts else 0.0,
+                'wait_max_ms':  1000 * self.wait_max,
+            }
+
+        # Saturation of pools with a limited number of connections
+        if isinstance(pool, sa_pool.QueuePool) and \
+           pool._max_overflow >= 0:
+            capacity = pool.size() + pool._max_overflow
+            metrics['capacity'] = capacity
+            metrics['saturation'] = pool.checkedout() / capacity \
+                if capacity else 1.0
+
+        return metrics
+
+
+class InstrumentedPool(object):
+    """Mixin for the pool classes measuring the checkout wait time."""
+
+    def __init__(self, *args, **kwargs):
+        super(InstrumentedPool, self).__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def connect(self):
+        start = perf_counter()
+        try:
+            connection = super(InstrumentedPool, self).connect()
+        except exc.TimeoutError:
+            self.metrics.waited(perf_counter() - start, timeout=True)
+            raise
+        self.metrics.waited(perf_counter() - start)
+        return connection
+
+    def recreate(self):
+        # Keep the metrics when the pool is recreated by engine.dispose()
+        new_pool = super(InstrumentedPool, self).recreate()
+        new_pool.metrics = self.metrics
+        return new_pool
+
+
+_instrumented_pool_classes = {}
+
+
+def instrumented_pool_class(poolclass):
+    """Get the instrumented version of a pool class."""
+    if issubclass(poolclass, InstrumentedPool):
+        return poolclass
+
+    if poolclass not in _instrumented_pool_classes:
+        _instrumented_pool_classes[poolclass] = type(
+            'Instrumented' + poolclass.__name__,
+            (InstrumentedPool, poolclass), {})
+
+    return _instrumented_pool_classes[poolclass]
+
+
+def pool_metrics(app):
+    """Get the pool metrics of all engines of the application.
+
+    The engines are listed by bind key ('primary' for the default
+    database).
+
+    """
+    metrics = {}
+    for bind, connector in list(get_state(app).connectors.items()):
+        engine = connector._engine
+        if engine is not None and hasattr(engine.pool, 'metrics'):
+            metrics[bind or 'primary'] = \
+                engine.pool.metrics.snapshot(engine.pool)
+
+    return metrics
+
+
+## =========================================================
+## Setup
+## ---------------------------------------------------------
+
+def init_app(app):
+    """Register the configured replicas, the shards and the archive
+    as binds and the pool metrics as metrics provider.
+    """
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    for bind, uri in zip(replica_binds(app),
+                         app.config['SQLALCHEMY_REPLICAS']):
+        binds[bind] = uri
+    for bind, uri in zip(shard_binds(app), app.config['POST_SHARDS']):
+        binds[bind] = uri
+
+    # The archive of the old posts (see app/archive.py)
+    binds['archive'] = app.config['ARCHIVE_DATABASE_URL'] or \
+        app.config['SQLALCHEMY_DATABASE_URI']
+    app.config['SQLALCHEMY_BINDS'] = binds
+
+    # Expose the pool metrics (see app/metrics)
+    app.metrics['database'] = lambda: pool_metrics(app)
+
+
+def dispose_engines(app):
+    """Drop the connections of all engines - the primary database and
+    every bind (the replicas, the shards and the archive).
+    """
+    from app import db
+    for bind in [None] + list(app.config['SQLALCHEMY_BINDS']):
+        db.get_engine(app, bind=bind).dispose()
+
+
+def register_events(db):
+    """Bind the read-your-writes handlers to the database events."""
+    event.listen(db.session, 'after_flush',    after_flush)
+    event.listen(db.session, 'after_commit',   after_commit)
+    event.listen(db.session, 'after_rollback', after_rollback)
+
+
+## fin.
@@ -6,6 +6,7 @@ from threading import Thread
 from flask import current_app
 from flask_mail import Message
 from app import mail
+from app.tasks import task, enqueue, queue_enabled
 
 
 def send_async_email(app, msg):
@@ -17,10 +18,29 @@ def send_async_email(app, msg):
         mail.send(msg)
 
 
+@task('send_email')
+def send_email_task(subject, sender, recipients, text_body, html_body):
+    """Send an email queued by send_email() (see app/tasks.py)."""
+    msg = Message(subject, sender=sender, recipients=recipients)
+    msg.body = text_body
+    msg.html = html_body
+    mail.send(msg)
+
+
 def send_email(subject, sender, recipients, text_body, html_body):
     """
     Send email asynchronously.
+
+    With the task queue (TASK_QUEUE) the email is sent by a task
+    worker once the session has been committed - the caller has to
+    commit it.
     """
+    if queue_enabled():
+        enqueue('send_email', subject=str(subject), sender=sender,
+                recipients=recipients, text_body=text_body,
+                html_body=html_body)
+        return
+
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
@@ -9,6 +9,18 @@ def not_found_error(error):
     return render_template('errors/404.html'), 404
 
 
+@bp.app_errorhandler(429)
+def too_many_requests_error(error):
+    return render_template('errors/429.html'), 429, \
+        [h for h in error.get_headers() if h[0] == 'Retry-After']
+
+
+@bp.app_errorhandler(503)
+def service_unavailable_error(error):
+    return render_template('errors/503.html'), 503, \
+        [h for h in error.get_headers() if h[0] == 'Retry-After']
+
+
 @bp.app_errorhandler(500)
 def internal_error(error):
     db.session.rollback()
@@ -0,0 +1,179 @@
+## =========================================================
+## app/explore.py
+## ---------------------------------------------------------
+##
+## Snapshot of the first pages of the explore feed.
+##
+## All visitors of the explore page see the same first pages.
+## Instead of querying them for every request, the ids of the posts
+## on the first EXPLORE_SNAPSHOT_PAGES pages are kept in a snapshot
+## which is rebuilt when it is older than EXPLORE_SNAPSHOT_TTL
+## seconds.
+##
+## Rebuilds are 'single flight': requests arriving while the
+## snapshot is rebuilt wait for the rebuild instead of querying the
+## database themselves.  When a memcached daemon is configured
+## (MEMCACHED_SERVER) the snapshot is shared by all workers, so that
+## usually only one of them has to query the database.
+##
+## With the posts in shards (see app/shards.py) the snapshot is
+## gathered from all shards; only the pages past the snapshot are
+## scatter-gather queries.
+##
+## ---------------------------------------------------------
+
+from time import time
+from flask import current_app
+from flask_sqlalchemy import Pagination
+from app import db
+from app.archive import archive_enabled, archived_count, archived_posts, \
+    paginate_posts, posts_by_id
+from app.cache import MemcachedCache, SingleFlight
+from app.models import Post, ArchivedPost
+from app.shards import sharding_enabled, paginate_sharded
+
+# Cache key of the snapshot in memcached
+SNAPSHOT_KEY = 'explore:snapshot'
+
+
+class ExploreSnapshot(object):
+    """The ids of the newest posts, refreshed periodically.
+
+    Each snapshot is a tuple (built_at, ids, total): the time the
+    snapshot has been built, the ids of the newest posts ordered by
+    time, and the total number of posts.
+
+    """
+
+    def __init__(self, pages, per_page, ttl, shared=None):
+        self.size = pages * per_page
+        self.ttl = ttl
+        self.shared = shared
+        self.flight = SingleFlight()
+        self.rebuilds = 0
+        self._snapshot = None
+
+    def is_fresh(self, snapshot):
+        return snapshot is not None and snapshot[0] + self.ttl > time()
+
+    def get(self):
+        """Get the current snapshot, rebuilding it when it is stale."""
+        snapshot = self._snapshot
+        if self.is_fresh(snapshot):
+            return snapshot
+
+        # Only one rebuild at a time
+        return self.flight.do(SNAPSHOT_KEY, self.refresh)
+
+    def refresh(self):
+
+        # A concurrent caller might have refreshed the snapshot
+        # while this one was waiting
+        if self.is_fresh(self._snapshot):
+            return self._snapshot
+
+        # The snapshot of another worker
+        snapshot = None
+        if self.shared is not None:
+            snapshot = self.shared.get_many([SNAPSHOT_KEY]).get(SNAPSHOT_KEY)
+
+        if not self.is_fresh(snapshot):
+            snapshot = self.build()
+            if self.shared is not None:
+                self.shared.set_many({SNAPSHOT_KEY: snapshot})
+
+        self._snapshot = snapshot
+        return snapshot
+
+    def build(self):
+        """Query the ids of the newest posts."""
+        self.rebuilds += 1
+        built_at = time()
+
+        # Gathered from all shards
+        if sharding_enabled():
+            posts = paginate_sharded(None, 1, self.size)
+            return built_at, [post.id for post in posts.items], posts.total
+
+        ids = [id for id, in db.session.query(Post.id).order_by(
+            Post.timestamp.desc(), Post.id.desc()).limit(self.size)]
+
+        # Followed by the newest archived posts (see app/archive.py)
+        if len(ids) < self.size and archive_enabled():
+            ids += [id for id, in archived_posts().with_entities(
+                ArchivedPost.id).limit(self.size - len(ids))]
+        total = db.session.query(db.func.count(Post.id)).scalar() + \
+            archived_count()
+        return built_at, ids, total
+
+    def paginate(self, page, per_page):
+        """Get a page of the explore feed.
+
+        Returns None when the page is not part of the snapshot.
+
+        """
+        if page < 1 or page * per_page > self.size:
+            return None
+
+        built_at, ids, total = self.get()
+        page_ids = ids[(page - 1) * per_page:page * per_page]
+
+        # Retrieve the posts, keeping the order of the snapshot
+        # (posts archived since the snapshot has been built are read
+        # from the archive)
+        posts = posts_by_id(page_ids)
+        items = [posts[id] for id in page_ids if id in posts]
+
+        return Pagination(None, page, per_page, total, items)
+
+    def stats(self):
+        return {
+            'rebuilds':       self.rebuilds,
+            'shared_waits':   self.flight.shared,
+            'age':            time() - self._snapshot[0]
+                              if self._snapshot else None,
+        }
+
+
+def explore_posts(page, per_page):
+    """Get a page of the explore feed.
+
+    The first pages are taken from the snapshot, the following ones
+    are queried from the database.
+
+    """
+    snapshot = current_app.explore_snapshot
+    if snapshot is not None:
+        posts = snapshot.paginate(page, per_page)
+        if posts is not None:
+            return posts
+
+    # Gathered from all shards (see app/shards.py)
+    if sharding_enabled():
+        return paginate_sharded(None, page, per_page)
+
+    return paginate_posts(
+        Post.query.order_by(Post.timestamp.desc(), Post.id.desc()),
+        archived_posts, page, per_page)
+
+
+def init_app(app):
+    """Create the snapshot of the explore feed."""
+    app.explore_snapshot = None
+
+    pages = app.config['EXPLORE_SNAPSHOT_PAGES']
+    if not pages:
+        return
+
+    shared = None
+    if app.config['MEMCACHED_SERVER']:
+        shared = MemcachedCache(app.config['MEMCACHED_SERVER'],
+                                app.config['EXPLORE_SNAPSHOT_TTL'])
+
+    app.explore_snapshot = ExploreSnapshot(
+        pages, app.config['POSTS_PER_PAGE'],
+        app.config['EXPLORE_SNAPSHOT_TTL'], shared)
+    app.metrics['explore'] = app.explore_snapshot.stats
+
+
+## fin.
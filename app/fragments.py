@@ -0,0 +1,160 @@
+## =========================================================
+## app/fragments.py
+## ---------------------------------------------------------
+##
+## Cache of the rendered _post.html fragments.
+##
+## The HTML rendered for a post depends only on the post itself,
+## its author and the locale of the request.  The fragments are
+## therefore cached with the key
+##
+##   (post id, version of the author's profile, locale)
+##
+## When the author changes her profile, her profile version
+## (User.profile_updated) changes and the old fragments of her posts
+## are not used anymore.  The fragments of changed or deleted posts
+## are removed from the cache when the change is committed.
+##
+## In the templates, the feed is built by concatenating the cached
+## fragments:
+##
+##   {% for fragment in post_fragments(posts) %}{{ fragment }}{% endfor %}
+##
+## ---------------------------------------------------------
+
+from flask import current_app, g, render_template
+from markupsafe import Markup
+from app.cache import create_cache
+
+
+def fragment_key(post, locale):
+    """The cache key of the fragment rendered for a post."""
+    author = post.author
+    version = author.profile_updated.strftime('%Y%m%d%H%M%S%f') \
+        if author.profile_updated else '0'
+    return 'post:{}:{}:{}'.format(post.id, version, locale)
+
+
+def render_post(post):
+    return Markup(render_template('_post.html', post=post))
+
+
+def post_fragments(posts):
+    """Get the rendered fragments of the posts.
+
+    The posts are processed in batches of FRAGMENT_CACHE_BATCH posts:
+    the cached fragments of a batch are fetched at once, the missing
+    ones are rendered and stored in the cache.  The fragments are
+    yielded in the order of the posts.
+
+    """
+    cache = current_app.fragment_cache
+    if cache is None:
+        for post in posts:
+            yield render_post(post)
+        return
+
+    batch_size = current_app.config['FRAGMENT_CACHE_BATCH']
+    batch = []
+    for post in posts:
+        batch.append(post)
+        if len(batch) == batch_size:
+            for fragment in _batch_fragments(cache, batch):
+                yield fragment
+            batch = []
+
+    for fragment in _batch_fragments(cache, batch):
+        yield fragment
+
+
+def _batch_fragments(cache, posts):
+    if not posts:
+        return []
+
+    keys = [fragment_key(post, g.locale) for post in posts]
+    cached = cache.get_many(keys)
+
+    rendered = {}
+    fragments = []
+    for key, post in zip(keys, posts):
+        fragment = cached.get(key)
+        if fragment is None:
+            fragment = rendered[key] = render_post(post)
+        fragments.append(Markup(fragment))
+
+    cache.set_many({key: str(fragment)
+                    for key, fragment in rendered.items()})
+
+    return fragments
+
+
+## =========================================================
+## Invalidation
+## ---------------------------------------------------------
+
+def after_flush(session, flush_context):
+    """Remember the posts which have been changed or deleted.
+
+    This is intended to be used as event handler and has to be
+    bound to the 'after_flush' event of the database.
+
+    """
+    # NOTE:
+    # session.dirty and session.deleted still contain the state
+    # before the flush when 'after_flush' is triggered.
+    from app.models import Post
+    changed = [obj for obj in list(session.dirty) + list(session.deleted)
+               if isinstance(obj, Post)]
+    if changed:
+        session.info.setdefault('changed_posts', []).extend(
+            fragment_key(post, '') for post in changed)
+
+
+def after_commit(session):
+    """Remove the fragments of the changed and deleted posts.
+
+    This is intended to be used as event handler and has to be
+    bound to the 'after_commit' event of the database.
+
+    """
+    changed = session.info.pop('changed_posts', None)
+    if not changed:
+        return
+
+    cache = getattr(session.app, 'fragment_cache', None)
+    if cache is None:
+        return
+
+    cache.delete_many([key + locale
+                       for key in changed
+                       for locale in session.app.config['LANGUAGES']])
+
+
+def after_rollback(session):
+    session.info.pop('changed_posts', None)
+
+
+## =========================================================
+## Setup
+## ---------------------------------------------------------
+
+def init_app(app):
+    """Create the fragment cache and make post_fragments() available
+    in the templates.
+    """
+    size = app.config['FRAGMENT_CACHE_SIZE']
+    app.fragment_cache = create_cache(app, size) if size else None
+    app.add_template_global(post_fragments)
+
+    if app.fragment_cache is not None:
+        app.metrics['fragments'] = app.fragment_cache.stats
+
+
+def register_events(db):
+    """Bind the invalidation handlers to the database events."""
+    db.event.listen(db.session, 'after_flush',    after_flush)
+    db.event.listen(db.session, 'after_commit',   after_commit)
+    db.event.listen(db.session, 'after_rollback', after_rollback)
+
+
+## fin.
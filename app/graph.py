@@ -0,0 +1,433 @@
+## =========================================================
+## app/graph.py
+## ---------------------------------------------------------
+##
+## In-process index of the follow graph.
+##
+## When FOLLOW_GRAPH is set, each worker keeps the whole follow
+## graph in memory and answers the follow queries of the user pages
+## - is a user following another one, the followed users and the
+## followers of a user, their numbers - without querying the
+## followers table.
+##
+## The graph is stored twice, once per direction, in compressed
+## sparse row (CSR) form - two arrays of C ints:
+##
+##   offsets:    offsets[u] .. offsets[u + 1] is the range of the
+##               neighbors of user u in 'neighbors'
+##   neighbors:  the neighbors of all users, sorted per user
+##
+## 1M follows take about 8MB per direction.  Membership is a binary
+## search in the neighbors of a user, degrees are a subtraction.
+##
+## Updates:
+##
+##   The rows of users changed after the graph has been loaded are
+##   kept in an overlay (user id -> sorted array of neighbors) which
+##   is merged into the CSR arrays when it grows larger than
+##   FOLLOW_GRAPH_COMPACT rows.
+##
+##   Follows committed by the worker itself are applied when they
+##   are committed.  Follows committed by other workers are noticed
+##   with User.follows_updated, which changes on both users of every
+##   follow and unfollow: when a user's follows_updated is newer than
+##   the version of her rows in the graph, her rows are read again
+##   from the database before they are used.
+##
+## The graph is loaded in the gunicorn master before forking (see
+## app/warmup.py) or else by the first request using it.
+##
+## ---------------------------------------------------------
+
+import sys
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from itertools import accumulate
+from threading import Lock
+from time import perf_counter
+from flask import current_app
+
+# Follows committed shortly before the graph has been loaded might
+# not have been read yet - the rows of users changed during this
+# period are read again when they are used.
+LOAD_MARGIN = timedelta(seconds=60)
+
+# The row of a user without neighbors
+EMPTY = array('i')
+
+
+## =========================================================
+## Adjacency in one direction
+## ---------------------------------------------------------
+
+class Adjacency(object):
+    """The neighbors of all users in one direction of the graph.
+
+    Instances are not changed once they are in use: updated rows are
+    stored as new arrays in the overlay, and compaction creates a new
+    Adjacency - readers never need a lock.
+
+    """
+
+    def __init__(self, offsets, neighbors, overlay=None):
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self.overlay = overlay if overlay is not None else {}
+
+    @classmethod
+    def build(cls, pairs, size):
+        """Build the CSR arrays from (user id, neighbor id) pairs sorted
+        by user id and neighbor id.  'size' is larger than the largest
+        user id.
+        """
+        counts = array('i', bytes(4 * (size + 1)))
+        neighbors = array('i')
+        last = None
+        for pair in pairs:
+            if pair == last:
+                continue
+            last = pair
+            id, other = pair
+            if id + 1 >= len(counts):
+                # A user created while the graph is read
+                counts.extend(array('i', bytes(4 * (id + 2 - len(counts)))))
+            neighbors.append(other)
+            counts[id + 1] += 1
+        return cls(array('i', accumulate(counts)), neighbors)
+
+    def row(self, id):
+        """The neighbors of a user as (array, start, end)."""
+        row = self.overlay.get(id)
+        if row is not None:
+            return row, 0, len(row)
+        if id + 1 >= len(self.offsets):
+            return EMPTY, 0, 0
+        return self.neighbors, self.offsets[id], self.offsets[id + 1]
+
+    def contains(self, id, other):
+        row, start, end = self.row(id)
+        i = bisect_left(row, other, start, end)
+        return i < end and row[i] == other
+
+    def degree(self, id):
+        _, start, end = self.row(id)
+        return end - start
+
+    def ids(self, id):
+        row, start, end = self.row(id)
+        return row[start:end].tolist()
+
+    def size(self):
+        return max([len(self.offsets) - 1] +
+                   [id + 1 for id in self.overlay])
+
+    def compact(self):
+        """A new Adjacency with the overlay merged into the CSR arrays."""
+        return Adjacency.build(
+            ((id, other) for id in range(self.size())
+             for other in self.ids(id)),
+            self.size())
+
+    def edges(self):
+        return len(self.neighbors) + sum(
+            len(row) - self.degree_in_csr(id)
+            for id, row in self.overlay.items())
+
+    def degree_in_csr(self, id):
+        if id + 1 >= len(self.offsets):
+            return 0
+        return self.offsets[id + 1] - self.offsets[id]
+
+    def memory(self):
+        """Approximate memory used in bytes."""
+        return sys.getsizeof(self.offsets) + \
+            sys.getsizeof(self.neighbors) + \
+            sys.getsizeof(self.overlay) + \
+            sum(sys.getsizeof(row) for row in self.overlay.values())
+
+
+## =========================================================
+## Follow graph
+## ---------------------------------------------------------
+
+class FollowGraph(object):
+    """The follow graph of all users.
+
+    - following: user -> the users she follows
+    - followers: user -> the users following her
+
+    """
+
+    def __init__(self, compact_threshold):
+        self.compact_threshold = compact_threshold
+        self.following = None
+        self.followers = None
+        self.loaded_at = None
+        self.build_seconds = None
+        self.syncs = 0
+        self._versions = {}
+        self._lock = Lock()
+
+    @property
+    def is_loaded(self):
+        return self.following is not None
+
+    def load(self):
+        """Read the whole graph from the database."""
+        from app import db
+        from app.models import User, followers
+
+        start = perf_counter()
+        loaded_at = datetime.utcnow() - LOAD_MARGIN
+        size = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+
+        connection = db.session.connection()
+
+        def pairs(column, other):
+            return fetch_rows(connection, db.select(
+                [column, other]).order_by(column, other))
+
+        c = followers.c
+        following = Adjacency.build(
+            pairs(c.follower_id, c.followed_id), size)
+        followed_by = Adjacency.build(
+            pairs(c.followed_id, c.follower_id), size)
+
+        with self._lock:
+            self.following, self.followers = following, followed_by
+            self.loaded_at = loaded_at
+            self._versions = {}
+        self.build_seconds = perf_counter() - start
+
+    ## -----------------------------------------------------
+    ## Queries
+
+    def is_following(self, user, other):
+        self.sync(user)
+        return self.following.contains(user.id, other.id)
+
+    def followed_ids(self, user):
+        self.sync(user)
+        return self.following.ids(user.id)
+
+    def follower_ids(self, user):
+        self.sync(user)
+        return self.followers.ids(user.id)
+
+    def followed_count(self, user):
+        self.sync(user)
+        return self.following.degree(user.id)
+
+    def followers_count(self, user):
+        self.sync(user)
+        return self.followers.degree(user.id)
+
+    ## -----------------------------------------------------
+    ## Updates
+
+    def version(self, id):
+        """The time up to which the rows of the user are known to be
+        current.
+        """
+        return self._versions.get(id, self.loaded_at)
+
+    def sync(self, user):
+        """Read the rows of the user again when she has followed or
+        unfollowed someone - or someone has followed or unfollowed her -
+        since they have been read.
+        """
+        updated = user.follows_updated
+        if updated is None or updated <= self.version(user.id):
+            return
+
+        from app import db
+        from app.models import followers
+        c = followers.c
+
+        def ids(column, other):
+            return array('i', [id for id, in db.session.execute(
+                db.select([other]).where(column == user.id)
+                .distinct().order_by(other))])
+
+        # No lock is held while the database is queried
+        following = ids(c.follower_id, c.followed_id)
+        followed_by = ids(c.followed_id, c.follower_id)
+
+        with self._lock:
+            self.following.overlay[user.id] = following
+            self.followers.overlay[user.id] = followed_by
+            self._versions[user.id] = updated
+            self.syncs += 1
+            self._compact()
+
+    def apply(self, edges, versions):
+        """Apply the follows committed by the worker.
+
+        - edges:     (follower id, followed id, True when followed or
+                     False when unfollowed)
+        - versions:  user id -> (follows_updated before, after the
+                     commit)
+
+        A user's version is advanced only when her rows were current
+        before the commit - otherwise they are read again on next use.
+
+        """
+        with self._lock:
+            for follower, followed, added in edges:
+                self._update(self.following, follower, followed, added)
+                self._update(self.followers, followed, follower, added)
+
+            for id, (before, after) in versions.items():
+                if before is not None and after is not None and \
+                   before <= self.version(id):
+                    self._versions[id] = after
+
+            self._compact()
+
+    @staticmethod
+    def _update(adjacency, id, other, added):
+        row = array('i', adjacency.ids(id))
+        i = bisect_left(row, other)
+        present = i < len(row) and row[i] == other
+        if added and not present:
+            row.insert(i, other)
+        elif not added and present:
+            del row[i]
+        adjacency.overlay[id] = row
+
+    def _compact(self):
+        if len(self.following.overlay) > self.compact_threshold:
+            self.following = self.following.compact()
+        if len(self.followers.overlay) > self.compact_threshold:
+            self.followers = self.followers.compact()
+
+    def stats(self):
+        if not self.is_loaded:
+            return {'loaded': False}
+        return {
+            'loaded':         True,
+            'edges':          self.following.edges(),
+            'memory_bytes':   self.following.memory() +
+                              self.followers.memory(),
+            'build_seconds':  self.build_seconds,
+            'overlay_rows':   len(self.following.overlay),
+            'syncs':          self.syncs,
+        }
+
+
+def fetch_rows(connection, statement, batch=10000):
+    """Iterate over the rows of a statement without parameters.
+
+    The rows are fetched as tuples directly from the DBAPI cursor -
+    creating SQLAlchemy result rows would take four times as long for
+    the million rows of a large follow graph.
+
+    """
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute(str(statement.compile(connection)))
+        while True:
+            rows = cursor.fetchmany(batch)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        cursor.close()
+
+
+def follow_graph():
+    """The follow graph of the current application, loaded on first
+    use - or None when FOLLOW_GRAPH is not set.
+    """
+    graph = current_app.follow_graph
+    if graph is not None and not graph.is_loaded:
+        graph.load()
+    return graph
+
+
+## =========================================================
+## Applying the committed follows
+## ---------------------------------------------------------
+
+def after_flush(session, flush_context):
+    """Remember the follows and unfollows.
+
+    This is intended to be used as event handler and has to be
+    bound to the 'after_flush' event of the database.
+
+    """
+    # NOTE:
+    # The attribute history still shows the changes of the flush
+    # when 'after_flush' is triggered.
+    from app import db
+    from app.models import User
+    edges = []
+    versions = {}
+    for user in session.dirty:
+        if not isinstance(user, User):
+            continue
+        state = db.inspect(user)
+        history = state.attrs.followed.history
+        edges.extend((user.id, other.id, True) for other in history.added)
+        edges.extend((user.id, other.id, False) for other in history.deleted)
+        updated = state.attrs.follows_updated.history
+        if updated.added:
+            before = updated.deleted[0] if updated.deleted else None
+            versions[user.id] = (before, updated.added[0])
+
+    if edges or versions:
+        session.info.setdefault('follow_edges', []).extend(edges)
+        known = session.info.setdefault('follow_versions', {})
+        for id, (before, after) in versions.items():
+            # Keep the version before the first flush of the transaction
+            if id in known:
+                before = known[id][0]
+            known[id] = (before, after)
+
+
+def after_commit(session):
+    """Apply the committed follows to the graph of the worker.
+
+    This is intended to be used as event handler and has to be
+    bound to the 'after_commit' event of the database.
+
+    """
+    edges = session.info.pop('follow_edges', None)
+    versions = session.info.pop('follow_versions', None)
+    if not edges and not versions:
+        return
+
+    graph = getattr(session.app, 'follow_graph', None)
+    if graph is not None and graph.is_loaded:
+        graph.apply(edges or [], versions or {})
+
+
+def after_rollback(session):
+    session.info.pop('follow_edges', None)
+    session.info.pop('follow_versions', None)
+
+
+## =========================================================
+## Setup
+## ---------------------------------------------------------
+
+def init_app(app):
+    """Create the (not yet loaded) follow graph."""
+    app.follow_graph = None
+    if not app.config['FOLLOW_GRAPH']:
+        return
+
+    app.follow_graph = FollowGraph(app.config['FOLLOW_GRAPH_COMPACT'])
+    app.metrics['graph'] = app.follow_graph.stats
+
+
+def register_events(db):
+    """Bind the update handlers to the database events."""
+    db.event.listen(db.session, 'after_flush',    after_flush)
+    db.event.listen(db.session, 'after_commit',   after_commit)
+    db.event.listen(db.session, 'after_rollback', after_rollback)
+
+
+## fin.
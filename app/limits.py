@@ -0,0 +1,323 @@
+## =========================================================
+## app/limits.py
+## ---------------------------------------------------------
+##
+## Rate limits and admission control of the expensive endpoints.
+##
+## Rate limits:
+##
+##   The requests of each client to an endpoint listed in RATE_LIMITS
+##   take a token from a token bucket.  A bucket holds up to 'burst'
+##   tokens and is refilled with 'rate' tokens per second; requests
+##   finding it empty are answered with '429 Too Many Requests' and a
+##   Retry-After header.
+##
+##   Clients are the logged in user (session or API token) and else
+##   the IP address - each client has her own bucket per endpoint.
+##   Behind PROXY_FIX_X_FOR reverse proxies, the IP address is taken
+##   from their X-Forwarded-For header (see create_app()).
+##
+##   A limit with a 'field' keeps a second bucket per value of that
+##   form field and IP address: the login attempts for a username are
+##   limited as well.  The address is part of the key so that the
+##   attempts of others never lock the user out.
+##
+##   The buckets are kept in each worker (RATE_LIMIT_STORE 'local')
+##   or in the memcached daemon shared by the workers of the host
+##   ('memcached', see MEMCACHED_SERVER).  The shared store falls
+##   back to the local one while the daemon cannot be reached.
+##
+## Admission control:
+##
+##   Each worker counts the requests to the endpoints listed in
+##   ADMISSION_LIMITS it is currently serving.  Beyond the limit of
+##   an endpoint, further requests are answered with
+##   '503 Service Unavailable' and a Retry-After header immediately
+##   instead of queuing up and taking all connections of the worker.
+##
+##   This requires a worker serving several requests at a time
+##   (gevent, threads or the ASGI application of app/aio.py).  A
+##   'sync' worker serves one request after the other - its count
+##   never exceeds 1 and the waiting requests queue up in the socket
+##   backlog instead.  gunicorn.conf.py switches the admission control
+##   off for sync workers (see check_concurrency()).
+##
+## The numbers of rejected requests are part of the metrics.
+##
+## ---------------------------------------------------------
+
+from collections import Counter, OrderedDict
+from threading import Lock
+from time import time
+from flask import current_app, g, request
+from flask_login import current_user
+from werkzeug.exceptions import TooManyRequests, ServiceUnavailable
+
+# Prefix of the bucket keys in memcached
+BUCKET_KEY_PREFIX = 'bucket:'
+
+
+## =========================================================
+## Token buckets
+## ---------------------------------------------------------
+
+def refill(state, rate, burst, now):
+    """The number of tokens of a bucket at time 'now'.
+
+    'state' is (tokens, time of the last update) - or None for a new
+    bucket, which is full.
+
+    """
+    if state is None:
+        return float(burst)
+    tokens, updated = state
+    return min(float(burst), tokens + (now - updated) * rate)
+
+
+def take_token(tokens, rate):
+    """Take a token from a bucket holding 'tokens' tokens.
+
+    Returns the number of tokens left - or None when the bucket is
+    empty - and the seconds until the next token is available.
+
+    """
+    if tokens >= 1:
+        return tokens - 1, 0
+    return None, (1 - tokens) / rate if rate > 0 else float('inf')
+
+
+class LocalBucketStore(object):
+    """The token buckets of the clients of a worker.
+
+    Up to 'size' buckets are kept - the least recently used ones are
+    dropped (and start full again when they are used next).
+
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._buckets = OrderedDict()
+        self._lock = Lock()
+
+    def take(self, key, rate, burst):
+        """Take a token from the bucket of the key.
+
+        Returns 0 when a token has been taken and else the seconds
+        until the next one is available.
+
+        """
+        now = time()
+        with self._lock:
+            tokens = refill(self._buckets.get(key), rate, burst, now)
+            left, wait = take_token(tokens, rate)
+            self._buckets[key] = (tokens if left is None else left, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.size:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class MemcachedBucketStore(object):
+    """The token buckets of the clients of all workers, kept in a
+    memcached daemon.
+
+    The buckets are updated with compare-and-set, so that concurrent
+    requests of different workers do not take the same token.
+    'fallback' is used while the daemon cannot be reached.
+
+    """
+
+    # Attempts to update a bucket changed concurrently
+    ATTEMPTS = 3
+
+    def __init__(self, server, fallback):
+        # pymemcache is only needed when memcached is used
+        from pymemcache.client.base import PooledClient
+        from pymemcache.exceptions import MemcacheError
+
+        host, port = server.rsplit(':', 1)
+        self.client = PooledClient(
+            (host, int(port)), connect_timeout=0.1, timeout=0.1,
+            no_delay=True)
+        self.fallback = fallback
+        self.errors = (OSError, MemcacheError)
+
+    def take(self, key, rate, burst):
+        try:
+            return self._take(BUCKET_KEY_PREFIX + key, rate, burst)
+        except self.errors:
+            return self.fallback.take(key, rate, burst)
+
+    def _take(self, key, rate, burst):
+        # A bucket is full again after burst / rate seconds
+        expire = int(burst / rate) + 1 if rate > 0 else 0
+        wait = 0
+        for _ in range(self.ATTEMPTS):
+            now = time()
+            value, cas = self.client.gets(key)
+            state = None
+            if value is not None:
+                tokens, updated = value.decode('ascii').split(':')
+                state = float(tokens), float(updated)
+            tokens = refill(state, rate, burst, now)
+            left, wait = take_token(tokens, rate)
+            if left is None:
+                return wait
+
+            value = '{:.3f}:{:.3f}'.format(left, now)
+            if cas is None:
+                stored = self.client.add(key, value, expire, noreply=False)
+            else:
+                stored = self.client.cas(key, value, cas, expire)
+            if stored:
+                return 0
+
+        # Too much contention - as if the bucket was empty
+        return 1 / rate if rate > 0 else 1
+
+
+## =========================================================
+## Admission control
+## ---------------------------------------------------------
+
+class Admission(object):
+    """The requests a worker is serving per endpoint."""
+
+    def __init__(self):
+        self.in_flight = Counter()
+        self._lock = Lock()
+
+    def enter(self, endpoint, limit):
+        """Count a request - unless 'limit' requests are being served
+        already.  Returns whether the request has been admitted.
+        """
+        with self._lock:
+            if self.in_flight[endpoint] >= limit:
+                return False
+            self.in_flight[endpoint] += 1
+            return True
+
+    def leave(self, endpoint):
+        with self._lock:
+            self.in_flight[endpoint] -= 1
+
+
+## =========================================================
+## Request hooks
+## ---------------------------------------------------------
+
+def client_key():
+    """The client of the request: the logged in user or the IP
+    address.
+    """
+    if current_user.is_authenticated:
+        return 'user:{}'.format(current_user.id)
+
+    # The user of an API token
+    # (the token is verified again by @jwt_required)
+    authorization = request.headers.get('Authorization', '')
+    if authorization.startswith('Bearer '):
+        from flask_jwt_extended import decode_token
+        try:
+            claims = decode_token(authorization[len('Bearer '):])
+            return 'user:{}'.format(
+                claims[current_app.config['JWT_IDENTITY_CLAIM']])
+        except Exception:
+            pass
+
+    return 'ip:{}'.format(request.remote_addr)
+
+
+def check_limits():
+    """Reject the request when the client has exceeded the rate limit
+    of the endpoint or the worker is serving too many requests to it.
+    """
+    limiter = current_app.limiter
+    endpoint = request.endpoint
+
+    limit = current_app.config['RATE_LIMITS'].get(endpoint)
+    if limit is not None and \
+       request.method in limit.get('methods', [request.method]):
+        keys = [client_key()]
+        field = limit.get('field')
+        if field and request.form.get(field):
+            keys.append('{}:{}:{}'.format(
+                field, request.form[field].strip().lower(),
+                request.remote_addr))
+        for key in keys:
+            wait = limiter.store.take('{}:{}'.format(endpoint, key),
+                                      limit['rate'], limit['burst'])
+            if wait:
+                limiter.rate_limited[endpoint] += 1
+                raise TooManyRequests(retry_after=int(wait) + 1)
+
+    limit = current_app.config['ADMISSION_LIMITS'].get(endpoint)
+    if limit is not None:
+        if not limiter.admission.enter(endpoint, limit):
+            limiter.shed[endpoint] += 1
+            raise ServiceUnavailable(
+                retry_after=current_app.config['ADMISSION_RETRY_AFTER'])
+        g.admitted = endpoint
+
+
+def leave(error=None):
+    """Stop counting the request once it has been served (including
+    the body of a streamed response).
+    """
+    endpoint = g.pop('admitted', None)
+    if endpoint is not None:
+        current_app.limiter.admission.leave(endpoint)
+
+
+## =========================================================
+## Setup
+## ---------------------------------------------------------
+
+def check_concurrency(app, concurrent):
+    """Switch the admission control off when the workers serve one
+    request at a time ('concurrent' is False) - it would never reject
+    a request.
+    """
+    if concurrent or not app.config['ADMISSION_LIMITS']:
+        return
+    app.logger.warning('Admission control requires a worker class '
+                       'serving concurrent requests (gevent, gthread, '
+                       'uvicorn) - switched off for sync workers.')
+    app.config['ADMISSION_LIMITS'] = {}
+
+
+class Limiter(object):
+    """The rate limits and the admission control of a worker."""
+
+    def __init__(self, store):
+        self.store = store
+        self.admission = Admission()
+        self.rate_limited = Counter()
+        self.shed = Counter()
+
+    def stats(self):
+        return {
+            'rate_limited': dict(self.rate_limited),
+            'shed':         dict(self.shed),
+            'in_flight':    dict(self.admission.in_flight),
+        }
+
+
+def init_app(app):
+    """Install the rate limits and the admission control."""
+    app.limiter = None
+    if not app.config['RATE_LIMITS'] and not app.config['ADMISSION_LIMITS']:
+        return
+
+    store = LocalBucketStore(app.config['RATE_LIMIT_LOCAL_BUCKETS'])
+    if app.config['RATE_LIMIT_STORE'] == 'memcached' and \
+       app.config['MEMCACHED_SERVER']:
+        store = MemcachedBucketStore(app.config['MEMCACHED_SERVER'], store)
+
+    app.limiter = Limiter(store)
+    app.before_request(check_limits)
+    app.teardown_request(leave)
+    app.metrics['limits'] = app.limiter.stats
+
+
+## fin.
@@ -4,7 +4,7 @@ from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, TextAreaField
 from wtforms.validators import ValidationError, DataRequired, Length
 from flask_babel import _, lazy_gettext as _l
-from app.models import User
+from app.availability import username_available
 
 
 class EditProfileForm(FlaskForm):
@@ -19,13 +19,12 @@ class EditProfileForm(FlaskForm):
 
     def validate_username(self, username):
         if username.data != self.original_username:
-            # NOTE: 
+            # NOTE:
             # When two or more processes are accessing the database at
             # the same time a race condition could cause the
-            # validation to pass...
-            # Very unlikely, so I'm not going to worry about it for now.
-            user = User.query.filter_by(username=self.username.data).first()
-            if user is not None:
+            # validation to pass - the unique index rejects the name
+            # when it is saved (see app/availability.py).
+            if not username_available(self.username.data):
                 raise ValidationError(_('Please use a different username.'))
 
 
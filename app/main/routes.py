@@ -1,14 +1,24 @@
 
 from datetime import datetime
 from flask import render_template, flash, redirect, url_for, request, g, \
-    jsonify, current_app
+    jsonify, current_app, abort, Response
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
-from guess_language import guess_language
-from app import db
+from sqlalchemy.exc import IntegrityError
+from app import db, updates
+from app.archive import archived_posts, paginate_posts, search_posts
+from app.conditional import conditional, global_feed_version, \
+    author_version, timeline_version
+from app.database import read_replica
+from app.explore import explore_posts
 from app.main.forms import EditProfileForm, PostForm, SearchForm
 from app.models import User, Post
-from app.translate import translate
+from app.shards import sharding_enabled, paginate_sharded, write_post
+from app.streaming import render_page, first_item
+from app.tags import normalize_tag, tagged_posts, mentioning_posts
+from app.translate import translate, detect_language
+from app.trending import record_follow, record_translation, \
+    trending_posts, trending_tags
 from app.main import bp
 
 
@@ -51,20 +61,19 @@ def before_request():
 @bp.route('/', methods=['GET', 'POST'])
 @bp.route('/index', methods=['GET', 'POST'])
 @login_required
+@read_replica
+@conditional(timeline_version)
 def index():
     form = PostForm()
     if form.validate_on_submit():
 
         # Guess language the post is written in
-        language = guess_language(form.post.data)
-        if language == 'UNKNOWN' or len(language) > 5:
-            language = ''
-
-        # Get post
-        post = Post(body=form.post.data, author=current_user,
-                    language=language)
-        db.session.add(post)
-        db.session.commit()
+        language = detect_language(form.post.data)
+
+        # Store post
+        # (in the shard of the user - see app/shards.py)
+        write_post(current_user._get_current_object(), form.post.data,
+                   language)
         flash(_('Your post is now live!'))
 
         return redirect(url_for('main.index'))
@@ -77,8 +86,20 @@ def index():
     page = request.args.get('page', 1, type=int)
 
     # Get posts corresponding to the requested page
-    posts = current_user.followed_posts().paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
+    # (only the columns shown - see app/readmodels.py)
+    # (streamed while the page is rendered - see app/streaming.py)
+    # (from the archive past the hot posts - see app/archive.py)
+    # (from the shards - see app/shards.py)
+    if sharding_enabled():
+        posts = paginate_sharded(
+            current_user.followed_ids() + [current_user.id],
+            page, current_app.config['POSTS_PER_PAGE'])
+    else:
+        posts = paginate_posts(
+            current_user.followed_posts(),
+            lambda: archived_posts(current_user.followed_ids() +
+                                   [current_user.id]),
+            page, current_app.config['POSTS_PER_PAGE'])
 
     # Get links to the previous and next page
     prev_url = url_for('main.index', page=posts.prev_num) \
@@ -86,39 +107,101 @@ def index():
     next_url = url_for('main.index', page=posts.next_num) \
         if posts.has_next else None
 
+    # The position of the newest post
+    # The first page checks for newer posts (see app/updates.py)
+    since = None
+    if page == 1:
+        newest = first_item(posts.items)
+        since = updates.format_since(newest) if newest else ''
+
     # Redirecting to the same page
     # to avoid resubmission of posted content
     # resulting in duplicate posts
     # See:
     #   - Post/Redirect/Get
     #     https://en.wikipedia.org/wiki/Post/Redirect/Get
-    return render_template('index.html',
-                           title=_('Home'),
-                           form=form,
-                           posts=posts.items,
-                           prev_url=prev_url,
-                           next_url=next_url)
+    return render_page('index.html',
+                       title=_('Home'),
+                       form=form,
+                       posts=posts.items,
+                       prev_url=prev_url,
+                       next_url=next_url,
+                       since=since)
+
+
+@bp.route('/new_posts')
+@login_required
+@read_replica
+def new_posts():
+    """The number and the ids of the posts in the timeline which are
+    newer than the position given with 'since' (see app/updates.py).
+    """
+    count, ids = updates.new_posts(
+        current_user, updates.parse_since(request.args.get('since')),
+        current_app.config['NEW_POSTS_MAX_IDS'])
+    response = jsonify({'count': count, 'ids': [str(id) for id in ids]})
+    response.cache_control.no_store = True
+    return response
+
+
+@bp.route('/new_posts/stream')
+@login_required
+def new_posts_stream():
+    """Server-sent events notifying the browser of new posts in the
+    timeline (see app/updates.py).
+    """
+    if not current_app.config['NEW_POSTS_STREAM']:
+        abort(404)
+
+    # The stream does not use the database - the authors are read
+    # before the response is sent and the database session is closed.
+    authors = set(current_user.followed_ids()) | {current_user.id}
+    hub = updates.get_hub(current_app._get_current_object())
+
+    response = Response(
+        updates.event_stream(hub, authors, hub.sequence,
+                             current_app.config['NEW_POSTS_STREAM_HEARTBEAT']),
+        mimetype='text/event-stream')
+    response.cache_control.no_store = True
+    # Do not let a proxy buffer the events
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 
 @bp.route('/explore')
 @login_required
+@read_replica
+@conditional(global_feed_version)
 def explore():
     page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
+
+    # The first pages are taken from a periodically refreshed
+    # snapshot of the newest posts (see app/explore.py)
+    posts = explore_posts(page, current_app.config['POSTS_PER_PAGE'])
     prev_url = url_for('main.explore', page=posts.prev_num) \
         if posts.has_prev else None
     next_url = url_for('main.explore', page=posts.next_num) \
         if posts.has_next else None
-    return render_template("index.html",
-                           title=_('Explore'),
-                           posts=posts.items,
-                           prev_url=prev_url,
-                           next_url=next_url)
+
+    # The first page shows the trending posts and tags
+    # (see app/trending.py)
+    trending = {}
+    if page == 1:
+        trending = {'trending_posts': trending_posts(),
+                    'trending_tags':  trending_tags()}
+
+    return render_page("index.html",
+                       title=_('Explore'),
+                       posts=posts.items,
+                       prev_url=prev_url,
+                       next_url=next_url,
+                       **trending)
 
 
 @bp.route('/user/<username>')
 @login_required
+@read_replica
+@conditional(author_version)
 def user(username):
     # Get user
     # When the username does not exist raise a 404 exception
@@ -127,16 +210,56 @@ def user(username):
     # No error was raised - so the user exists
     # Get her posts for the requested page
     page = request.args.get('page', 1, type=int)
-    posts = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
+    if sharding_enabled():
+        posts = paginate_sharded([user.id], page,
+                                 current_app.config['POSTS_PER_PAGE'])
+    else:
+        posts = paginate_posts(user.posts.order_by(Post.timestamp.desc()),
+                               lambda: archived_posts([user.id]),
+                               page, current_app.config['POSTS_PER_PAGE'])
     next_url = url_for('main.user', username=user.username, 
                        page=posts.next_num) if posts.has_next else None
     prev_url = url_for('main.user', username=user.username, 
                        page=posts.prev_num) if posts.has_prev else None
 
     # Render user page
-    return render_template('user.html', user=user, posts=posts.items,
-                           next_url=next_url, prev_url=prev_url)
+    return render_page('user.html', user=user, posts=posts.items,
+                       next_url=next_url, prev_url=prev_url)
+
+
+@bp.route('/tag/<name>')
+@login_required
+@read_replica
+def tag(name):
+    """The posts of a hashtag (see app/tags.py)."""
+    tag = normalize_tag(name)
+    if tag is None:
+        abort(404)
+
+    # Paginated with the position of the last post shown
+    before = updates.parse_since(request.args.get('before'))
+    posts, last = tagged_posts(tag, before,
+                               current_app.config['POSTS_PER_PAGE'])
+    next_url = url_for('main.tag', name=tag,
+                       before=updates.format_since(last)) if last else None
+    prev_url = url_for('main.tag', name=tag) if before else None
+    return render_page('feed.html', title='#' + tag, posts=posts,
+                       next_url=next_url, prev_url=prev_url)
+
+
+@bp.route('/mentions')
+@login_required
+@read_replica
+def mentions():
+    """The posts mentioning the current user (see app/tags.py)."""
+    before = updates.parse_since(request.args.get('before'))
+    posts, last = mentioning_posts(current_user, before,
+                                   current_app.config['POSTS_PER_PAGE'])
+    next_url = url_for('main.mentions',
+                       before=updates.format_since(last)) if last else None
+    prev_url = url_for('main.mentions') if before else None
+    return render_page('feed.html', title=_('Mentions'), posts=posts,
+                       next_url=next_url, prev_url=prev_url)
 
 
 @bp.route('/edit_profile', methods=['GET', 'POST'])
@@ -146,7 +269,15 @@ def edit_profile():
     if form.validate_on_submit():
         current_user.username = form.username.data
         current_user.about_me = form.about_me.data
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Taken meanwhile (see app/availability.py)
+            db.session.rollback()
+            form.username.errors.append(
+                _('Please use a different username.'))
+            return render_template('edit_profile.html',
+                                   title=_('Edit Profile'), form=form)
         flash(_('Your changes have been saved.'))
         return redirect(url_for('main.edit_profile'))
     elif request.method == 'GET':
@@ -168,6 +299,7 @@ def follow(username):
         return redirect(url_for('main.user', username=username))
     current_user.follow(user)
     db.session.commit()
+    record_follow(user)
     flash(_('You are following %(username)s!', username=username))
     return redirect(url_for('main.user', username=username))
 
@@ -199,6 +331,11 @@ def translate_text():
         request.form['target_language']
     )
 
+    # Count the translation for the trending posts
+    # (see app/trending.py)
+    record_translation(current_user,
+                       request.form.get('post_id', type=int))
+
     # Jsonify
     json = jsonify({'text': translation})
 
@@ -207,6 +344,7 @@ def translate_text():
 
 @bp.route('/search')
 @login_required
+@read_replica
 def search():
 
     # When submitted an empty search form has been submitted, 
@@ -218,9 +356,16 @@ def search():
     page = request.args.get('page', 1, type=int)
 
     # Search
-    posts, total = Post.search(g.search_form.q.data, page,
-                               current_app.config['POSTS_PER_PAGE'])
+    # (in the hot and the archived posts - see app/archive.py)
+    posts, total = search_posts(g.search_form.q.data, page,
+                                current_app.config['POSTS_PER_PAGE'])
+    return render_search(posts, total, page)
+
 
+def render_search(posts, total, page):
+    """The page of search results (shared with the asynchronous search
+    of app/aio.py).
+    """
     # Generate next and previous page links
     next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1) \
         if total > page * current_app.config['POSTS_PER_PAGE'] else None
@@ -228,8 +373,9 @@ def search():
         if page > 1 else None
 
     # Render page
-    return render_template('search.html', title=_('Search'), posts=posts,
-                           next_url=next_url, prev_url=prev_url)
+    return render_page('search.html', title=_('Search'),
+                       posts=posts,
+                       next_url=next_url, prev_url=prev_url)
 
 
 ## fin.
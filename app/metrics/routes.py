@@ -0,0 +1,37 @@
+from flask import jsonify, abort, current_app, render_template, request
+from app.metrics import bp
+
+
+@bp.route('/metrics')
+def metrics():
+    """Metrics of the current worker process as JSON.
+
+    The metrics are collected by the providers registered in
+    app.metrics.  This endpoint is only available when METRICS_ENABLED
+    is set and should only be reachable from the internal network.
+
+    """
+    if not current_app.config['METRICS_ENABLED']:
+        abort(404)
+
+    return jsonify({name: provider()
+                    for name, provider in current_app.metrics.items()})
+
+
+@bp.route('/metrics/tasks')
+def tasks():
+    """Throughput and latencies of the task queue (see app/tasks.py).
+
+    Like /metrics, only available when METRICS_ENABLED is set.
+
+    """
+    if not current_app.config['METRICS_ENABLED']:
+        abort(404)
+
+    from app.tasks import queue_stats
+    window = request.args.get('window', 3600, type=int)
+    return render_template('metrics/tasks.html', title='Tasks',
+                           stats=queue_stats(window))
+
+
+## fin.
@@ -3,12 +3,15 @@
 from datetime import datetime
 from hashlib import md5
 from time import time
-from flask import current_app
+from flask import current_app, url_for
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
 import jwt
 from app import db, login
-from app.search import add_to_index, remove_from_index, query_index
+from app.graph import follow_graph
+from app.passwords import password_hasher
+from app.search import add_to_index, remove_from_index, query_index, \
+    bulk_index
+from app.tasks import task, enqueue, queue_enabled
 
 ## =========================================================
 ## mixin class SearchableMixin 
@@ -139,26 +142,78 @@ class SearchableMixin(object):
         # are therefore not available anymore.
         # Retrieve the content stored before the commit has takes place
         # to update the search database:
-        for obj in session._changes['add']:
+        changes, session._changes = session._changes, None
+
+        # With the task queue the index has been updated by the
+        # tasks committed together with the changes (see below)
+        if queue_enabled(session.app):
+            return
+
+        for obj in changes['add']:
             if isinstance(obj, SearchableMixin):
                 add_to_index(obj.__tablename__, obj)
 
-        for obj in session._changes['update']:
+        for obj in changes['update']:
             if isinstance(obj, SearchableMixin):
                 add_to_index(obj.__tablename__, obj)
 
-        for obj in session._changes['delete']:
+        for obj in changes['delete']:
             if isinstance(obj, SearchableMixin):
                 remove_from_index(obj.__tablename__, obj)
 
-        session._changes = None
+    ## -----------------------------------------------------
+    ## Updating the index with the task queue (see app/tasks.py)
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        """Remember the entries which have been written.
+
+        This is intended to be used as event handler and has to be
+        bound to the 'after_flush' event of the database.
+
+        """
+        # NOTE:
+        # The ids of the new entries have been assigned by the flush -
+        # session.new, session.dirty and session.deleted still
+        # contain the flushed entries.
+        if not queue_enabled(session.app) or \
+           not session.app.elasticsearch:
+            return
+        entries = session.info.setdefault('index_entries', set())
+        for obj in list(session.new) + list(session.dirty) + \
+                list(session.deleted):
+            if isinstance(obj, SearchableMixin):
+                entries.add((obj.__tablename__, obj.id))
+
+    @classmethod
+    def after_flush_postexec(cls, session, flush_context):
+        """Queue the index updates of the entries written by the flush.
+
+        The tasks are flushed in the same transaction as the entries
+        (the commit flushes until the session is clean).
+
+        This is intended to be used as event handler and has to be
+        bound to the 'after_flush_postexec' event of the database.
+
+        """
+        entries = session.info.pop('index_entries', None)
+        for index, id in sorted(entries or ()):
+            enqueue('sync_index', index=index, id=id)
+
+    @staticmethod
+    def after_rollback(session):
+        session.info.pop('index_entries', None)
 
     @classmethod
     def reindex(cls):
         """Update the search index with all data from the databank.
+
+        The entries are loaded in chunks and sent in bulk requests.
+        Returns the number of entries indexed.
+
         """
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+        return bulk_index(cls.__tablename__,
+                          cls.query.order_by(cls.id).yield_per(1000))
 
 # Bind updates to the Elasticsearch index to SQLAlchemy events
 # Events        - https://docs.sqlalchemy.org/en/latest/core/event.html
@@ -166,33 +221,108 @@ class SearchableMixin(object):
 # - ORM Events  - https://docs.sqlalchemy.org/en/latest/orm/events.html
 db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
 db.event.listen(db.session, 'after_commit',  SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_flush',   SearchableMixin.after_flush)
+db.event.listen(db.session, 'after_flush_postexec',
+                SearchableMixin.after_flush_postexec)
+db.event.listen(db.session, 'after_rollback', SearchableMixin.after_rollback)
+
+
+@task('sync_index')
+def sync_index(index, id):
+    """Update the entry 'id' of a search index from the database - or
+    remove it when it has been deleted.
+    """
+    model = next(cls for cls in SearchableMixin.__subclasses__()
+                 if cls.__tablename__ == index)
+    obj = model.query.get(id)
+
+    # Posts stored in the shards (see app/shards.py)
+    if obj is None and model is Post:
+        from app.shards import sharding_enabled, rows_by_id
+        if sharding_enabled():
+            row = rows_by_id([id]).get(id)
+            if row is not None:
+                obj = Post(id=row[0], body=row[1], timestamp=row[2],
+                           language=row[3], user_id=row[4])
+
+    if obj is not None:
+        add_to_index(index, obj)
+
+    # Archived posts stay in the index (see app/archive.py)
+    elif current_app.elasticsearch and not (
+            model is Post and ArchivedPost.query.get(id) is not None):
+        current_app.elasticsearch.delete(index=index, id=id, ignore=404)
 
 ## =========================================================
 
+def email_hash(email):
+    """The md5 hash of an email address as used by Gravatar."""
+    if email is None:
+        return None
+    return md5(email.lower().encode('utf-8')).hexdigest()
+
+
+def avatar_url(digest, size):
+    """The url of the avatar with the email hash 'digest'.
+
+    The size is rounded up to one of the sizes in AVATAR_SIZES.  Users
+    without email hash get the avatar of the empty email.
+
+    """
+    sizes = current_app.config['AVATAR_SIZES']
+    size = next((s for s in sizes if s >= size), sizes[-1])
+    return url_for('avatars.avatar', digest=digest or email_hash(''),
+                   size=size)
+
 # Auxiliary table 'followers'
 # to define the many-to-many relationship between 
 # following users 'followers' and followed users 'followed'
 # Since this auxiliary table has no data other than the foreign keys, 
 # it is created without an associated model class.
 # The table has to be defined befor its usage in class User.
+#
+# Both directions are indexed:
+# - (follower_id, followed_id) for the users followed by a user and
+# - (followed_id, follower_id) for the followers of a user.
 followers = db.Table(
     'followers',
     db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id')),
+    db.Index('ix_followers_follower_id_followed_id',
+             'follower_id', 'followed_id'),
+    db.Index('ix_followers_followed_id_follower_id',
+             'followed_id', 'follower_id')
 )
 
 
 class User(UserMixin, db.Model):
     """
     Uses the UserMixin which implements flask_login's login procedure.
+
+    The fields listed in __profile__ are shown with the user's posts.
+    profile_updated is set every time one of them changes - it is
+    used as version of the profile by the caches
+    (see app/fragments.py).
+
+    follows_updated is set every time the user follows or unfollows
+    someone or someone follows or unfollows her.
+
+    suggestions_updated is the time her "who to follow" suggestions
+    have been computed (see app/suggestions.py).
     """
+    __profile__ = ['username', 'email', 'about_me']
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
+    email_hash = db.Column(db.String(32), index=True)
     password_hash = db.Column(db.String(128))
     posts = db.relationship('Post', backref='author', lazy='dynamic')
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
+    profile_updated = db.Column(db.DateTime, index=True,
+                                default=datetime.utcnow)
+    follows_updated = db.Column(db.DateTime, default=datetime.utcnow)
+    suggestions_updated = db.Column(db.DateTime)
     followed = db.relationship(
         'User', 
         secondary=followers,
@@ -206,40 +336,128 @@ class User(UserMixin, db.Model):
         return '<User {}>'.format(self.username)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher().hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        """Check the password of the user.
 
-    def avatar(self, size):
-        """Get the avator for the user registered at 'Gravatar'
-        (http://en.gravatar.com/).  A random 'identicon' avatar is
-        generated for users that do not have an avatar registered with
-        the service.
+        A correct password is hashed again when its hash has been
+        created with outdated parameters (see app/passwords.py) - the
+        caller has to commit the session.
 
         """
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(
-            digest, size)
+        hasher = password_hasher()
+        if not hasher.verify(self.password_hash, password):
+            return False
+        if hasher.needs_rehash(self.password_hash):
+            self.set_password(password)
+            hasher.rehashes += 1
+        return True
+
+    @db.validates('email')
+    def set_email_hash(self, key, email):
+        """Keep the hash of the email used by the avatars up to date."""
+        self.email_hash = email_hash(email)
+        return email
+
+    def avatar(self, size):
+        """Get the url of the avatar of the user (see app/avatars)."""
+        return avatar_url(self.email_hash or email_hash(self.email), size)
 
     def follow(self, user):
-        if not self.is_following(user):
+        if not self._is_following(user):
             self.followed.append(user)
+            self.follows_updated = user.follows_updated = datetime.utcnow()
 
     def unfollow(self, user):
-        if self.is_following(user):
+        if self._is_following(user):
             self.followed.remove(user)
+            self.follows_updated = user.follows_updated = datetime.utcnow()
+
+    # The follow queries are answered by the in-process follow graph
+    # when it is enabled (see app/graph.py) - and by the followers
+    # table otherwise.
 
     def is_following(self, user):
+        graph = follow_graph()
+        if graph is not None:
+            return graph.is_following(self, user)
+        return self._is_following(user)
+
+    def _is_following(self, user):
+        # follow() and unfollow() always check the database
         return self.followed.filter(
             followers.c.followed_id == user.id).count() > 0
 
+    def followed_count(self):
+        graph = follow_graph()
+        if graph is not None:
+            return graph.followed_count(self)
+        return self.followed.count()
+
+    def followers_count(self):
+        graph = follow_graph()
+        if graph is not None:
+            return graph.followers_count(self)
+        return self.followers.count()
+
+    def followed_ids(self):
+        graph = follow_graph()
+        if graph is not None:
+            return graph.followed_ids(self)
+        return [id for id, in db.session.execute(
+            db.select([followers.c.followed_id]).where(
+                followers.c.follower_id == self.id))]
+
     def followed_posts(self):
-        followed = Post.query.join(
-            followers, (followers.c.followed_id == Post.user_id)).filter(
-                followers.c.follower_id == self.id)
-        own = Post.query.filter_by(user_id=self.id)
-        return followed.union(own).order_by(Post.timestamp.desc())
+        """The posts of the followed users and the user's own posts,
+        newest first.
+
+        The posts are selected in a single pass:
+
+          SELECT post.* FROM post
+          WHERE post.user_id IN (SELECT followed_id FROM followers
+                                 WHERE follower_id = :id
+                                 UNION ALL SELECT :id)
+          ORDER BY post.timestamp DESC, post.id DESC
+
+        With the index on (user_id, timestamp, id) of the post table
+        the database can read the newest posts of each author from the
+        index instead of sorting all their posts to return a page.
+
+        """
+        return Post.query.filter(
+            Post.user_id.in_(self.followed_authors())).order_by(
+                Post.timestamp.desc(), Post.id.desc())
+
+    def followed_authors(self):
+        """A select of the ids of the followed users and the user's
+        own id - the authors of the posts in her timeline.
+
+        With the follow graph, the ids of users following less than
+        FOLLOW_GRAPH_INLINE_IDS users are returned as list instead.
+
+        """
+        graph = follow_graph()
+        if graph is not None:
+            ids = graph.followed_ids(self)
+            if len(ids) < current_app.config['FOLLOW_GRAPH_INLINE_IDS']:
+                return ids + [self.id]
+
+        return db.select([followers.c.followed_id]).where(
+            followers.c.follower_id == self.id).union_all(
+                db.select([db.literal(self.id)]))
+
+    def suggested_users(self, limit):
+        """The users suggested to be followed by the user, best first
+        - without the users she has followed since the suggestions
+        have been computed.
+        """
+        return User.query.join(
+            Suggestion, Suggestion.suggested_id == User.id).filter(
+                Suggestion.user_id == self.id,
+                ~User.id.in_(self.followed_authors())).order_by(
+                    Suggestion.score.desc(), User.id).limit(limit).all()
 
     def get_reset_password_token(self, expires_in=600):
 
@@ -280,6 +498,22 @@ class User(UserMixin, db.Model):
 
         return User.query.get(id)
 
+    @staticmethod
+    def before_update(mapper, connection, user):
+        """Update the profile version when the profile has changed.
+
+        This is intended to be used as event handler and has to be
+        bound to the 'before_update' event of the User model.
+
+        """
+        state = db.inspect(user)
+        for field in user.__profile__:
+            if state.attrs[field].history.has_changes():
+                user.profile_updated = datetime.utcnow()
+                break
+
+db.event.listen(User, 'before_update', User.before_update)
+
 
 @login.user_loader
 def load_user(id):
@@ -291,6 +525,11 @@ def load_user(id):
 
 class Post(SearchableMixin, db.Model):
     __searchable__ = ['body']
+    # The posts of an author ordered by time
+    # (used by the feeds - see User.followed_posts())
+    __table_args__ = (
+        db.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
@@ -300,4 +539,147 @@ class Post(SearchableMixin, db.Model):
     def __repr__(self):
         return '<Post {}>'.format(self.body)
 
+
+# The hashtags and the mentions of the posts (see app/tags.py)
+#
+# The timestamp of the post is copied into both tables, so that the
+# posts of a tag and the posts mentioning a user are found from the
+# indexes (tag, timestamp, post_id) and (user_id, timestamp, post_id)
+# alone.  There is no foreign key to the posts - the tags of the
+# archived posts are kept (see app/archive.py).  The post ids are
+# 64 bit wide - the ids of the posts in the shards do not fit into
+# 32 bits (see shards.new_post_id()).
+post_tags = db.Table(
+    'post_tag',
+    db.Column('tag', db.String(64), primary_key=True),
+    db.Column('post_id', db.BigInteger, primary_key=True,
+              autoincrement=False),
+    db.Column('timestamp', db.DateTime),
+    db.Index('ix_post_tag_tag_timestamp', 'tag', 'timestamp', 'post_id'),
+    db.Index('ix_post_tag_post_id', 'post_id')
+)
+
+post_mentions = db.Table(
+    'post_mention',
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'),
+              primary_key=True, autoincrement=False),
+    db.Column('post_id', db.BigInteger, primary_key=True,
+              autoincrement=False),
+    db.Column('timestamp', db.DateTime),
+    db.Index('ix_post_mention_user_id_timestamp',
+             'user_id', 'timestamp', 'post_id'),
+    db.Index('ix_post_mention_post_id', 'post_id')
+)
+
+
+class ArchivedPost(db.Model):
+    """A post moved out of the post table by 'flask archive posts'
+    (see app/archive.py).
+
+    The table lives in the 'archive' bind - the application database
+    unless ARCHIVE_DATABASE_URL is set - and has no foreign key to the
+    users for this reason.  The posts keep their ids.
+
+    """
+    __bind_key__ = 'archive'
+    __tablename__ = 'post_archive'
+    __table_args__ = (
+        db.Index('ix_post_archive_user_id_timestamp',
+                 'user_id', 'timestamp', 'id'),
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    body = db.Column(db.String(140))
+    timestamp = db.Column(db.DateTime, index=True)
+    user_id = db.Column(db.Integer)
+    language = db.Column(db.String(5))
+
+    def __repr__(self):
+        return '<ArchivedPost {}>'.format(self.body)
+
+
+class Suggestion(db.Model):
+    """A user suggested to be followed by another user.
+
+    The score is the number of users followed by the user who follow
+    the suggested user.  The suggestions are computed by the batch job
+    'flask graph suggest' (see app/suggestions.py).
+    """
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'),
+                        primary_key=True)
+    suggested_id = db.Column(db.Integer, db.ForeignKey('user.id'),
+                             primary_key=True)
+    score = db.Column(db.Integer)
+
+    def __repr__(self):
+        return '<Suggestion {} -> {}>'.format(self.user_id, self.suggested_id)
+
+
+class Task(db.Model):
+    """A job of the task queue (see app/tasks.py).
+
+    state is 'queued' (waiting until run_at), 'running' (claimed by
+    the worker batch 'claim' until claimed_until), 'done' or
+    'failed' (after TASK_MAX_ATTEMPTS attempts).
+    """
+    # The tasks due to be run
+    __table_args__ = (
+        db.Index('ix_task_state_run_at', 'state', 'run_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64))
+    payload = db.Column(db.Text)
+    state = db.Column(db.String(16), default='queued')
+    attempts = db.Column(db.Integer, default=0)
+    run_at = db.Column(db.DateTime, default=datetime.utcnow)
+    claim = db.Column(db.String(32), index=True)
+    claimed_until = db.Column(db.DateTime)
+    created = db.Column(db.DateTime, default=datetime.utcnow)
+    started = db.Column(db.DateTime)
+    finished = db.Column(db.DateTime)
+    error = db.Column(db.Text)
+
+    def __repr__(self):
+        return '<Task {} {}>'.format(self.name, self.state)
+
+
+class BackfillProgress(db.Model):
+    """The progress of a backfill (see app/backfills.py): the rows up
+    to the primary key 'position' have been updated.  The backfill is
+    run by the runner 'claim' until claimed_until.
+    """
+    __tablename__ = 'backfill_progress'
+    name = db.Column(db.String(64), primary_key=True)
+    position = db.Column(db.BigInteger, default=0)
+    rows = db.Column(db.Integer, default=0)
+    claim = db.Column(db.String(32))
+    claimed_until = db.Column(db.DateTime)
+    started = db.Column(db.DateTime)
+    finished = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return '<BackfillProgress {} {}>'.format(self.name, self.position)
+
+
+class TrendingScore(db.Model):
+    """The decayed count of the activity of a post or a tag
+    (see app/trending.py): 'score' is relative to the landmark of the
+    era 'era'.
+
+    (The score is listed before the era - the assignments of an
+    UPDATE setting both refer to the old era on every database.)
+    """
+    __tablename__ = 'trending_score'
+    # The highest scores of an era
+    __table_args__ = (
+        db.Index('ix_trending_score_kind_era_score', 'kind', 'era', 'score'),
+    )
+    kind = db.Column(db.String(8), primary_key=True)
+    key = db.Column(db.String(64), primary_key=True)
+    score = db.Column(db.Float)
+    era = db.Column(db.Integer)
+
+    def __repr__(self):
+        return '<TrendingScore {} {} {}>'.format(self.kind, self.key,
+                                                 self.score)
+
 ## fin.
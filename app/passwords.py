@@ -0,0 +1,196 @@
+## =========================================================
+## app/passwords.py
+## ---------------------------------------------------------
+##
+## Password hashing.
+##
+## The hash method and its cost are configured with
+## PASSWORD_HASH_METHOD (a werkzeug method like
+## 'pbkdf2:sha256:150000' - the last part is the number of
+## iterations) and PASSWORD_SALT_LENGTH.  The parameters are stored
+## with each hash:
+##
+##   pbkdf2:sha256:150000$<salt>$<hash>
+##
+## When a user logs in with a password whose hash has been created
+## with other parameters, the password is hashed again with the
+## current ones (see User.check_password()) - the cost can be raised
+## without asking the users to reset their passwords.
+##
+## Offloading:
+##
+##   Hashing a password takes tens of milliseconds of CPU time on
+##   purpose.  With PASSWORD_HASH_PROCESSES set, the hashes are
+##   computed in a pool of that many processes per worker instead of
+##   in the worker itself, and a burst of logins cannot hold the GIL
+##   of the worker while it renders pages.
+##
+##   At most PASSWORD_HASH_CONCURRENCY hashes are computed per worker
+##   at the same time (with or without pool).  Requests waiting
+##   longer than PASSWORD_HASH_TIMEOUT seconds for their turn are
+##   answered with '503 Service Unavailable'.
+##
+##   Both the pool and the limit belong to each worker: a host with
+##   N workers computes up to N * PASSWORD_HASH_CONCURRENCY hashes in
+##   up to N * PASSWORD_HASH_PROCESSES processes.
+##
+##   Offloading requires a worker serving several requests at a time
+##   (gevent or threads) - a 'sync' worker waits for the hash anyway
+##   and serves nothing else meanwhile.  gunicorn.conf.py refuses to
+##   start sync workers with PASSWORD_HASH_PROCESSES set (see
+##   check_concurrency()).
+##
+##   In a gevent worker, waiting for the result of the pool only
+##   blocks the greenlet of the request: the thread of the pool
+##   reading the results, its pipes and the condition the result is
+##   waited for are all patched by gevent.  This holds for the locks
+##   of the hasher only when they are created after the patching -
+##   the hasher is created in the worker on first use (see
+##   password_hasher()), not while gunicorn preloads the application.
+##
+## ---------------------------------------------------------
+
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from flask import current_app
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import generate_password_hash, check_password_hash, \
+    DEFAULT_PBKDF2_ITERATIONS
+
+
+def normalize_method(method):
+    """The method as stored in the hashes - with the number of
+    iterations of pbkdf2.
+    """
+    if method.startswith('pbkdf2:') and method.count(':') == 1:
+        return '{}:{}'.format(method, DEFAULT_PBKDF2_ITERATIONS)
+    return method
+
+
+def hash_parameters(pwhash):
+    """The method and the salt length of a hash."""
+    if not pwhash or pwhash.count('$') < 2:
+        return None, None
+    method, salt, _ = pwhash.split('$', 2)
+    return method, len(salt)
+
+
+class PasswordHasher(object):
+    """Hash and verify passwords - in a process pool when 'processes'
+    is not 0.
+    """
+
+    def __init__(self, method, salt_length, processes, concurrency,
+                 timeout):
+        self.method = normalize_method(method)
+        self.salt_length = salt_length
+        self.processes = processes
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._pool = None
+        self._pool_pid = None
+        self._lock = threading.Lock()
+        self.hashes = 0
+        self.verifications = 0
+        self.rehashes = 0
+        self.rejected = 0
+
+    def pool(self):
+        """The process pool of the current process.
+
+        The pool is created on first use - in the worker, after it has
+        been forked by gunicorn.  Its processes are spawned as fresh
+        interpreters which do not inherit the state of the worker.
+
+        """
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ProcessPoolExecutor(
+                    self.processes, mp_context=get_context('spawn'))
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def _run(self, function, *args):
+        if not self._slots.acquire(timeout=self.timeout):
+            self.rejected += 1
+            raise ServiceUnavailable(
+                'Too many logins at the same time.',
+                retry_after=max(1, int(self.timeout)))
+        try:
+            if not self.processes:
+                return function(*args)
+            return self.pool().submit(function, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        """Hash a password with the current parameters."""
+        self.hashes += 1
+        return self._run(generate_password_hash, password,
+                         self.method, self.salt_length)
+
+    def verify(self, pwhash, password):
+        self.verifications += 1
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """Has the hash been created with other parameters than the
+        current ones?
+        """
+        return hash_parameters(pwhash) != (self.method, self.salt_length)
+
+    def stats(self):
+        return {
+            'method':        self.method,
+            'processes':     self.processes,
+            'hashes':        self.hashes,
+            'verifications': self.verifications,
+            'rehashes':      self.rehashes,
+            'rejected':      self.rejected,
+        }
+
+
+def password_hasher(app=None):
+    """The password hasher of the application (by default the current
+    one).
+
+    The hasher is created on first use - in the worker, after a
+    gevent worker has patched the threading module.  gunicorn loads
+    the application before ('preload_app'), and a semaphore created
+    then would block the whole worker.
+
+    """
+    app = app or current_app
+    hasher = app.extensions.get('password_hasher')
+    if hasher is not None:
+        return hasher
+
+    config = app.config
+    return app.extensions.setdefault('password_hasher', PasswordHasher(
+        config['PASSWORD_HASH_METHOD'],
+        config['PASSWORD_SALT_LENGTH'],
+        config['PASSWORD_HASH_PROCESSES'],
+        config['PASSWORD_HASH_CONCURRENCY'],
+        config['PASSWORD_HASH_TIMEOUT']))
+
+
+def check_concurrency(app, concurrent):
+    """Refuse to offload the hashing when the workers serve one
+    request at a time ('concurrent' is False).
+    """
+    if not concurrent and app.config['PASSWORD_HASH_PROCESSES']:
+        raise RuntimeError('PASSWORD_HASH_PROCESSES requires a worker '
+                           'class serving concurrent requests (gevent, '
+                           'gthread) - not sync workers.')
+
+
+def init_app(app):
+    """Register the statistics of the password hasher as metrics
+    provider.
+    """
+    app.metrics['passwords'] = lambda: password_hasher(app).stats()
+
+
+## fin.
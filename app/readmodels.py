@@ -0,0 +1,107 @@
+## =========================================================
+## app/readmodels.py
+## ---------------------------------------------------------
+##
+## Read models of the post lists.
+##
+## The feeds, the user pages and the search results only show a few
+## columns of each post and of its author.  Loading them as ORM
+## objects reads every column - including the password hash, the
+## email and the about me of the authors - builds an object with its
+## instance state for each row and adds it to the identity map of
+## the session.
+##
+## The list views query the columns they show instead:
+##
+##   SELECT post.id, post.body, post.timestamp, post.language,
+##          user.id, user.username, user.email_hash,
+##          user.profile_updated
+##   FROM post JOIN user ON user.id = post.user_id
+##   ...
+##
+## and get each row as a PostView - a named tuple without instance
+## dict - with the author as AuthorView.  They provide the attributes
+## used by _post.html and by the fragment cache (app/fragments.py),
+## so the templates work with both.
+##
+## Usage:
+##
+##   posts = post_views(current_user.followed_posts()).paginate(...)
+##
+## The read models are not attached to the session: they cannot be
+## changed and do not load anything lazily.
+##
+## See benchmarks/read_models.py for a comparison of the memory
+## allocated by both paths.
+##
+## ---------------------------------------------------------
+
+from collections import namedtuple
+from app import db
+from app.models import User, Post, avatar_url
+
+
+class AuthorView(namedtuple('AuthorView', [
+        'id', 'username', 'email_hash', 'profile_updated'])):
+    """The author of a post as shown with the post."""
+    __slots__ = ()
+
+    def avatar(self, size):
+        return avatar_url(self.email_hash, size)
+
+
+class PostView(namedtuple('PostView', [
+        'id', 'body', 'timestamp', 'language', 'author'])):
+    """A post as shown in the post lists."""
+    __slots__ = ()
+
+
+class PostBundle(db.Bundle):
+    """The columns of a PostView - returned as PostView by queries."""
+
+    # Rows of queries with the bundle as only entity are PostViews
+    # instead of 1-tuples
+    single_entity = True
+
+    def __init__(self):
+        super(PostBundle, self).__init__(
+            'post_view',
+            Post.id, Post.body, Post.timestamp, Post.language,
+            User.id, User.username, User.email_hash, User.profile_updated)
+
+    def create_row_processor(self, query, procs, labels):
+        def proc(row):
+            (id, body, timestamp, language,
+             author_id, username, digest, profile_updated) = \
+                [proc(row) for proc in procs]
+            return PostView(id, body, timestamp, language, AuthorView(
+                author_id, username, digest, profile_updated))
+        return proc
+
+
+def post_views(query):
+    """Turn a query of posts into a query of their PostViews.
+
+    The filters, the order and the pagination of the query are kept.
+
+    """
+    return query.join(User, User.id == Post.user_id)\
+                .with_entities(PostBundle())
+
+
+def row_views(rows):
+    """The PostViews of rows (id, body, timestamp, language, user_id)
+    read without the join - from the archive or the shards, which may
+    be other databases than the users.
+    """
+    if not rows:
+        return []
+    authors = {row[0]: AuthorView(*row) for row in db.session.query(
+        User.id, User.username, User.email_hash, User.profile_updated)
+        .filter(User.id.in_({row[4] for row in rows}))}
+    return [PostView(id, body, timestamp, language, authors[user_id])
+            for id, body, timestamp, language, user_id in rows
+            if user_id in authors]
+
+
+## fin.
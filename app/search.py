@@ -17,6 +17,25 @@ def add_to_index(index, model):
     current_app.elasticsearch.index(index=index, id=model.id, body=payload)
 
 
+def bulk_index(index, models, chunk_size=500):
+    """Add many entries to a full-text index with bulk requests of
+    'chunk_size' entries.  Returns the number of entries indexed.
+    """
+
+    # Do nothing when elasticsearch has not been configured
+    if not current_app.elasticsearch:
+        return 0
+
+    from elasticsearch.helpers import bulk
+    actions = ({'_index': index, '_id': model.id,
+                '_source': {field: getattr(model, field)
+                            for field in model.__searchable__}}
+               for model in models)
+    indexed, _ = bulk(current_app.elasticsearch, actions,
+                      chunk_size=chunk_size)
+    return indexed
+
+
 def remove_from_index(index, model):
     """Remove an entry from the index."""
 
@@ -36,25 +55,41 @@ def query_index(index, query, page, per_page):
     if not current_app.elasticsearch:
         return [], 0
 
+    # Search the given index
+    #| print("DEBUG query_index():\n  - index: {}\n  - query: {}" \
+    #|       .format(index, query))
+    search = current_app.elasticsearch.search(
+        index=index, body=search_body(query, page, per_page))
+    #| print("DEBUG search:", search)
+
+    return search_result(search)
+
+
+def search_body(query, page, per_page):
+    """The body of a search query (shared with the asynchronous
+    search of app/aio.py).
+    """
     # Query: searching the entire index:
     # - The 'multi_match' allowes to search across multiple fields. 
     # - By passing '*' as field name all fields are searched.
     # => Combining both, the entire index is searched.
     # Pagination: Returning page 'page' with 'per_page' results.
-    body = {'query': {'multi_match': {'query': query, 'fields': ['*']}},
+    return {'query': {'multi_match': {'query': query, 'fields': ['*']}},
             'from': (page - 1) * per_page, 'size': per_page}
 
-    # Search the given index
-    #| print("DEBUG query_index():\n  - index: {}\n  - body: {}" \
-    #|       .format(index, body))
-    search = current_app.elasticsearch.search(index=index, body=body)
-    #| print("DEBUG search:", search)
+
+def search_result(search):
+    """The ids of the hits and the number of results of a search."""
 
     # Extract ids and number of results.
     # The ids have to be extracted from the list of hits.
     ids = [int(hit['_id']) for hit in search['hits']['hits']]
     number_of_results = search['hits']['total']
 
+    # Elasticsearch 7 returns {'value': <number>, 'relation': 'eq'}
+    if isinstance(number_of_results, dict):
+        number_of_results = number_of_results['value']
+
     return ids, number_of_results
 
 
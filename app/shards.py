@@ -0,0 +1,488 @@
+## =========================================================
+## app/shards.py
+## ---------------------------------------------------------
+##
+## Sharding of the posts by author.
+##
+## When POST_SHARDS lists database URIs, the posts are not stored in
+## the post table of the application database but in the post tables
+## of these databases - the shards, registered as binds 'shard_0',
+## 'shard_1', ...  The posts of user u are stored in shard
+##
+##   u % len(POST_SHARDS)
+##
+## The users, the follows and everything else stay in the application
+## database.  A local setup with several SQLite files:
+##
+##   POST_SHARD_URLS=sqlite:///shard0.db,sqlite:///shard1.db
+##   flask shards init
+##   flask shards rebalance
+##
+## Writes:
+##
+##   All posts - of the web pages and of the API - are written by
+##   write_post().  A new post is inserted into the shard of its author
+##   only.  Its id is generated by the application - the shards cannot
+##   hand out ids unique across all shards: the milliseconds since
+##   ID_EPOCH_MS, shifted left by 22 bits, plus 22 random bits.
+##
+##   The shards are written without the session, so the session hooks
+##   of the post table do not see the post.  write_post() does their
+##   work in the application database itself: it stores the hashtags
+##   and mentions (see app/tags.py), updates the search index (queued
+##   as task 'sync_index' with the task queue), counts the tags for
+##   the trending tags (see app/trending.py) and publishes the post to
+##   the hub of the new posts (see app/updates.py).
+##
+## Reads:
+##
+##   The user pages read the shard of the user.  The timeline and the
+##   explore feed are scatter-gather queries: the shards holding posts
+##   of the followed users (all shards for the explore feed) are
+##   queried in parallel on a thread pool, each returning its newest
+##   offset + per_page posts, and the sorted results are merged
+##   (k-way merge on (timestamp, id)).  The authors are read from the
+##   application database (see readmodels.row_views()).
+##
+##   The posts read by id - the hashtags and mentions, the search
+##   results, the trending posts, the explore snapshot - are looked up
+##   in all shards (see archive.posts_by_id()).  The new posts of the
+##   timeline (see app/updates.py) and the feeds of the API (see
+##   app/api/posts.py) are read from the shards as well.
+##
+## Rebalancing:
+##
+##   'flask shards rebalance' moves the posts stored in the wrong place
+##   - the post table of the application database, or a shard not
+##   matching their author after shards have been added - to their
+##   shard, in batches copied before they are deleted.  The tags and
+##   mentions of each batch are stored again (see app/tags.py).
+##
+## Not sharded yet:
+##
+##   The archive of the old posts cannot be combined with the shards.
+##   The pages are not answered with '304 Not Modified' (see
+##   app/conditional.py) - their versions are computed from the post
+##   table.
+##
+## ---------------------------------------------------------
+
+import heapq
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import islice
+from threading import Lock
+from time import time
+from flask import current_app
+from flask_sqlalchemy import Pagination
+from app import db
+from app.database import shard_binds
+from app.models import Post
+from app.readmodels import row_views
+
+# Start of the timestamps of the post ids (2020-01-01)
+ID_EPOCH_MS = 1577836800000
+
+# The post table of the shards
+# (without foreign key - the users are not in the shards)
+shard_metadata = db.MetaData()
+shard_post = db.Table(
+    'post', shard_metadata,
+    db.Column('id', db.BigInteger, primary_key=True, autoincrement=False),
+    db.Column('body', db.String(140)),
+    db.Column('timestamp', db.DateTime, index=True),
+    db.Column('user_id', db.Integer),
+    db.Column('language', db.String(5)),
+    db.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp', 'id'),
+)
+
+# The columns of the rows passed to readmodels.row_views()
+VIEW_COLUMNS = [shard_post.c.id, shard_post.c.body, shard_post.c.timestamp,
+                shard_post.c.language, shard_post.c.user_id]
+
+
+def sharding_enabled(app=None):
+    app = app or current_app
+    return bool(app.config['POST_SHARDS'])
+
+
+def shard_count():
+    return len(current_app.config['POST_SHARDS'])
+
+
+def shard_of(user_id, count=None):
+    """The number of the shard storing the posts of a user."""
+    return user_id % (count or shard_count())
+
+
+def shard_engine(shard):
+    return db.get_engine(current_app, bind=shard_binds(current_app)[shard])
+
+
+def new_post_id():
+    """A new post id, unique across the shards and growing with time."""
+    return (int(time() * 1000) - ID_EPOCH_MS) << 22 | \
+        random.getrandbits(22)
+
+
+## =========================================================
+## Writes
+## ---------------------------------------------------------
+
+def add_post(user, body, language=None):
+    """Store a new post of a user in her shard.
+
+    Returns the post - not attached to the session.
+
+    """
+    post = Post(id=new_post_id(), body=body, timestamp=datetime.utcnow(),
+                user_id=user.id, language=language)
+    with shard_engine(shard_of(user.id)).begin() as connection:
+        connection.execute(shard_post.insert().values(
+            id=post.id, body=post.body, timestamp=post.timestamp,
+            user_id=post.user_id, language=post.language))
+    return post
+
+
+def announce_post(post):
+    """Do for a post stored in a shard what the session hooks do for
+    the posts of the post table.
+    """
+    from app import tags, trending
+    from app.search import add_to_index
+    from app.tasks import enqueue, queue_enabled
+
+    # Hashtags and mentions, and the index update with the task queue
+    # - committed together
+    tags.index_posts(db.session, [(post.id, post.body, post.timestamp)],
+                     replace=False)
+    queued = queue_enabled() and current_app.elasticsearch
+    if queued:
+        enqueue('sync_index', index=Post.__tablename__, id=post.id)
+    db.session.commit()
+    if not queued:
+        add_to_index(Post.__tablename__, post)
+
+    for tag in tags.extract_tags(post.body):
+        trending.record('tag', tag)
+
+    # Nobody is subscribed to a worker without hub
+    hub = current_app.extensions.get('post_hub')
+    if hub is not None:
+        hub.publish([(post.id, post.user_id)])
+
+
+def write_post(user, body, language=None):
+    """Write a new post of a user - to her shard when the posts are
+    sharded.  Returns the id of the post.
+    """
+    if not sharding_enabled():
+        post = Post(body=body, author=user, language=language)
+        db.session.add(post)
+        db.session.commit()
+        return post.id
+
+    post = add_post(user, body, language)
+    announce_post(post)
+    return post.id
+
+
+## =========================================================
+## Scatter-gather reads
+## ---------------------------------------------------------
+
+class ShardPool(object):
+    """The threads querying the shards in parallel.
+
+    The pool is created on first use in each process (after the
+    workers have been forked).
+
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._executor = None
+        self._pid = None
+        self._lock = Lock()
+        self.queries = 0
+
+    def executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    self.size, thread_name_prefix='shard')
+                self._pid = os.getpid()
+            return self._executor
+
+    def map(self, function, jobs):
+        """Call function(*job) for each job - in parallel when there
+        is more than one.
+        """
+        self.queries += len(jobs)
+        if len(jobs) == 1:
+            return [function(*jobs[0])]
+        return list(self.executor().map(lambda job: function(*job), jobs))
+
+    def stats(self):
+        return {'shards': self.size, 'queries': self.queries}
+
+
+def shard_jobs(user_ids):
+    """The engines of the shards holding the posts of the users (all
+    shards when 'user_ids' is None) with the users of each shard.
+    """
+    count = shard_count()
+    if user_ids is None:
+        return [(shard_engine(shard), None) for shard in range(count)]
+
+    users = {}
+    for user_id in user_ids:
+        users.setdefault(shard_of(user_id, count), []).append(user_id)
+    return [(shard_engine(shard), users[shard]) for shard in sorted(users)]
+
+
+def position_criterion(before=None, after=None):
+    """The posts older than the position 'before' and / or newer than
+    the position 'after' - positions (timestamp, id).
+    """
+    criteria = []
+    if before is not None:
+        timestamp, id = before
+        criteria.append(db.or_(
+            shard_post.c.timestamp < timestamp,
+            db.and_(shard_post.c.timestamp == timestamp,
+                    shard_post.c.id < id)))
+    if after is not None:
+        timestamp, id = after
+        criteria.append(db.or_(
+            shard_post.c.timestamp > timestamp,
+            db.and_(shard_post.c.timestamp == timestamp,
+                    shard_post.c.id > id)))
+    return db.and_(*criteria) if criteria else None
+
+
+def query_shard(engine, user_ids, limit, criterion=None, count=True):
+    """The number of posts of the users in a shard and the newest
+    'limit' of them, as rows (id, body, timestamp, language, user_id).
+
+    Only the posts matching 'criterion' are counted and returned; the
+    number is None without 'count'.
+
+    """
+    users = shard_post.c.user_id.in_(user_ids) \
+        if user_ids is not None else db.true()
+    criterion = db.and_(users, criterion) \
+        if criterion is not None else users
+    with engine.connect() as connection:
+        total = connection.execute(db.select(
+            [db.func.count()]).select_from(shard_post)
+            .where(criterion)).scalar() if count else None
+        rows = connection.execute(db.select(VIEW_COLUMNS).where(criterion)
+                                  .order_by(shard_post.c.timestamp.desc(),
+                                            shard_post.c.id.desc())
+                                  .limit(limit)).fetchall() \
+            if (total or not count) and limit else []
+    return total, rows
+
+
+def query_ids(engine, ids):
+    """The rows of the posts 'ids' stored in a shard."""
+    with engine.connect() as connection:
+        return connection.execute(db.select(VIEW_COLUMNS).where(
+            shard_post.c.id.in_(ids))).fetchall()
+
+
+def merge_newest(results):
+    """Merge the rows of the shards, newest first.
+
+    A post copied by a running rebalance - present in two shards - is
+    returned once.
+
+    """
+    last = None
+    for row in heapq.merge(*results, key=lambda row: (row[2], row[0]),
+                           reverse=True):
+        if row[0] != last:
+            yield row
+        last = row[0]
+
+
+def paginate_sharded(user_ids, page, per_page):
+    """Get a page of the posts of the users 'user_ids' (of all users
+    when None) from the shards, newest first.
+    """
+    page = max(page, 1)
+    start = (page - 1) * per_page
+    jobs = [(engine, users, start + per_page)
+            for engine, users in shard_jobs(user_ids)]
+    results = current_app.shard_pool.map(query_shard, jobs)
+    total = sum(count for count, _ in results)
+    rows = list(islice(merge_newest([rows for _, rows in results]),
+                       start, start + per_page))
+    return Pagination(None, page, per_page, total, row_views(rows))
+
+
+def newest_rows(user_ids, before, limit):
+    """The newest 'limit' posts of the users 'user_ids' (of all users
+    when None) older than the position 'before' (all posts when None),
+    as rows (id, body, timestamp, language, user_id).
+    """
+    jobs = [(engine, users, limit, position_criterion(before=before),
+             False) for engine, users in shard_jobs(user_ids)]
+    results = current_app.shard_pool.map(query_shard, jobs)
+    return list(islice(merge_newest([rows for _, rows in results]), limit))
+
+
+def newer_posts(user_ids, after, limit):
+    """The number of posts of the users newer than the position
+    'after' (all posts when None) and the ids of the newest 'limit' of
+    them (see updates.new_posts()).
+    """
+    jobs = [(engine, users, limit, position_criterion(after=after))
+            for engine, users in shard_jobs(user_ids)]
+    results = current_app.shard_pool.map(query_shard, jobs)
+    rows = islice(merge_newest([rows for _, rows in results]), limit)
+    return sum(count for count, _ in results), [row[0] for row in rows]
+
+
+def rows_by_id(ids):
+    """The rows (id, body, timestamp, language, user_id) of the posts
+    'ids' by id - looked up in all shards.
+    """
+    if not ids:
+        return {}
+    jobs = [(shard_engine(shard), ids) for shard in range(shard_count())]
+    return {row[0]: row for rows in current_app.shard_pool.map(
+        query_ids, jobs) for row in rows}
+
+
+def shard_posts_by_id(ids):
+    """The PostViews of the posts 'ids' stored in the shards."""
+    return {post.id: post for post in row_views(
+        list(rows_by_id(ids).values()))}
+
+
+def post_tables():
+    """The tables the new posts are written to, as (name, engine,
+    table) - the post table or the shards.
+    """
+    if not sharding_enabled():
+        return [('primary', db.get_engine(current_app), Post.__table__)]
+    return [(bind, shard_engine(shard), shard_post)
+            for shard, bind in enumerate(shard_binds(current_app))]
+
+
+## =========================================================
+## Rebalancing
+## ---------------------------------------------------------
+
+def move_rows(rows, read, target, delete):
+    """Copy rows to the shard 'target' - unless they have been copied
+    by an interrupted run - and delete them from where they have been
+    read.
+    """
+    ids = [row['id'] for row in rows]
+    with target.begin() as connection:
+        copied = {id for id, in connection.execute(db.select(
+            [shard_post.c.id]).where(shard_post.c.id.in_(ids)))}
+        rows = [row for row in rows if row['id'] not in copied]
+        if rows:
+            connection.execute(shard_post.insert(), rows)
+    with read.begin() as connection:
+        connection.execute(delete.where(delete.table.c.id.in_(ids)))
+
+
+def store_rows(rows):
+    """Insert rows of posts (dicts) into the shards of their authors -
+    skipping the posts stored already (see transfer.import_data()).
+    """
+    count = shard_count()
+    targets = {}
+    for row in rows:
+        targets.setdefault(shard_of(row['user_id'], count), []).append(row)
+    for target, target_rows in sorted(targets.items()):
+        ids = [row['id'] for row in target_rows]
+        with shard_engine(target).begin() as connection:
+            stored = {id for id, in connection.execute(db.select(
+                [shard_post.c.id]).where(shard_post.c.id.in_(ids)))}
+            target_rows = [row for row in target_rows
+                           if row['id'] not in stored]
+            if target_rows:
+                connection.execute(shard_post.insert(), target_rows)
+
+
+def misplaced_rows(connection, table, count, shard, batch):
+    """A batch of the rows of a post table not belonging to the shard
+    'shard' (to no shard for None) - as dicts.
+    """
+    criterion = table.c.user_id.isnot(None)
+    if shard is not None:
+        criterion = db.and_(criterion, table.c.user_id % count != shard)
+    return [dict(row) for row in connection.execute(
+        db.select([table.c.id, table.c.body, table.c.timestamp,
+                   table.c.user_id, table.c.language])
+        .where(criterion).order_by(table.c.id).limit(batch))]
+
+
+def rebalance(batch, progress=None):
+    """Move the posts of the application database and of the wrong
+    shards to their shards.
+
+    Returns the number of posts moved from each source ('primary',
+    'shard_0', ...).  'progress' is called with the source and the
+    number of posts moved from it so far after each batch.
+
+    """
+    from app import tags
+    count = shard_count()
+    sources = [('primary', db.get_engine(current_app), Post.__table__, None)]
+    sources += [(bind, shard_engine(shard), shard_post, shard)
+                for shard, bind in enumerate(shard_binds(current_app))]
+
+    moved = {}
+    for name, engine, table, shard in sources:
+        moved[name] = 0
+        while True:
+            with engine.connect() as connection:
+                rows = misplaced_rows(connection, table, count, shard, batch)
+            if not rows:
+                break
+            targets = {}
+            for row in rows:
+                targets.setdefault(shard_of(row['user_id'], count),
+                                   []).append(row)
+            for target, target_rows in sorted(targets.items()):
+                move_rows(target_rows, engine, shard_engine(target),
+                          table.delete())
+
+            # The posts written before they were tagged (or before
+            # the tags were introduced)
+            tags.index_posts(db.session, [
+                (row['id'], row['body'], row['timestamp']) for row in rows])
+            db.session.commit()
+            moved[name] += len(rows)
+            if progress is not None:
+                progress(name, moved[name])
+    return moved
+
+
+def create_shards():
+    """Create the post table in each shard."""
+    for shard in range(shard_count()):
+        shard_metadata.create_all(shard_engine(shard))
+
+
+def init_app(app):
+    app.shard_pool = None
+    if not sharding_enabled(app):
+        return
+    if app.config['POST_ARCHIVE_AFTER_DAYS']:
+        raise RuntimeError('The archive of the posts cannot be combined '
+                           'with POST_SHARDS.')
+    app.shard_pool = ShardPool(len(app.config['POST_SHARDS']))
+    app.metrics['shards'] = app.shard_pool.stats
+
+
+## fin.
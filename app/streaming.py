@@ -0,0 +1,170 @@
+## =========================================================
+## app/streaming.py
+## ---------------------------------------------------------
+##
+## Streamed rendering of the pages with long post lists.
+##
+## render_template() renders the whole page before the first byte
+## is sent - the time to first byte grows with the number of posts
+## per page.  The views listed in STREAMING_VIEWS (endpoint names
+## like 'main.index') are streamed instead:
+##
+## - The head and the navigation are sent as soon as the template
+##   reaches {{ stream_flush() }} in base.html - before any post has
+##   been fetched.
+##
+## - The posts are fetched from a server-side cursor in batches of
+##   STREAMING_BATCH rows while the page is rendered, and sent in
+##   chunks of at least STREAMING_CHUNK_SIZE bytes.
+##
+## Usage in a view:
+##
+##   posts = paginate(post_views(query), page, per_page)
+##   return render_page('index.html', posts=posts.items, ...)
+##
+## Both fall back to Query.paginate() and render_template() for the
+## views which are not streamed.
+##
+## NOTE:
+## The status and the headers of a streamed page are sent before it
+## has been rendered - errors raised while streaming cannot be
+## answered with an error page anymore.
+##
+## ---------------------------------------------------------
+
+from itertools import islice
+from flask import current_app, g, has_request_context, render_template, \
+    request, stream_with_context
+from flask_sqlalchemy import Pagination
+
+
+def is_streamed():
+    """Is the page of the current request streamed?"""
+    return has_request_context() and \
+        request.endpoint in current_app.config['STREAMING_VIEWS']
+
+
+## =========================================================
+## Posts from a server-side cursor
+## ---------------------------------------------------------
+
+class ResultStream(object):
+    """The rows of a query, fetched in batches when they are iterated.
+
+    The query is executed when the first row is needed.  The rows can
+    be iterated only once - except for the first one, which can be
+    looked at before with first().
+
+    """
+
+    def __init__(self, query, batch):
+        self.query = query
+        self.batch = batch
+        self._rows = None
+        self._head = None
+
+    def _iter_rows(self):
+        if self._rows is None:
+            # yield_per() asks the driver for a server-side cursor
+            # where the database supports it
+            self._rows = iter(self.query.yield_per(self.batch))
+        return self._rows
+
+    def first(self):
+        """The first row - or None when there are no rows."""
+        if self._head is None:
+            self._head = list(islice(self._iter_rows(), 1))
+        return self._head[0] if self._head else None
+
+    def __iter__(self):
+        head, self._head = self._head or [], []
+        for row in head:
+            yield row
+        for row in self._iter_rows():
+            yield row
+
+
+def first_item(items):
+    """The first item of a page (a list or a ResultStream)."""
+    if isinstance(items, ResultStream):
+        return items.first()
+    return items[0] if items else None
+
+
+def paginate(query, page, per_page, total=None):
+    """Get a page of the query.
+
+    When the page is streamed, the rows of the page are fetched while
+    the page is rendered - only the total number of rows is counted
+    before (unless it is given with 'total').
+
+    """
+    if not is_streamed():
+        if total is None:
+            return query.paginate(page, per_page, False)
+        page = max(page, 1)
+        items = query.limit(per_page).offset((page - 1) * per_page).all()
+        return Pagination(query, page, per_page, total, items)
+
+    page = max(page, 1)
+    if total is None:
+        total = query.order_by(None).count()
+    items = ResultStream(
+        query.limit(per_page).offset((page - 1) * per_page),
+        current_app.config['STREAMING_BATCH'])
+    return Pagination(query, page, per_page, total, items)
+
+
+## =========================================================
+## Streamed templates
+## ---------------------------------------------------------
+
+def stream_flush():
+    """Send what has been rendered so far (in the templates)."""
+    g.stream_flush = True
+    return ''
+
+
+def chunked(events, size):
+    """Join the output of a template to chunks of at least 'size'
+    characters - or less when the template has called
+    stream_flush().
+    """
+    chunk = []
+    length = 0
+    for event in events:
+        chunk.append(event)
+        length += len(event)
+        flush = g.pop('stream_flush', False)
+        if flush or length >= size:
+            yield ''.join(chunk)
+            chunk = []
+            length = 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+def render_page(template_name, **context):
+    """Render a page - streamed when the view is listed in
+    STREAMING_VIEWS (see above).
+    """
+    if not is_streamed():
+        return render_template(template_name, **context)
+
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    template = app.jinja_env.get_or_select_template(template_name)
+    g.pop('stream_flush', None)
+
+    # The request context is kept while the page is rendered
+    return app.response_class(stream_with_context(chunked(
+        template.generate(context), app.config['STREAMING_CHUNK_SIZE'])),
+        mimetype='text/html')
+
+
+def init_app(app):
+    """Make stream_flush() available in the templates."""
+    app.add_template_global(stream_flush)
+
+
+## fin.
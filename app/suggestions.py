@@ -0,0 +1,204 @@
+## =========================================================
+## app/suggestions.py
+## ---------------------------------------------------------
+##
+## "Who to follow" suggestions.
+##
+## The users suggested to a user are the users followed by the users
+## she follows (friends of friends), ranked by the number of users
+## she follows who follow them.
+##
+## With the follow graph as sparse adjacency matrix A
+## (A[u, v] = 1 when u follows v), the number of these paths for all
+## users at once is the matrix product
+##
+##   S = A · A
+##
+## minus the users already followed and the user herself.  The top
+## SUGGESTIONS_PER_USER entries of each row of S are stored in the
+## suggestion table by the batch job
+##
+##   flask graph suggest [--all]
+##
+## Incremental refresh:
+##
+##   The suggestions of a user depend on her follows and on the
+##   follows of the users she follows.  Without --all only the users
+##   whose follows have changed since their suggestions have been
+##   computed (User.follows_updated > User.suggestions_updated) and
+##   their followers are refreshed.
+##
+## numpy and scipy are only needed by the batch job and are
+## imported when it runs.
+##
+## ---------------------------------------------------------
+
+from contextlib import contextmanager
+from datetime import datetime
+from time import perf_counter
+from flask import current_app
+from app import db
+from app.graph import fetch_rows
+from app.models import User, Suggestion, followers
+
+# Number of ids in the IN clauses of the writes
+# (below the default SQLite limit of 999 parameters)
+WRITE_BATCH = 500
+
+
+@contextmanager
+def timed(timings, step):
+    """Add the time spent in the block to timings[step]."""
+    start = perf_counter()
+    yield
+    timings[step] = timings.get(step, 0) + perf_counter() - start
+
+
+## =========================================================
+## Sparse matrix operations
+## ---------------------------------------------------------
+
+def adjacency_matrix(connection):
+    """The follow graph as sparse matrix A in CSR form."""
+    import numpy as np
+    from scipy import sparse
+
+    c = followers.c
+    edges = np.array(list(fetch_rows(
+        connection, db.select([c.follower_id, c.followed_id]).where(
+            db.and_(c.follower_id.isnot(None), c.followed_id.isnot(None))))),
+        dtype=np.int32).reshape(-1, 2)
+
+    size = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+    if len(edges):
+        size = max(size, int(edges.max()) + 1)
+
+    matrix = sparse.csr_matrix(
+        (np.ones(len(edges), dtype=np.int32), (edges[:, 0], edges[:, 1])),
+        shape=(size, size))
+
+    # Count duplicate rows of the followers table once
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+    return matrix
+
+
+def top_suggestions(matrix, users, top):
+    """Compute the top suggestions of the users.
+
+    Returns three arrays: the user, the suggested user and the score
+    of each suggestion.
+
+    """
+    import numpy as np
+
+    followed = matrix[users]
+    paths = followed @ matrix
+
+    # Not the users already followed
+    paths = paths - paths.multiply(followed)
+    paths.eliminate_zeros()
+    paths = paths.tocoo()
+
+    # Not the user herself
+    user = users[paths.row]
+    keep = paths.col != user
+    user, suggested, score = user[keep], paths.col[keep], paths.data[keep]
+
+    # The 'top' best scores of each user
+    # (sorted by user, descending score and suggested user)
+    order = np.lexsort((suggested, -score, user))
+    user, suggested, score = user[order], suggested[order], score[order]
+    starts = np.searchsorted(user, user, side='left')
+    keep = np.arange(len(user)) - starts < top
+
+    return user[keep], suggested[keep], score[keep]
+
+
+## =========================================================
+## Batch job
+## ---------------------------------------------------------
+
+def users_to_refresh(matrix):
+    """The users whose suggestions might have changed: the users who
+    have followed or unfollowed someone or have been followed or
+    unfollowed since their suggestions were computed - and their
+    followers.
+    """
+    import numpy as np
+
+    changed = np.array([id for id, in db.session.query(User.id).filter(
+        db.or_(User.suggestions_updated.is_(None),
+               User.follows_updated > User.suggestions_updated))],
+        dtype=np.int32)
+
+    # Not the users created after the graph has been loaded
+    changed = changed[changed < matrix.shape[0]]
+
+    followed_by = matrix.T.tocsr()[changed]
+    return np.union1d(changed, followed_by.indices).astype(np.int32)
+
+
+def store(users, user, suggested, score, updated):
+    """Replace the suggestions of the users."""
+    table = Suggestion.__table__
+    rows = [{'user_id': u, 'suggested_id': s, 'score': n}
+            for u, s, n in zip(user.tolist(), suggested.tolist(),
+                               score.tolist())]
+
+    users = users.tolist()
+    for i in range(0, len(users), WRITE_BATCH):
+        ids = users[i:i + WRITE_BATCH]
+        db.session.execute(table.delete().where(table.c.user_id.in_(ids)))
+        db.session.execute(User.__table__.update().where(
+            User.id.in_(ids)).values(suggestions_updated=updated))
+    if rows:
+        db.session.execute(table.insert(), rows)
+    db.session.commit()
+
+
+def compute_suggestions(full=False, top=None, chunk_size=10000):
+    """Compute the suggestions of all users (full) or of the users
+    whose neighborhood has changed.
+
+    Returns the statistics of the run: numbers and timings
+    in seconds.
+
+    """
+    import numpy as np
+
+    top = top or current_app.config['SUGGESTIONS_PER_USER']
+    timings = {}
+    started = datetime.utcnow()
+
+    with timed(timings, 'load'):
+        matrix = adjacency_matrix(db.session.connection())
+
+    with timed(timings, 'select'):
+        if full:
+            users = np.array([id for id, in db.session.query(User.id)
+                              .filter(User.id < matrix.shape[0])],
+                             dtype=np.int32)
+        else:
+            users = users_to_refresh(matrix)
+
+    suggestions = 0
+    for i in range(0, len(users), chunk_size):
+        chunk = users[i:i + chunk_size]
+        with timed(timings, 'multiply'):
+            user, suggested, score = top_suggestions(matrix, chunk, top)
+        with timed(timings, 'store'):
+            store(chunk, user, suggested, score, started)
+        suggestions += len(user)
+
+    stats = {
+        'follows':      int(matrix.nnz),
+        'users':        int(len(users)),
+        'suggestions':  int(suggestions),
+    }
+    stats.update(timings)
+    stats['total'] = sum(timings.values())
+    return stats
+
+
+## fin.
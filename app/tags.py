@@ -0,0 +1,207 @@
+## =========================================================
+## app/tags.py
+## ---------------------------------------------------------
+##
+## Hashtags and mentions.
+##
+## The bodies of the posts are parsed when the posts are written:
+##
+##   '#Flask and #python with @susan'
+##
+## stores the tags 'flask' and 'python' (lower case) in the post_tag
+## table and the mention of the user 'susan' in the post_mention
+## table (see models.post_tags and models.post_mentions) - in the
+## transaction writing the post.  Mentions of unknown users are
+## dropped.
+##
+## Reading:
+##
+##   /tag/<name> shows the posts of a tag, /mentions the posts
+##   mentioning the current user, newest first.  Both are paginated
+##   with a cursor - the position (timestamp, id) of the last post
+##   shown (see updates.format_since()):
+##
+##     /tag/flask?before=<position>
+##
+##   so that a page is read from the index of the lookup table
+##   without counting or skipping the newer posts:
+##
+##     SELECT post_id, timestamp FROM post_tag
+##     WHERE tag = :tag
+##       AND (timestamp < :timestamp
+##            OR timestamp = :timestamp AND post_id < :id)
+##     ORDER BY timestamp DESC, post_id DESC
+##     LIMIT :per_page + 1
+##
+##   The posts themselves are read by id - from the post table or the
+##   archive (see archive.posts_by_id()).
+##
+## The posts written before are parsed by the backfill 'post_tags':
+##
+##   flask backfill run post_tags
+##
+## The posts stored in the shards (see app/shards.py) are indexed by
+## shards.write_post() - in the application database as well.
+##
+## ---------------------------------------------------------
+
+import re
+
+# The length of the tags - the length of the tag column
+TAG_LENGTH = 64
+
+# A tag: '#' followed by word characters - not only digits ('#1')
+# and not within a word ('a#b')
+TAG_PATTERN = re.compile(r'(?<![\w#])#(\w*[^\W\d]\w*)')
+
+# A mention: '@' followed by a username - not within a word, which
+# leaves out the email addresses
+MENTION_PATTERN = re.compile(r'(?<![\w@])@(\w+)')
+
+
+def normalize_tag(tag):
+    """The stored form of a tag - None when it is not a valid tag."""
+    match = TAG_PATTERN.fullmatch('#' + (tag or ''))
+    return match.group(1).lower()[:TAG_LENGTH] if match else None
+
+
+def extract_tags(body):
+    """The normalized tags of a post body."""
+    return {normalize_tag(tag) for tag in TAG_PATTERN.findall(body or '')}
+
+
+def extract_mentions(body):
+    """The usernames mentioned in a post body."""
+    return set(MENTION_PATTERN.findall(body or ''))
+
+
+## =========================================================
+## Writing the lookup tables
+## ---------------------------------------------------------
+
+def index_posts(session, posts, replace=True):
+    """Store the tags and mentions of posts given as tuples
+    (id, body, timestamp).
+
+    With 'replace' the rows stored for the posts before are deleted
+    first - which makes it safe to index a post again.
+
+    """
+    from app import db
+    from app.models import User, post_tags, post_mentions
+    if not posts:
+        return
+    ids = [id for id, _, _ in posts]
+    if replace:
+        session.execute(post_tags.delete().where(
+            post_tags.c.post_id.in_(ids)))
+        session.execute(post_mentions.delete().where(
+            post_mentions.c.post_id.in_(ids)))
+
+    tags = []
+    mentions = {}
+    for id, body, timestamp in posts:
+        tags.extend({'tag': tag, 'post_id': id, 'timestamp': timestamp}
+                    for tag in extract_tags(body))
+        for username in extract_mentions(body):
+            mentions.setdefault(username, []).append((id, timestamp))
+    if tags:
+        session.execute(post_tags.insert(), tags)
+
+    if mentions:
+        users = User.__table__
+        rows = [{'user_id': user_id, 'post_id': id, 'timestamp': timestamp}
+                for user_id, username in session.execute(
+                    db.select([users.c.id, users.c.username])
+                    .where(users.c.username.in_(list(mentions))))
+                for id, timestamp in mentions[username]]
+        if rows:
+            session.execute(post_mentions.insert(), rows)
+
+
+def after_flush(session, flush_context):
+    """Index the tags and mentions of the posts written by the flush.
+
+    This is intended to be used as event handler and has to be
+    bound to the 'after_flush' event of the database.
+
+    """
+    # NOTE:
+    # session.new still contains the objects inserted by the flush -
+    # their ids and timestamps have been assigned already.  The
+    # statements run in the transaction of the flush.
+    from app import db
+    from app.models import Post, post_tags, post_mentions
+    new = [(post.id, post.body, post.timestamp) for post in session.new
+           if isinstance(post, Post)]
+    changed = []
+    for post in session.dirty:
+        if isinstance(post, Post):
+            state = db.inspect(post)
+            if state.attrs.body.history.has_changes() or \
+               state.attrs.timestamp.history.has_changes():
+                changed.append((post.id, post.body, post.timestamp))
+    deleted = [post.id for post in session.deleted
+               if isinstance(post, Post)]
+
+    index_posts(session, new, replace=False)
+    index_posts(session, changed)
+    if deleted:
+        session.execute(post_tags.delete().where(
+            post_tags.c.post_id.in_(deleted)))
+        session.execute(post_mentions.delete().where(
+            post_mentions.c.post_id.in_(deleted)))
+
+
+def register_events(db):
+    """Bind the indexing handler to the database events."""
+    db.event.listen(db.session, 'after_flush', after_flush)
+
+
+## =========================================================
+## Reading the feeds
+## ---------------------------------------------------------
+
+def lookup_page(table, column, value, before, limit):
+    """A page of the posts of a lookup table with 'column' = 'value',
+    older than the position 'before' (timestamp, id) - the newest
+    when None.
+
+    Returns the PostViews of the page and the row (id, timestamp) of
+    its last post to continue after - None on the last page.
+
+    """
+    from app import db
+    from app.archive import posts_by_id
+    criterion = table.c[column] == value
+    if before is not None:
+        timestamp, id = before
+        criterion = db.and_(criterion, db.or_(
+            table.c.timestamp < timestamp,
+            db.and_(table.c.timestamp == timestamp, table.c.post_id < id)))
+    rows = db.session.execute(
+        db.select([table.c.post_id.label('id'), table.c.timestamp])
+        .where(criterion)
+        .order_by(table.c.timestamp.desc(), table.c.post_id.desc())
+        .limit(limit + 1)).fetchall()
+
+    more = len(rows) > limit
+    rows = rows[:limit]
+    posts = posts_by_id([id for id, _ in rows])
+    views = [posts[id] for id, _ in rows if id in posts]
+    return views, rows[-1] if more else None
+
+
+def tagged_posts(tag, before, limit):
+    """A page of the posts of a (normalized) tag, newest first."""
+    from app.models import post_tags
+    return lookup_page(post_tags, 'tag', tag, before, limit)
+
+
+def mentioning_posts(user, before, limit):
+    """A page of the posts mentioning a user, newest first."""
+    from app.models import post_mentions
+    return lookup_page(post_mentions, 'user_id', user.id, before, limit)
+
+
+## fin.
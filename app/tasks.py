@@ -0,0 +1,345 @@
+## =========================================================
+## app/tasks.py
+## ---------------------------------------------------------
+##
+## Durable task queue stored in the application database.
+##
+## Slow side work of the requests - sending emails, updating the
+## search index - is written as a task into the 'task' table in the
+## same transaction as the change causing it, and run later by the
+## workers started with
+##
+##   flask worker [--threads 4] [--processes 1] [--batch 10]
+##
+## The tasks survive the crash of the web worker which created them
+## and of the task worker running them.
+##
+## Tasks:
+##
+##   A task is a function registered with a name:
+##
+##     @task('send_email')
+##     def send_email_task(subject, sender, ...):
+##         ...
+##
+##   and enqueued with its arguments (which have to be JSON
+##   serializable) before the session is committed:
+##
+##     enqueue('send_email', subject=..., sender=..., ...)
+##     db.session.commit()
+##
+## Workers:
+##
+##   - Each worker thread claims up to --batch due tasks at once by
+##     marking them 'running' with a claim token, valid for
+##     TASK_VISIBILITY_TIMEOUT seconds.  Tasks whose claim has
+##     expired - their worker has died - are claimed again.
+##
+##   - Failing tasks are retried after TASK_RETRY_BACKOFF seconds,
+##     doubling with each attempt (up to TASK_RETRY_MAX_DELAY), and
+##     marked 'failed' after TASK_MAX_ATTEMPTS attempts.
+##
+##   - Done tasks are deleted after TASK_KEEP_DONE seconds.
+##
+## The queue is used when TASK_QUEUE is set - otherwise the work is
+## done as before, in the request or in a background thread.
+##
+## The throughput and the latencies of the queue are shown at
+## /metrics/tasks (see app/metrics).
+##
+## ---------------------------------------------------------
+
+import json
+import os
+import signal
+from datetime import datetime, timedelta
+from multiprocessing import get_context
+from socket import gethostname
+from threading import Event, Thread
+from time import sleep
+from uuid import uuid4
+from flask import current_app
+from app import db
+
+# Registered tasks: name -> function
+TASKS = {}
+
+
+def task(name):
+    """Register a function as task 'name'."""
+    def decorator(f):
+        TASKS[name] = f
+        return f
+    return decorator
+
+
+def queue_enabled(app=None):
+    app = app or current_app
+    return bool(app.config['TASK_QUEUE'])
+
+
+def enqueue(name, run_at=None, **payload):
+    """Add a task to the session - it is queued when the session is
+    committed.
+    """
+    from app.models import Task
+    queued = Task(name=name, payload=json.dumps(payload),
+                  run_at=run_at or datetime.utcnow())
+    db.session.add(queued)
+    return queued
+
+
+## =========================================================
+## Running the tasks
+## ---------------------------------------------------------
+
+def due(now):
+    """The criterion of the tasks which can be claimed."""
+    from app.models import Task
+    return db.or_(
+        db.and_(Task.state == 'queued', Task.run_at <= now),
+        db.and_(Task.state == 'running', Task.claimed_until < now))
+
+
+def claim(batch, visibility):
+    """Claim up to 'batch' due tasks.
+
+    Returns the claim token and the claimed tasks as
+    (id, name, payload, attempts).
+
+    """
+    from app.models import Task
+    now = datetime.utcnow()
+    ids = [id for id, in db.session.query(Task.id).filter(due(now))
+           .order_by(Task.run_at).limit(batch)]
+    if not ids:
+        db.session.commit()
+        return None, []
+
+    # The tasks claimed concurrently by another worker do not match
+    # the criterion anymore
+    token = uuid4().hex
+    table = Task.__table__
+    db.session.execute(table.update().where(db.and_(
+        table.c.id.in_(ids), due(now))).values(
+            state='running', claim=token, started=now,
+            claimed_until=now + timedelta(seconds=visibility),
+            attempts=table.c.attempts + 1))
+    db.session.commit()
+
+    tasks = db.session.query(Task.id, Task.name, Task.payload,
+                             Task.attempts).filter(Task.claim == token).all()
+    return token, tasks
+
+
+def finish(id, token, **values):
+    """Update a task - unless it has been claimed again meanwhile."""
+    from app.models import Task
+    table = Task.__table__
+    db.session.execute(table.update().where(db.and_(
+        table.c.id == id, table.c.claim == token)).values(**values))
+    db.session.commit()
+
+
+def retry_delay(attempts, config):
+    """Seconds until a task is run again after its 'attempts' attempt."""
+    return min(config['TASK_RETRY_BACKOFF'] * 2 ** (attempts - 1),
+               config['TASK_RETRY_MAX_DELAY'])
+
+
+def run_task(id, name, payload, attempts, token):
+    """Run a claimed task and record its result."""
+    config = current_app.config
+    try:
+        function = TASKS.get(name)
+        if function is None:
+            raise LookupError('Unknown task {!r}'.format(name))
+        function(**json.loads(payload))
+        db.session.commit()
+    except Exception as error:
+        db.session.rollback()
+        current_app.logger.exception('Task %s (%s) failed', id, name)
+        now = datetime.utcnow()
+        if attempts >= config['TASK_MAX_ATTEMPTS']:
+            finish(id, token, state='failed', finished=now, error=repr(error))
+        else:
+            finish(id, token, state='queued', error=repr(error),
+                   run_at=now + timedelta(
+                       seconds=retry_delay(attempts, config)))
+        return False
+
+    finish(id, token, state='done', finished=datetime.utcnow(), error=None)
+    return True
+
+
+def work_once(batch):
+    """Claim and run a batch of tasks.
+
+    Returns the number of tasks run.
+
+    """
+    config = current_app.config
+    token, tasks = claim(batch, config['TASK_VISIBILITY_TIMEOUT'])
+    for id, name, payload, attempts in tasks:
+        run_task(id, name, payload, attempts, token)
+    return len(tasks)
+
+
+def prune(keep):
+    """Delete the tasks done more than 'keep' seconds ago."""
+    from app.models import Task
+    before = datetime.utcnow() - timedelta(seconds=keep)
+    deleted = Task.query.filter(Task.state == 'done',
+                                Task.finished < before)\
+                        .delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+
+## =========================================================
+## Workers
+## ---------------------------------------------------------
+
+class Worker(Thread):
+    """A thread running tasks until 'stop' is set."""
+
+    def __init__(self, app, batch, stop):
+        super(Worker, self).__init__(name='task-worker')
+        self.app = app
+        self.batch = batch
+        self.stop = stop
+
+    def run(self):
+        config = self.app.config
+        last_pruned = datetime.min
+        while not self.stop.is_set():
+            try:
+                with self.app.app_context():
+                    count = work_once(self.batch)
+                    if datetime.utcnow() - last_pruned > \
+                       timedelta(seconds=config['TASK_KEEP_DONE']):
+                        prune(config['TASK_KEEP_DONE'])
+                        last_pruned = datetime.utcnow()
+                    db.session.remove()
+            except Exception:
+                self.app.logger.exception('Running the tasks failed')
+                count = 0
+            if not count:
+                self.stop.wait(config['TASK_POLL_INTERVAL'])
+
+
+def work(app, threads, batch):
+    """Run worker threads until the process is asked to stop
+    (SIGINT or SIGTERM).
+    """
+    # NOTE:
+    # The signal handler only records the signal - setting the event
+    # in the handler could deadlock with the main thread waiting on it.
+    signals = []
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: signals.append(signum))
+
+    # Connections are not shared with the parent process
+    with app.app_context():
+        db.get_engine(app).dispose()
+
+    stop = Event()
+    workers = [Worker(app, batch, stop) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    app.logger.info('Task worker %s:%s running %s threads',
+                    gethostname(), os.getpid(), threads)
+    while not signals and any(worker.is_alive() for worker in workers):
+        sleep(1)
+
+    # Let the threads finish their current batch
+    stop.set()
+    for worker in workers:
+        worker.join()
+    app.logger.info('Task worker %s:%s stopped', gethostname(), os.getpid())
+
+
+def run_workers(app, threads, processes, batch):
+    """Run 'processes' worker processes of 'threads' threads each."""
+    if processes <= 1:
+        work(app, threads, batch)
+        return
+
+    context = get_context('fork')
+    children = [context.Process(target=work, args=(app, threads, batch),
+                                name='task-worker-{}'.format(i))
+                for i in range(processes)]
+    for child in children:
+        child.start()
+
+    def forward(signum, frame):
+        for child in children:
+            if child.is_alive():
+                os.kill(child.pid, signal.SIGTERM)
+    signal.signal(signal.SIGINT, forward)
+    signal.signal(signal.SIGTERM, forward)
+
+    for child in children:
+        child.join()
+
+
+## =========================================================
+## Statistics
+## ---------------------------------------------------------
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def queue_stats(window=3600):
+    """Numbers of tasks per state, and throughput and latencies of the
+    tasks done in the last 'window' seconds.
+
+    - wait: seconds from the creation of a task to its (last) start
+    - run:  seconds from its start to its end
+
+    """
+    from app.models import Task
+    counts = dict(db.session.query(Task.state, db.func.count(Task.id))
+                  .group_by(Task.state))
+    since = datetime.utcnow() - timedelta(seconds=window)
+    done = db.session.query(Task.name, Task.created, Task.started,
+                            Task.finished)\
+                     .filter(Task.state == 'done', Task.finished >= since)\
+                     .order_by(Task.finished.desc()).limit(10000).all()
+
+    def latencies(rows):
+        wait = [(started - created).total_seconds()
+                for _, created, started, _ in rows]
+        run = [(finished - started).total_seconds()
+               for _, _, started, finished in rows]
+        return {
+            'done':        len(rows),
+            'per_minute':  60.0 * len(rows) / window,
+            'wait_p50':    percentile(wait, 0.5),
+            'wait_p95':    percentile(wait, 0.95),
+            'run_p50':     percentile(run, 0.5),
+            'run_p95':     percentile(run, 0.95),
+        }
+
+    names = sorted({row[0] for row in done})
+    return {
+        'queued':   counts.get('queued', 0),
+        'running':  counts.get('running', 0),
+        'failed':   counts.get('failed', 0),
+        'window':   window,
+        'all':      latencies(done),
+        'tasks':    {name: latencies([row for row in done if row[0] == name])
+                     for name in names},
+    }
+
+
+def init_app(app):
+    if app.config['TASK_QUEUE']:
+        app.metrics['tasks'] = queue_stats
+
+
+## fin.
@@ -0,0 +1,292 @@
+## =========================================================
+## app/transfer.py
+## ---------------------------------------------------------
+##
+## Bulk export and import of the users, posts and follow graph as
+## NDJSON - one JSON object per line:
+##
+##   {"table": "user", "row": {"id": 1, "username": "john", ...}}
+##   {"table": "post", "row": {"id": 1, "body": "...", ...}}
+##   {"table": "post_archive", "row": {"id": 1, "body": "...", ...}}
+##   {"table": "followers", "row": {"follower_id": 1, "followed_id": 2}}
+##
+## with the commands
+##
+##   flask data export FILE [--chunk 1000]
+##   flask data import FILE [--batch 1000] [--offset 0]
+##
+## Files ending in '.gz' are gzip-compressed, '-' is stdout / stdin.
+##
+## Export:
+##
+##   The tables are read in chunks of --chunk rows ordered by their
+##   keys (keyset pagination), users before their posts and follows -
+##   the memory used does not grow with the size of the tables.
+##
+##   The posts are read wherever they are stored: the archived posts
+##   from the archive bind (see app/archive.py) as 'post_archive', the
+##   posts in the shards (see app/shards.py) as 'post' after the ones
+##   of the post table.
+##
+## Import:
+##
+##   The rows keep their ids.  They are inserted with one executemany
+##   INSERT per table and batch, and committed every --batch lines.
+##   The inserts bypass the ORM - the SearchableMixin hooks do not
+##   index the posts one by one - and the search index is rebuilt
+##   with bulk requests once all rows have been imported.
+##
+##   The archived posts are written to the archive bind.  With shards
+##   the posts are written to the shards of their authors (posts
+##   stored by an interrupted import are skipped).
+##
+##   The tags and mentions of the posts (see app/tags.py) are stored
+##   with each batch - replacing the ones stored for the same posts by
+##   an interrupted import.
+##
+##   An interrupted import is resumed with --offset set to the number
+##   of lines committed before, as reported by the progress output.
+##
+## The derived tables (suggestions, tasks) are not transferred - run
+## 'flask graph suggest --all' after an import.
+##
+## ---------------------------------------------------------
+
+import gzip
+import io
+import json
+import sys
+from datetime import datetime
+from collections import namedtuple
+from app import db
+from app.models import User, Post, ArchivedPost, followers
+from app.search import bulk_index
+from app.tags import index_posts
+from app.shards import sharding_enabled, shard_count, shard_engine, \
+    shard_post, store_rows
+
+# The transferred tables in the order of their dependencies
+TABLES = [User.__table__, Post.__table__, ArchivedPost.__table__,
+          followers]
+
+# The tables which are not stored in the application database
+BOUND_TABLES = {ArchivedPost.__table__.name: ArchivedPost}
+
+# The tables of posts - tagged when imported
+POST_TABLES = {Post.__tablename__, ArchivedPost.__tablename__}
+
+
+def open_file(path, mode):
+    """Open an NDJSON file for reading ('r') or writing ('w') as
+    text - gzip-compressed when the name ends in '.gz'.
+    """
+    if path == '-':
+        stream = sys.stdin if mode == 'r' else sys.stdout
+        return io.TextIOWrapper(stream.buffer, encoding='utf-8')
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+## =========================================================
+## Export
+## ---------------------------------------------------------
+
+def key_columns(table):
+    """The columns the rows of a table are ordered and paged by."""
+    if table.primary_key.columns:
+        return list(table.primary_key.columns)
+    return list(table.columns)
+
+
+def after_key(columns, key):
+    """The criterion of the rows after 'key' in the order of
+    'columns' (lexicographic).
+    """
+    column, value = columns[0], key[0]
+    if len(columns) == 1:
+        return column > value
+    return db.or_(column > value,
+                  db.and_(column == value, after_key(columns[1:], key[1:])))
+
+
+def table_rows(connection, table, chunk):
+    """Iterate over the rows of a table as dicts, reading 'chunk' rows
+    at a time.
+    """
+    columns = key_columns(table)
+
+    # Follows with a missing user cannot be imported
+    statement = db.select([table]).where(
+        db.and_(*[column.isnot(None) for column in columns]))\
+        .order_by(*columns).limit(chunk)
+    key = None
+    while True:
+        query = statement if key is None else \
+            statement.where(after_key(columns, key))
+        rows = connection.execute(query).fetchall()
+        for row in rows:
+            yield dict(row)
+        if len(rows) < chunk:
+            break
+        key = [rows[-1][column.name] for column in columns]
+
+
+def read_table(table, chunk):
+    """Iterate over the rows of a transferred table - read from its
+    bind, and from the shards for the posts.
+    """
+    if table.name in BOUND_TABLES:
+        connection = db.session.connection(mapper=BOUND_TABLES[table.name])
+    else:
+        connection = db.session.connection()
+    for row in table_rows(connection, table, chunk):
+        yield row
+
+    if table is Post.__table__ and sharding_enabled():
+        for shard in range(shard_count()):
+            with shard_engine(shard).connect() as connection:
+                for row in table_rows(connection, shard_post, chunk):
+                    yield row
+
+
+def encode(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(repr(value))
+
+
+def export_data(out, chunk=1000, progress=None):
+    """Write the tables as NDJSON to 'out'.
+
+    Returns the number of rows written per table.
+
+    """
+    counts = {}
+    for table in TABLES:
+        count = 0
+        for row in read_table(table, chunk):
+            out.write(json.dumps({'table': table.name, 'row': row},
+                                 default=encode, separators=(',', ':')))
+            out.write('\n')
+            count += 1
+            if progress is not None and count % chunk == 0:
+                progress(table.name, count)
+        counts[table.name] = count
+    db.session.commit()
+    return counts
+
+
+## =========================================================
+## Import
+## ---------------------------------------------------------
+
+def decoder(table):
+    """A function converting the values of an exported row of a table
+    back to the types of its columns.
+    """
+    dates = [column.name for column in table.columns
+             if isinstance(column.type, db.DateTime)]
+
+    def decode(row):
+        for name in dates:
+            if row.get(name) is not None:
+                row[name] = datetime.fromisoformat(row[name])
+        return row
+    return decode
+
+
+def reset_sequences(connection):
+    """Continue the id sequences after the imported ids (PostgreSQL)."""
+    if connection.dialect.name != 'postgresql':
+        return
+    for table in TABLES:
+        if table.name in BOUND_TABLES:
+            continue
+        for column in table.primary_key.columns:
+            connection.execute(db.text(
+                "SELECT setval(pg_get_serial_sequence(:table, :column), "
+                "coalesce(max({column}), 0) + 1, false) FROM \"{table}\""
+                .format(table=table.name, column=column.name)),
+                table=table.name, column=column.name)
+
+
+def import_data(lines, batch=1000, offset=0, progress=None):
+    """Insert the NDJSON rows of 'lines' - skipping the first 'offset'
+    lines - committing every 'batch' lines.
+
+    Returns the number of rows inserted per table.  'progress' is
+    called with the number of lines committed after each batch.
+
+    """
+    tables = {table.name: table for table in TABLES}
+    decoders = {name: decoder(table) for name, table in tables.items()}
+    counts = dict.fromkeys(tables, 0)
+    pending = {}
+    number = 0
+
+    def flush():
+        # The tables in the order of their dependencies
+        for name in tables:
+            rows = pending.pop(name, None)
+            if not rows:
+                continue
+            if name == Post.__tablename__ and sharding_enabled():
+                store_rows(rows)
+            else:
+                db.session.execute(tables[name].insert(), rows,
+                                   mapper=BOUND_TABLES.get(name))
+            if name in POST_TABLES:
+                index_posts(db.session, [
+                    (row['id'], row['body'], row['timestamp'])
+                    for row in rows])
+            counts[name] += len(rows)
+        db.session.commit()
+        if progress is not None:
+            progress(number)
+
+    for number, line in enumerate(lines, 1):
+        if number <= offset or not line.strip():
+            continue
+        record = json.loads(line)
+        name = record['table']
+        if name not in tables:
+            raise ValueError('Line {}: unknown table {!r}'.format(
+                number, name))
+        pending.setdefault(name, []).append(decoders[name](record['row']))
+        if (number - offset) % batch == 0:
+            flush()
+    flush()
+
+    reset_sequences(db.session.connection())
+    db.session.commit()
+    return counts
+
+
+class IndexedPost(namedtuple('IndexedPost', ['id', 'body'])):
+    """The indexed fields of a post."""
+    __slots__ = ()
+    __searchable__ = Post.__searchable__
+
+
+def reindex_posts(chunk=1000):
+    """Rebuild the search index of all posts - hot, archived and in the
+    shards.  Returns the number of posts indexed.
+    """
+    return bulk_index(Post.__tablename__, (
+        IndexedPost(row['id'], row['body'])
+        for table in (Post.__table__, ArchivedPost.__table__)
+        for row in read_table(table, chunk)))
+
+
+def transfer_rates(counts, seconds):
+    """Lines of the report of a transfer: rows and rows per second."""
+    total = sum(counts.values())
+    lines = ['  {:<10} {:>10} rows'.format(name, count)
+             for name, count in counts.items()]
+    lines.append('  {:<10} {:>10} rows in {:.1f}s, {:.0f} rows/s'.format(
+        'total', total, seconds, total / seconds if seconds else 0))
+    return lines
+
+
+## fin.
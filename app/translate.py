@@ -28,6 +28,7 @@
 from google.cloud import translate as google_translate
 from flask import current_app
 from flask_babel import _
+from guess_language import guess_language
 
 
 def translate_text(text, source_language, target_language):
@@ -87,4 +88,20 @@ def translate(string, source_language, target_language):
     return translation
 
 
+## =========================================================
+## Language detection
+## ---------------------------------------------------------
+
+def detect_language(text):
+    """Guess the language a text is written in.
+
+    Returns '' when the language could not be detected.
+
+    """
+    language = guess_language(text)
+    if language == 'UNKNOWN' or len(language) > 5:
+        language = ''
+    return language
+
+
 ## fin.
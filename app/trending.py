@@ -0,0 +1,396 @@
+## =========================================================
+## app/trending.py
+## ---------------------------------------------------------
+##
+## Trending posts and tags.
+##
+## The explore page shows the posts and the tags with the most
+## activity in the last hours.  The activity is not computed from the
+## posts (a GROUP BY over the post table on every request) but
+## counted when it happens:
+##
+##   - a new post counts for each of its tags (see app/tags.py),
+##   - a translation of a post counts for the post - once per user
+##     and post in TRENDING_HALF_LIFE seconds (in each worker), and
+##     only for posts which exist,
+##   - a follow counts FOLLOW_WEIGHT for the newest post of the user
+##     followed - the post which has won the follower.
+##
+## Decay:
+##
+##   An event counts half after TRENDING_HALF_LIFE seconds, a quarter
+##   after twice as long, ...  The counts are kept as 'forward
+##   decayed' scores: an event at time t adds
+##
+##     weight * 2 ** ((t - landmark) / TRENDING_HALF_LIFE)
+##
+##   - newer events add more.  All scores decay at the same rate, so
+##   the order of the scores is the order of the decayed counts at
+##   any time later, and the scores only ever have to be increased.
+##   To keep them in the range of a float, the landmark moves ahead
+##   every ERA_HALF_LIVES half-lives (an 'era'): the scores of the
+##   previous era are scaled down into the current one, older ones
+##   have decayed to nothing and are dropped.
+##
+## Counting:
+##
+##   Each worker adds the events to its TrendingCounters in memory.
+##   Every TRENDING_FLUSH_INTERVAL seconds a thread of the worker adds
+##   them to the trending_score table (see models.TrendingScore) - the
+##   table sums up the events of all workers - and reloads the top
+##   TRENDING_SIZE posts and tags from its index (kind, era, score).
+##   The explore page reads these top lists of the worker - O(K),
+##   without query apart from the posts shown.
+##
+## The tags of the posts stored in the shards (see app/shards.py) are
+## counted by shards.write_post().
+##
+## ---------------------------------------------------------
+
+import heapq
+import os
+from collections import OrderedDict
+from threading import Lock, Thread
+from time import sleep, time
+from flask import current_app
+
+# Half-lives per era of the scores (2 ** 64 fits into any float)
+ERA_HALF_LIVES = 64
+
+# The weight of a follow
+FOLLOW_WEIGHT = 2
+
+# The kinds of the counted things
+KINDS = ('post', 'tag')
+
+
+def era_of(now, half_life):
+    return int(now // (half_life * ERA_HALF_LIVES))
+
+
+def forward_score(weight, now, half_life):
+    """The score of an event at time 'now', as (era, score)."""
+    era = era_of(now, half_life)
+    landmark = era * half_life * ERA_HALF_LIVES
+    return era, weight * 2 ** ((now - landmark) / half_life)
+
+
+def rescale(score, era, to_era):
+    """A score of the era 'era' in the units of the era 'to_era'."""
+    if era == to_era:
+        return score
+    if era == to_era - 1:
+        return score * 2.0 ** -ERA_HALF_LIVES
+    return 0.0
+
+
+## =========================================================
+## Database
+## ---------------------------------------------------------
+
+def store_scores(scores, era):
+    """Add scores {(kind, key): (era, score)} to the trending_score
+    table and drop the scores of the eras before the previous one.
+    """
+    from app import db
+    from app.models import TrendingScore
+    table = TrendingScore.__table__
+    for (kind, key), (score_era, score) in sorted(scores.items()):
+        score = rescale(score, score_era, era)
+        updated = db.session.execute(table.update().where(db.and_(
+            table.c.kind == kind, table.c.key == key)).values(
+                score=db.case([
+                    (table.c.era == era, table.c.score + score),
+                    (table.c.era == era - 1,
+                     table.c.score * 2.0 ** -ERA_HALF_LIVES + score)],
+                    else_=score),
+                era=era)).rowcount
+        if not updated:
+            db.session.execute(table.insert().values(
+                kind=kind, key=key, score=score, era=era))
+    db.session.execute(table.delete().where(table.c.era < era - 1))
+
+
+def load_top(era, size):
+    """The highest scores of each kind as lists [(key, score)] -
+    the top of the current era merged with the top of the previous.
+    """
+    from app import db
+    from app.models import TrendingScore
+    top = {}
+    for kind in KINDS:
+        rows = []
+        for score_era in (era, era - 1):
+            rows += [(key, rescale(score, score_era, era))
+                     for key, score in db.session.query(
+                         TrendingScore.key, TrendingScore.score)
+                     .filter(TrendingScore.kind == kind,
+                             TrendingScore.era == score_era)
+                     .order_by(TrendingScore.score.desc()).limit(size)]
+        top[kind] = heapq.nlargest(size, rows, key=lambda row: row[1])
+    return top
+
+
+## =========================================================
+## Counters of a worker
+## ---------------------------------------------------------
+
+class TrendingCounters(object):
+    """The events counted by a worker since the last flush and the
+    top lists read at the last flush.
+    """
+
+    def __init__(self, app, size, half_life, interval):
+        self.app = app
+        self.size = size
+        self.half_life = half_life
+        self.interval = interval
+        self._pending = {}
+        self._top = None
+        self._lock = Lock()
+        self._pid = None
+        self._seen = OrderedDict()
+        self.events = 0
+        self.flushes = 0
+
+    def record(self, kind, key, weight=1, now=None):
+        """Count an event of a post or a tag."""
+        self.start()
+        era, score = forward_score(weight, now or time(), self.half_life)
+        key = str(key)
+        with self._lock:
+            if (kind, key) in self._pending:
+                pending_era, pending = self._pending[(kind, key)]
+                score += rescale(pending, pending_era, era)
+            self._pending[(kind, key)] = (era, score)
+            self.events += 1
+
+    def first_seen(self, key, now=None):
+        """Has 'key' not been seen in the last half-life?  Remembers
+        it for the next half-life.
+        """
+        now = now or time()
+        with self._lock:
+            # The keys in the order they have been seen - drop the
+            # ones seen before the half-life
+            while self._seen:
+                oldest, seen = next(iter(self._seen.items()))
+                if seen > now - self.half_life:
+                    break
+                del self._seen[oldest]
+            if key in self._seen:
+                return False
+            self._seen[key] = now
+            return True
+
+    def flush(self, now=None):
+        """Add the counted events to the database and reload the top
+        lists.  Needs an application context.
+
+        The events are counted again by the next flush when the
+        database cannot be written.
+
+        """
+        from app import db
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        era = era_of(now or time(), self.half_life)
+        try:
+            store_scores(pending, era)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            with self._lock:
+                for (kind, key), (pending_era, score) in pending.items():
+                    if (kind, key) in self._pending:
+                        newer_era, newer = self._pending[(kind, key)]
+                        score = rescale(score, pending_era, newer_era) + \
+                            newer
+                        pending_era = newer_era
+                    self._pending[(kind, key)] = (pending_era, score)
+            raise
+        self._top = load_top(era, self.size)
+        self.flushes += 1
+
+    def top(self, kind):
+        """The top list [(key, score)] of a kind - read from the
+        database when it has not been flushed yet.
+        """
+        if self._top is None:
+            self._top = load_top(era_of(time(), self.half_life), self.size)
+        return self._top[kind]
+
+    def start(self):
+        """Start the flusher thread - once in each worker process
+        (after the workers have been forked).
+        """
+        if not self.interval or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                TrendingFlusher(self.app, self, self.interval).start()
+
+    def stats(self):
+        return {
+            'events':  self.events,
+            'pending': len(self._pending),
+            'seen':    len(self._seen),
+            'flushes': self.flushes,
+        }
+
+
+class TrendingFlusher(Thread):
+    """Flush the counters of the worker periodically."""
+
+    def __init__(self, app, counters, interval):
+        super(TrendingFlusher, self).__init__(name='trending-flusher',
+                                              daemon=True)
+        self.app = app
+        self.counters = counters
+        self.interval = interval
+
+    def run(self):
+        from app import db
+        while True:
+            sleep(self.interval)
+            try:
+                with self.app.app_context():
+                    try:
+                        self.counters.flush()
+                    finally:
+                        db.session.remove()
+            except Exception:
+                self.app.logger.exception('Storing the trending counts '
+                                          'failed')
+
+
+## =========================================================
+## Counting
+## ---------------------------------------------------------
+
+def record(kind, key, weight=1):
+    """Count an event of a post or a tag - when trending is enabled."""
+    counters = current_app.trending
+    if counters is not None:
+        counters.record(kind, key, weight)
+
+
+def record_translation(user, post_id):
+    """Count a translation of a post by a user - the first one in the
+    half-life, when the post exists.
+    """
+    from app.archive import posts_by_id
+    counters = current_app.trending
+    if counters is None or post_id is None:
+        return
+    # Only the existing posts are remembered
+    if posts_by_id([post_id]) and counters.first_seen((user.id, post_id)):
+        counters.record('post', post_id)
+
+
+def record_follow(user):
+    """Count a follow of a user for her newest post."""
+    from app import db
+    from app.models import Post
+    from app.shards import sharding_enabled, newest_rows
+    if current_app.trending is None:
+        return
+    if sharding_enabled():
+        rows = newest_rows([user.id], None, 1)
+        newest = rows[0][0] if rows else None
+    else:
+        newest = db.session.query(Post.id)\
+            .filter(Post.user_id == user.id)\
+            .order_by(Post.timestamp.desc(), Post.id.desc())\
+            .limit(1).scalar()
+    if newest is not None:
+        record('post', newest, FOLLOW_WEIGHT)
+
+
+def after_flush(session, flush_context):
+    """Remember the tags of the posts which have been written.
+
+    This is intended to be used as event handler and has to be
+    bound to the 'after_flush' event of the database.
+
+    """
+    from app.models import Post
+    from app.tags import extract_tags
+    tags = [tag for post in session.new if isinstance(post, Post)
+            for tag in extract_tags(post.body)]
+    if tags:
+        session.info.setdefault('trending_tags', []).extend(tags)
+
+
+def after_commit(session):
+    """Count the tags of the committed posts.
+
+    This is intended to be used as event handler and has to be
+    bound to the 'after_commit' event of the database.
+
+    """
+    tags = session.info.pop('trending_tags', None)
+    if tags:
+        for tag in tags:
+            record('tag', tag)
+
+
+def after_rollback(session):
+    """Forget the tags of the posts which have been rolled back.
+
+    This is intended to be used as event handler and has to be
+    bound to the 'after_rollback' event of the database.
+
+    """
+    session.info.pop('trending_tags', None)
+
+
+def register_events(db):
+    """Bind the counting handlers to the database events."""
+    db.event.listen(db.session, 'after_flush',    after_flush)
+    db.event.listen(db.session, 'after_commit',   after_commit)
+    db.event.listen(db.session, 'after_rollback', after_rollback)
+
+
+## =========================================================
+## Reading
+## ---------------------------------------------------------
+
+def trending_posts():
+    """The PostViews of the trending posts, highest score first."""
+    from app.archive import posts_by_id
+    if current_app.trending is None:
+        return []
+    ids = [int(key) for key, _ in current_app.trending.top('post')]
+    posts = posts_by_id(ids)
+    return [posts[id] for id in ids if id in posts]
+
+
+def trending_tags():
+    """The trending tags, highest score first."""
+    if current_app.trending is None:
+        return []
+    return [key for key, _ in current_app.trending.top('tag')]
+
+
+def trending_version():
+    """Version of the trending lists: the keys in order."""
+    if current_app.trending is None:
+        return ()
+    return tuple(key for kind in KINDS
+                 for key, _ in current_app.trending.top(kind))
+
+
+def init_app(app):
+    """Create the counters of the worker."""
+    app.trending = None
+    if not app.config['TRENDING_SIZE']:
+        return
+    app.trending = TrendingCounters(
+        app, app.config['TRENDING_SIZE'], app.config['TRENDING_HALF_LIFE'],
+        app.config['TRENDING_FLUSH_INTERVAL'])
+    app.metrics['trending'] = app.trending.stats
+
+
+## fin.
@@ -0,0 +1,342 @@
+## =========================================================
+## app/updates.py
+## ---------------------------------------------------------
+##
+## New posts in the home timeline.
+##
+## Instead of reloading the whole timeline to check for new posts,
+## the browser asks for the posts written since the newest post it
+## shows:
+##
+##   GET /new_posts?since=<position>  ->  {"count": 3, "ids": [...]}
+##
+## The ids are sent as strings - the ids of the posts in the shards
+## (see app/shards.py) do not fit into a JavaScript number.
+##
+## The position is the (timestamp, id) of the newest post.  The
+## query only reads the index on post (user_id, timestamp, id):
+##
+##   SELECT post.id FROM post
+##   WHERE post.user_id IN (<followed authors>)
+##     AND (post.timestamp > :timestamp
+##          OR post.timestamp = :timestamp AND post.id > :id)
+##
+## Server-sent events:
+##
+##   When NEW_POSTS_STREAM is set, browsers showing the timeline
+##   additionally subscribe to the event stream /new_posts/stream
+##   and are notified as soon as one of the users they follow
+##   writes a post.
+##
+##   Each worker keeps the newest posts in a PostHub - a ring buffer
+##   the streams wait on.  Posts committed by the worker itself are
+##   published when they are committed, posts committed by the other
+##   workers are found by a poller thread querying the database every
+##   NEW_POSTS_STREAM_POLL seconds.
+##
+##   The poller reads the posts by timestamp, not by id: the ids of
+##   the shards have random low bits, and a post is committed a while
+##   after its timestamp has been set.  Each poll reads the posts of
+##   the last NEW_POSTS_STREAM_OVERLAP seconds before the newest one
+##   seen so far again, skipping the ones already published.
+##
+##   Every open stream holds a connection - use an asynchronous
+##   worker class to serve them (see gunicorn.conf.py).
+##
+## ---------------------------------------------------------
+
+import json
+from collections import deque
+from datetime import datetime, timedelta
+from threading import Condition, Thread
+from time import sleep
+
+# Format of the positions in the timeline
+SINCE_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+## =========================================================
+## New posts since a position
+## ---------------------------------------------------------
+
+def format_since(post):
+    """The position of a post in the timeline."""
+    return '{}-{}'.format(post.timestamp.strftime(SINCE_FORMAT), post.id)
+
+
+def parse_since(since):
+    """Parse a position created by format_since().
+
+    Returns None when the position is invalid.
+
+    """
+    try:
+        timestamp, id = since.split('-')
+        return datetime.strptime(timestamp, SINCE_FORMAT), int(id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def new_posts(user, position, limit):
+    """Get the number of posts in the timeline of the user which are
+    newer than the position, and the ids of the newest 'limit' of
+    them.
+
+    All posts of the timeline are new when position is None.
+
+    """
+    from app import db
+    from app.models import Post
+    from app.shards import sharding_enabled, newer_posts
+    if sharding_enabled():
+        return newer_posts(user.followed_ids() + [user.id], position,
+                           limit)
+
+    criterion = Post.user_id.in_(user.followed_authors())
+    if position is not None:
+        timestamp, id = position
+        criterion = db.and_(criterion, db.or_(
+            Post.timestamp > timestamp,
+            db.and_(Post.timestamp == timestamp, Post.id > id)))
+
+    ids = [id for id, in db.session.query(Post.id).filter(criterion)
+           .order_by(Post.timestamp.desc(), Post.id.desc()).limit(limit)]
+
+    count = len(ids)
+    if count == limit:
+        count = db.session.query(db.func.count(Post.id))\
+                          .filter(criterion).scalar()
+
+    return count, ids
+
+
+## =========================================================
+## Publish / subscribe
+## ---------------------------------------------------------
+
+class PostHub(object):
+    """The newest posts known to the worker.
+
+    The posts are kept in a ring buffer of 'size' entries
+    (sequence number, post id, author id).  Subscribers remember the
+    sequence number of the last entry they have seen and wait for
+    newer ones.
+
+    """
+
+    def __init__(self, size):
+        self._entries = deque(maxlen=size)
+        self._ids = set()
+        self._condition = Condition()
+        self.sequence = 0
+        self.subscribers = 0
+
+    def subscribe(self):
+        with self._condition:
+            self.subscribers += 1
+
+    def unsubscribe(self):
+        with self._condition:
+            self.subscribers -= 1
+
+    def publish(self, posts):
+        """Publish the posts given as (post id, author id) pairs.
+
+        Posts which have already been published are ignored.
+
+        """
+        with self._condition:
+            for id, user_id in posts:
+                if id in self._ids:
+                    continue
+                if len(self._entries) == self._entries.maxlen:
+                    self._ids.discard(self._entries[0][1])
+                self.sequence += 1
+                self._entries.append((self.sequence, id, user_id))
+                self._ids.add(id)
+            self._condition.notify_all()
+
+    def wait(self, after, timeout):
+        """Wait up to 'timeout' seconds for entries newer than the
+        sequence number 'after'.
+
+        Returns the new entries and the current sequence number.
+
+        """
+        with self._condition:
+            if self.sequence <= after:
+                self._condition.wait(timeout)
+            entries = [entry for entry in self._entries if entry[0] > after]
+            return entries, self.sequence
+
+    def stats(self):
+        return {
+            'sequence':    self.sequence,
+            'buffered':    len(self._entries),
+            'subscribers': self.subscribers,
+        }
+
+
+class PostPoller(Thread):
+    """Publish the posts committed by the other workers.
+
+    Polls the posts with a timestamp in the last 'overlap' seconds
+    before the newest one seen so far - a range scan of the timestamp
+    index of the post table or of each shard (see app/shards.py).
+    The posts seen in that window are remembered, so that each post
+    is published once.
+
+    """
+
+    def __init__(self, app, hub, interval, overlap):
+        super(PostPoller, self).__init__(name='post-poller', daemon=True)
+        self.app = app
+        self.hub = hub
+        self.interval = interval
+        self.overlap = timedelta(seconds=overlap)
+        # The newest timestamp and the posts {id: timestamp} seen in
+        # the window of each table
+        self._newest = {}
+        self._seen = {}
+
+    def run(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    self.poll()
+            except Exception:
+                self.app.logger.exception('Polling the new posts failed')
+            sleep(self.interval)
+
+    def poll(self):
+        """Publish the posts committed since the last poll.
+
+        The first poll of a table only remembers the posts committed
+        so far.
+
+        """
+        from app import db
+        from app.shards import post_tables
+        for name, engine, table in post_tables():
+            newest = self._newest.get(name)
+            with engine.connect() as connection:
+                if newest is None:
+                    newest = connection.execute(
+                        db.select([db.func.max(table.c.timestamp)])
+                    ).scalar() or datetime.utcnow()
+                rows = connection.execute(
+                    db.select([table.c.id, table.c.user_id,
+                               table.c.timestamp])
+                    .where(table.c.timestamp > newest - self.overlap)
+                ).fetchall()
+
+            seen = self._seen.get(name, {})
+            posts = [(id, user_id) for id, user_id, _ in rows
+                     if id not in seen]
+            if posts and name in self._newest:
+                self.hub.publish(posts)
+
+            # Slide the window
+            seen.update((id, timestamp) for id, _, timestamp in rows)
+            newest = max([newest] + [timestamp for _, _, timestamp in rows])
+            self._newest[name] = newest
+            self._seen[name] = {
+                id: timestamp for id, timestamp in seen.items()
+                if timestamp > newest - self.overlap}
+
+
+def get_hub(app):
+    """Get the hub of the worker, creating it on first use.
+
+    The hub is created lazily in the worker process - after an
+    asynchronous worker has patched the threading primitives.
+
+    """
+    hub = app.extensions.get('post_hub')
+    if hub is not None:
+        return hub
+
+    created = PostHub(app.config['NEW_POSTS_STREAM_BUFFER'])
+    hub = app.extensions.setdefault('post_hub', created)
+    if hub is created:
+        interval = app.config['NEW_POSTS_STREAM_POLL']
+        if interval:
+            PostPoller(app, hub, interval,
+                       app.config['NEW_POSTS_STREAM_OVERLAP']).start()
+        app.metrics['new_posts'] = hub.stats
+    return hub
+
+
+def event_stream(hub, authors, after, heartbeat):
+    """The server-sent events of a subscriber.
+
+    An event 'posts' with the ids of the new posts is sent when one
+    of the 'authors' writes a post.  A comment is sent every
+    'heartbeat' seconds to keep the connection open.
+
+    """
+    hub.subscribe()
+    try:
+        yield 'retry: {}\n\n'.format(heartbeat * 1000)
+        while True:
+            entries, after = hub.wait(after, heartbeat)
+            ids = [id for _, id, user_id in entries if user_id in authors]
+            if ids:
+                yield 'event: posts\ndata: {}\n\n'.format(
+                    json.dumps({'ids': [str(id) for id in ids]}))
+            else:
+                yield ': keepalive\n\n'
+    finally:
+        hub.unsubscribe()
+
+
+## =========================================================
+## Publishing the committed posts
+## ---------------------------------------------------------
+
+def after_flush(session, flush_context):
+    """Remember the posts which have been written.
+
+    This is intended to be used as event handler and has to be
+    bound to the 'after_flush' event of the database.
+
+    """
+    # NOTE:
+    # session.new still contains the objects inserted by the flush -
+    # their ids have been assigned already.
+    from app.models import Post
+    posts = [(obj.id, obj.user_id) for obj in session.new
+             if isinstance(obj, Post)]
+    if posts:
+        session.info.setdefault('new_posts', []).extend(posts)
+
+
+def after_commit(session):
+    """Publish the committed posts to the hub of the worker.
+
+    This is intended to be used as event handler and has to be
+    bound to the 'after_commit' event of the database.
+
+    """
+    posts = session.info.pop('new_posts', None)
+    if not posts:
+        return
+
+    # Nobody is subscribed to a worker without hub
+    hub = session.app.extensions.get('post_hub')
+    if hub is not None:
+        hub.publish(posts)
+
+
+def after_rollback(session):
+    session.info.pop('new_posts', None)
+
+
+def register_events(db):
+    """Bind the publishing handlers to the database events."""
+    db.event.listen(db.session, 'after_flush',    after_flush)
+    db.event.listen(db.session, 'after_commit',   after_commit)
+    db.event.listen(db.session, 'after_rollback', after_rollback)
+
+
+## fin.
@@ -0,0 +1,198 @@
+## =========================================================
+## app/warmup.py
+## ---------------------------------------------------------
+##
+## Production serving profile: Preloading and warming up the
+## application before it starts accepting traffic.
+##
+## When gunicorn is run with 'preload_app = True' (see
+## gunicorn.conf.py) the application is created once in the
+## gunicorn master process and the workers are forked from it.
+## Everything prepared in the master before forking - compiled
+## templates, loaded translation catalogs - is therefore shared
+## by all workers copy-on-write instead of being rebuilt lazily by
+## every worker on its first requests.
+##
+## ---------------------------------------------------------
+
+import os
+from time import perf_counter
+from flask import request, current_app
+from flask_babel import get_locale, support
+from jinja2 import FileSystemBytecodeCache
+
+
+## =========================================================
+## Jinja bytecode cache
+## ---------------------------------------------------------
+
+def setup_bytecode_cache(app):
+    """Store the compiled templates in a bytecode cache on disk.
+
+    The cache directory is taken from the configuration variable
+    JINJA_BYTECODE_CACHE_DIR.  Templates compiled once - for example
+    by precompile_templates() during a deploy - are then loaded from
+    the cache instead of being compiled again after a restart.
+
+    """
+    cache_dir = app.config['JINJA_BYTECODE_CACHE_DIR']
+    if not cache_dir:
+        return
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+
+
+def precompile_templates(app):
+    """Compile all templates known to the application.
+
+    This includes the templates of the application as well as the
+    templates of the registered extensions (Flask-Bootstrap etc.).
+    The compiled templates are kept in the template cache of the
+    Jinja environment and - when a bytecode cache has been set up -
+    written to disk.
+
+    Returns the number of compiled templates.
+
+    """
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+
+    return len(names)
+
+
+## =========================================================
+## Babel translation catalogs
+## ---------------------------------------------------------
+
+def load_translations(app):
+    """Load the translation catalogs of all languages listed in the
+    configuration variable LANGUAGES.
+
+    Flask-Babel loads the catalogs from disk on every request.  The
+    catalogs loaded here are kept in app.babel_catalogs and handed to
+    Flask-Babel by use_preloaded_translations() instead.
+
+    Returns the number of loaded catalogs.
+
+    """
+    babel = app.extensions['babel']
+
+    catalogs = {}
+    for language in app.config['LANGUAGES']:
+
+        # The same procedure as used by flask_babel.get_translations()
+        translations = support.Translations()
+        for dirname in babel.translation_directories:
+            catalog = support.Translations.load(
+                dirname, [language], babel.domain)
+            translations.merge(catalog)
+            if hasattr(catalog, 'plural'):
+                translations.plural = catalog.plural
+
+        catalogs[language] = translations
+
+    app.babel_catalogs = catalogs
+
+    return len(catalogs)
+
+
+def use_preloaded_translations():
+    """Hand the preloaded catalog for the current locale to
+    Flask-Babel.
+
+    Flask-Babel looks for the translations of the current request in
+    request.babel_translations before loading them from disk.
+
+    This is intended to be registered as 'before_request' handler.
+
+    """
+    catalogs = getattr(current_app, 'babel_catalogs', None)
+    if not catalogs:
+        return
+
+    translations = catalogs.get(str(get_locale()))
+    if translations is not None:
+        request.babel_translations = translations
+
+
+## =========================================================
+## Warmup requests
+## ---------------------------------------------------------
+
+def run_warmup_requests(app):
+    """Send the requests listed in the configuration variable
+    WARMUP_URLS to the application.
+
+    This runs all code paths needed to answer these requests once
+    (template rendering, url building, database connection setup
+    etc.) before the worker starts accepting real traffic.
+
+    Returns a list of (url, status code, seconds) tuples.
+
+    """
+    results = []
+    client = app.test_client()
+    for url in app.config['WARMUP_URLS']:
+        start = perf_counter()
+        response = client.get(url)
+        results.append((url, response.status_code, perf_counter() - start))
+
+    return results
+
+
+## =========================================================
+## Setup
+## ---------------------------------------------------------
+
+def init_app(app):
+    """Set up the bytecode cache and the usage of preloaded
+    translation catalogs.
+    """
+    setup_bytecode_cache(app)
+    app.before_request(use_preloaded_translations)
+
+
+def prepare(app):
+    """Precompile the templates, load the translation catalogs and the
+    follow graph.
+
+    This is intended to be called once in the gunicorn master process
+    before the workers are forked.
+
+    """
+    start = perf_counter()
+    templates = precompile_templates(app)
+    catalogs = load_translations(app)
+    app.logger.info(
+        'Precompiled {} templates and loaded {} catalogs in {:.3f}s'.format(
+            templates, catalogs, perf_counter() - start))
+
+    # The follow graph (see app/graph.py)
+    graph = getattr(app, 'follow_graph', None)
+    if graph is not None:
+        with app.app_context():
+            graph.load()
+        stats = graph.stats()
+        app.logger.info(
+            'Loaded the follow graph ({} follows, {} bytes) in {:.3f}s'.format(
+                stats['edges'], stats['memory_bytes'],
+                stats['build_seconds']))
+
+
+def warmup(app):
+    """Run the warmup requests.
+
+    This is intended to be called in each gunicorn worker before it
+    starts accepting traffic.
+
+    """
+    for url, status, seconds in run_warmup_requests(app):
+        app.logger.info('Warmup {} -> {} in {:.3f}s'.format(
+            url, status, seconds))
+
+
+## fin.
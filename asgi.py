@@ -0,0 +1,22 @@
+## =========================================================
+## asgi.py
+##
+## ASGI entry point of the riji application: /translate and /search
+## are served on an asyncio event loop, all other requests by the
+## WSGI application riji:app (see app/aio.py).
+##
+## Usage:
+##
+##   uvicorn asgi:app
+##   gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:app
+##
+## ---------------------------------------------------------
+
+from app.aio import AsyncApp
+from riji import app as flask_app
+
+
+app = AsyncApp(flask_app)
+
+
+## fin.
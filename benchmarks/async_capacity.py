@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+## =========================================================
+## Benchmark: capacity of a worker for /search
+##
+## Searches through a fake Elasticsearch answering after a fixed
+## delay, and compares the requests a single worker process serves
+## per second:
+##
+##   - sync:  the WSGI application (riji:app) - a sync worker serves
+##            one request at a time,
+##   - async: the ASGI application (asgi:app, see app/aio.py) with
+##            growing numbers of concurrent requests.
+##
+## The fake Elasticsearch runs in a thread of its own, the requests
+## are sent to the applications in-process (no HTTP server).
+##
+## Usage:
+##
+##   python benchmarks/async_capacity.py [--delay 0.1]
+##                                       [--concurrency 1,10,100,500]
+##                                       [--requests 1000]
+##
+## ---------------------------------------------------------
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+from threading import Thread
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from aiohttp import web
+from app import create_app, db
+from app.aio import AsyncApp
+from app.models import User, Post
+from config import Config
+
+
+## =========================================================
+## Fake Elasticsearch
+## ---------------------------------------------------------
+
+def start_search_service(delay, ids):
+    """Serve a fake Elasticsearch in a thread - returns its URL."""
+    loop = asyncio.new_event_loop()
+    started = []
+
+    async def handle(request):
+        if request.path.endswith('/_search'):
+            await asyncio.sleep(delay)
+            return web.json_response({'hits': {
+                'total': {'value': len(ids), 'relation': 'eq'},
+                'hits': [{'_id': str(id)} for id in ids]}})
+        return web.json_response({})
+
+    async def start():
+        service = web.Application()
+        service.router.add_route('*', '/{path:.*}', handle)
+        runner = web.AppRunner(service, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        started.append(site._server.sockets[0].getsockname()[1])
+
+    loop.run_until_complete(start())
+    Thread(target=loop.run_forever, daemon=True).start()
+    return 'http://127.0.0.1:{}'.format(started[0])
+
+
+## =========================================================
+## Requests
+## ---------------------------------------------------------
+
+async def request(asgi, method, path, body=b'', cookie=None):
+    """Send a request to an ASGI application - returns status and
+    headers of the response.
+    """
+    path, _, query = path.partition('?')
+    headers = [(b'host', b'localhost')]
+    if body:
+        headers.append((b'content-type',
+                        b'application/x-www-form-urlencoded'))
+        headers.append((b'content-length', str(len(body)).encode()))
+    if cookie:
+        headers.append((b'cookie', cookie.encode()))
+    scope = {'type': 'http', 'asgi': {'version': '3.0'},
+             'http_version': '1.1', 'method': method, 'scheme': 'http',
+             'path': path, 'root_path': '', 'query_string': query.encode(),
+             'headers': headers, 'server': ('localhost', 80),
+             'client': ('127.0.0.1', 1)}
+    messages = [{'type': 'http.request', 'body': body}]
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.sleep(3600)
+
+    async def send(message):
+        sent.append(message)
+
+    await asgi(scope, receive, send)
+    return sent[0]['status'], [(name.decode(), value.decode())
+                               for name, value in sent[0]['headers']]
+
+
+def measure_sync(app, n_requests):
+    """Requests per second of the WSGI application."""
+    client = app.test_client()
+    client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+    start = perf_counter()
+    for _ in range(n_requests):
+        assert client.get('/search?q=post').status_code == 200
+    return n_requests / (perf_counter() - start)
+
+
+async def measure_async(asgi, concurrency, n_requests):
+    """Requests per second and median latency of the ASGI application
+    with 'concurrency' requests at a time.
+    """
+    _, headers = await request(asgi, 'POST', '/auth/login',
+                               b'username=john&password=cat')
+    cookie = '; '.join(value.split(';')[0]
+                       for name, value in headers if name == 'set-cookie')
+    latencies = []
+
+    async def client(count):
+        for _ in range(count):
+            started = perf_counter()
+            status, _ = await request(asgi, 'GET', '/search?q=post',
+                                      cookie=cookie)
+            assert status == 200, status
+            latencies.append(perf_counter() - started)
+
+    start = perf_counter()
+    await asyncio.gather(*[client(n_requests // concurrency)
+                           for _ in range(concurrency)])
+    elapsed = perf_counter() - start
+    await asgi.services.close()
+    return len(latencies) / elapsed, \
+        1000 * sorted(latencies)[len(latencies) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--delay', type=float, default=0.1)
+    parser.add_argument('--concurrency', default='1,10,100,500')
+    parser.add_argument('--requests', type=int, default=1000)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    url = start_search_service(args.delay, list(range(1, 11)))
+
+    class BenchmarkConfig(Config):
+        SQLALCHEMY_DATABASE_URI = \
+            'sqlite:///' + os.path.join(tmpdir, 'benchmark.db')
+        WTF_CSRF_ENABLED = False
+        ELASTICSEARCH_URL = url
+        RATE_LIMITS = {}
+        ADMISSION_LIMITS = {}
+        AIO_MAX_CONCURRENT = 100000
+
+    app = create_app(BenchmarkConfig)
+    with app.app_context():
+        db.create_all()
+        user = User(username='john', email='john@example.com')
+        user.set_password('cat')
+        db.session.add(user)
+        db.session.add_all([Post(body='post {}'.format(i), author=user)
+                            for i in range(10)])
+        db.session.commit()
+
+    print('Elasticsearch delay: {:.0f}ms'.format(1000 * args.delay))
+    print('{:>8} {:>12} {:>10} {:>12}'.format(
+        'server', 'concurrency', 'req/s', 'median'))
+    n_sync = max(1, min(args.requests, int(10 / args.delay)))
+    print('{:>8} {:>12} {:>10.1f} {:>12}'.format(
+        'sync', 1, measure_sync(app, n_sync), '-'))
+    for concurrency in [int(c) for c in args.concurrency.split(',')]:
+        asgi = AsyncApp(app)
+        throughput, median = asyncio.run(measure_async(
+            asgi, concurrency, max(args.requests, concurrency)))
+        asgi.executor.shutdown()
+        print('{:>8} {:>12} {:>10.1f} {:>10.1f}ms'.format(
+            'async', concurrency, throughput, median))
+
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+    os.remove(os.path.join(tmpdir, 'benchmark.db'))
+    os.rmdir(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
+
+## fin.
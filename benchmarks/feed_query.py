@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+## =========================================================
+## Benchmark: home feed query
+##
+## Compares the original feed query of User.followed_posts()
+## (UNION of the followed posts and the own posts, sorted as a whole)
+## with the single-pass query - with and without the feed indexes on
+## post (user_id, timestamp, id) and followers - for a user following
+## 10000 accounts.
+##
+## Usage:
+##
+##   python benchmarks/feed_query.py [--followed 10000] [--posts 20]
+##                                   [--others 10000]
+##
+## A user following only a small part of all authors
+## (e.g. --followed 20 --others 100000 --posts 10) shows the
+## difference between the composite index and a scan of the
+## timestamp index best.
+##
+## ---------------------------------------------------------
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from app import create_app, db
+from app.models import User, Post, followers
+from config import Config
+
+
+def legacy_followed_posts(user):
+    """The feed query before the single-pass rewrite."""
+    followed = Post.query.join(
+        followers, (followers.c.followed_id == Post.user_id)).filter(
+            followers.c.follower_id == user.id)
+    own = Post.query.filter_by(user_id=user.id)
+    return followed.union(own).order_by(Post.timestamp.desc())
+
+
+def populate(n_followed, posts_per_user, n_others):
+    """Create a user following n_followed users with posts_per_user
+    posts each, plus n_others users not followed by her.
+    """
+    n_users = 1 + n_followed + n_others
+    now = datetime.utcnow()
+    db.session.execute(User.__table__.insert(), [
+        {'id': i, 'username': 'user{}'.format(i),
+         'email': 'user{}@example.com'.format(i)}
+        for i in range(1, n_users + 1)])
+    db.session.execute(followers.insert(), [
+        {'follower_id': 1, 'followed_id': i}
+        for i in range(2, n_followed + 2)])
+    rows = []
+    for user_id in range(1, n_users + 1):
+        for _ in range(posts_per_user):
+            rows.append({
+                'body': 'post', 'user_id': user_id,
+                'timestamp': now - timedelta(
+                    seconds=random.randint(0, 365 * 24 * 3600))})
+    db.session.execute(Post.__table__.insert(), rows)
+    db.session.commit()
+    return len(rows)
+
+
+def timeit(query, page, per_page, repeat):
+    """Best time of fetching a page of the query."""
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        query.limit(per_page).offset((page - 1) * per_page).all()
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def query_plan(query):
+    statement = query.limit(10).statement.compile(
+        db.engine, compile_kwargs={'literal_binds': True})
+    rows = db.session.execute('EXPLAIN QUERY PLAN {}'.format(statement))
+    return [row[-1] for row in rows]
+
+
+def report(name, query, repeat):
+    print('\n{}:'.format(name))
+    for line in query_plan(query):
+        print('  plan: {}'.format(line))
+    for page in (1, 10):
+        print('  page {:2d}: {:8.2f} ms'.format(
+            page, 1000 * timeit(query, page, 10, repeat)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--followed', type=int, default=10000)
+    parser.add_argument('--posts', type=int, default=20)
+    parser.add_argument('--others', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+
+    class BenchmarkConfig(Config):
+        SQLALCHEMY_DATABASE_URI = \
+            'sqlite:///' + os.path.join(tmpdir, 'benchmark.db')
+
+    app = create_app(BenchmarkConfig)
+    with app.app_context():
+        db.create_all()
+        n_posts = populate(args.followed, args.posts, args.others)
+        print('{} followed accounts, {} posts in total'.format(
+            args.followed, n_posts))
+
+        def queries():
+            user = User.query.get(1)
+            return [('legacy union', legacy_followed_posts(user)),
+                    ('single pass', user.followed_posts())]
+
+        # The schema before the feed indexes were added
+        feed_indexes = [index for index in
+                        list(Post.__table__.indexes) +
+                        list(followers.indexes)
+                        if index.name != 'ix_post_timestamp']
+
+        for with_indexes in (False, True):
+            db.session.remove()
+            for index in feed_indexes:
+                if with_indexes:
+                    index.create(db.engine)
+                else:
+                    index.drop(db.engine)
+            db.engine.execute('ANALYZE')
+            for name, query in queries():
+                report('{}, {} feed indexes'.format(
+                    name, 'with' if with_indexes else 'without'),
+                    query, args.repeat)
+
+        # Same results
+        legacy, single_pass = [query for _, query in queries()]
+        assert [p.id for p in legacy.limit(50)] == \
+            [p.id for p in single_pass.limit(50)]
+
+        db.session.remove()
+        db.drop_all()
+
+    os.remove(os.path.join(tmpdir, 'benchmark.db'))
+    os.rmdir(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
+
+## fin.
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+## =========================================================
+## Benchmark: follow graph index
+##
+## Loads a random follow graph into the in-process index
+## (app/graph.py) and compares its follow queries with the queries
+## of the followers table.
+##
+## Usage:
+##
+##   python benchmarks/follow_graph.py [--users 100000] [--follows 1000000]
+##
+## ---------------------------------------------------------
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+from datetime import datetime
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from app import create_app, db
+from app.graph import FollowGraph
+from app.models import User, followers
+from config import Config
+
+
+def populate(n_users, n_follows):
+    # Nobody has changed her follows since the graph has been loaded
+    db.session.execute(User.__table__.insert(), [
+        {'id': i, 'username': 'user{}'.format(i),
+         'email': 'user{}@example.com'.format(i),
+         'follows_updated': datetime(2020, 1, 1)}
+        for i in range(1, n_users + 1)])
+    edges = set()
+    while len(edges) < n_follows:
+        edges.add((random.randint(1, n_users), random.randint(1, n_users)))
+    db.session.execute(followers.insert(), [
+        {'follower_id': a, 'followed_id': b} for a, b in edges])
+    db.session.commit()
+
+
+def timeit(function, users):
+    """Average time of the function per user in microseconds."""
+    start = perf_counter()
+    for user in users:
+        function(user)
+    return 1e6 * (perf_counter() - start) / len(users)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--follows', type=int, default=1000000)
+    parser.add_argument('--samples', type=int, default=1000)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+
+    class BenchmarkConfig(Config):
+        SQLALCHEMY_DATABASE_URI = \
+            'sqlite:///' + os.path.join(tmpdir, 'benchmark.db')
+
+    app = create_app(BenchmarkConfig)
+    with app.app_context():
+        db.create_all()
+        populate(args.users, args.follows)
+
+        graph = FollowGraph(compact_threshold=10000)
+        graph.load()
+        stats = graph.stats()
+        print('{} users, {} follows'.format(args.users, stats['edges']))
+        print('build: {:.3f}s, memory: {:.1f}MB'.format(
+            stats['build_seconds'], stats['memory_bytes'] / 2**20))
+
+        users = User.query.filter(User.id.in_(
+            random.sample(range(1, args.users + 1), args.samples))).all()
+        others = [random.choice(users) for _ in users]
+        pairs = list(zip(users, others))
+
+        print('\n{:<20} {:>12} {:>12}'.format('query', 'table', 'graph'))
+        for name, table, index in [
+                ('is_following',
+                 lambda p: p[0]._is_following(p[1]),
+                 lambda p: graph.is_following(p[0], p[1])),
+                ('followed_count',
+                 lambda p: p[0].followed.count(),
+                 lambda p: graph.followed_count(p[0])),
+                ('followers_count',
+                 lambda p: p[0].followers.count(),
+                 lambda p: graph.followers_count(p[0])),
+                ('followed_ids',
+                 lambda p: [u.id for u in p[0].followed],
+                 lambda p: graph.followed_ids(p[0])),
+        ]:
+            print('{:<20} {:>10.1f}us {:>10.1f}us'.format(
+                name, timeit(table, pairs), timeit(index, pairs)))
+
+        db.session.remove()
+        db.drop_all()
+
+    os.remove(os.path.join(tmpdir, 'benchmark.db'))
+    os.rmdir(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
+
+## fin.
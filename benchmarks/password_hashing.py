@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+## =========================================================
+## Benchmark: password hashing
+##
+## Measures the password hashes per second of a single core for a
+## few hash methods and costs, and the throughput of the process
+## pool of app/passwords.py with growing numbers of processes.
+##
+## Use it to choose PASSWORD_HASH_METHOD: the cost should make a
+## hash take as long as the logins of a worker can afford.
+##
+## Usage:
+##
+##   python benchmarks/password_hashing.py [--seconds 2]
+##                                         [--methods pbkdf2:sha256:150000,...]
+##                                         [--processes 1,2,4]
+##
+## ---------------------------------------------------------
+
+import argparse
+import os
+import sys
+from concurrent.futures import wait
+from time import perf_counter
+from werkzeug.security import generate_password_hash
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from app.passwords import PasswordHasher
+
+METHODS = 'pbkdf2:sha256:50000,pbkdf2:sha256:150000,pbkdf2:sha256:300000,' \
+    'pbkdf2:sha512:150000'
+
+
+def single_core(method, seconds):
+    """Hashes per second computed in this process."""
+    count = 0
+    start = perf_counter()
+    while perf_counter() - start < seconds:
+        generate_password_hash('correct horse battery staple', method, 16)
+        count += 1
+    return count / (perf_counter() - start)
+
+
+def pool(method, processes, seconds):
+    """Hashes per second computed by a pool of processes."""
+    hasher = PasswordHasher(method, 16, processes, processes, 60)
+    executor = hasher.pool()
+
+    # Start the processes before measuring
+    wait([executor.submit(generate_password_hash, 'warmup', method, 16)
+          for _ in range(processes)])
+
+    count = 0
+    start = perf_counter()
+    while perf_counter() - start < seconds:
+        wait([executor.submit(generate_password_hash,
+                              'correct horse battery staple', method, 16)
+              for _ in range(processes)])
+        count += processes
+    rate = count / (perf_counter() - start)
+    executor.shutdown()
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--seconds', type=float, default=2)
+    parser.add_argument('--methods', default=METHODS)
+    parser.add_argument('--processes', default='1,2,4')
+    args = parser.parse_args()
+
+    print('{} cores'.format(os.cpu_count()))
+    print('\n{:<24} {:>12} {:>12}'.format('method', 'hashes/s', 'ms/hash'))
+    for method in args.methods.split(','):
+        rate = single_core(method, args.seconds)
+        print('{:<24} {:>12.1f} {:>12.1f}'.format(method, rate, 1000 / rate))
+
+    method = args.methods.split(',')[0]
+    print('\npool, {}'.format(method))
+    print('{:<24} {:>12} {:>12}'.format('processes', 'hashes/s', 'per core'))
+    for processes in [int(n) for n in args.processes.split(',')]:
+        rate = pool(method, processes, args.seconds)
+        print('{:<24} {:>12.1f} {:>12.1f}'.format(
+            processes, rate, rate / processes))
+
+
+if __name__ == '__main__':
+    main()
+
+## fin.
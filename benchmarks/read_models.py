@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+## =========================================================
+## Benchmark: read models of the post lists
+##
+## Loads pages of the home timeline as ORM objects (Post and User)
+## and as read models (app/readmodels.py) and compares the memory
+## allocated (tracemalloc), the number of objects added to the
+## session and the time per page.
+##
+## Usage:
+##
+##   python benchmarks/read_models.py [--users 1000] [--posts 100000]
+##                                    [--per-page 25] [--pages 200]
+##
+## ---------------------------------------------------------
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+from datetime import datetime, timedelta
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from app import create_app, db
+from app.models import User, Post, followers, email_hash
+from app.readmodels import post_views
+from config import Config
+
+
+def populate(n_users, n_posts):
+    now = datetime.utcnow()
+    db.session.execute(User.__table__.insert(), [
+        {'id': i, 'username': 'user{}'.format(i),
+         'email': 'user{}@example.com'.format(i),
+         'email_hash': email_hash('user{}@example.com'.format(i)),
+         'password_hash': 'pbkdf2:sha256:150000$' + 'x' * 80,
+         'about_me': 'about user {} '.format(i) * 8}
+        for i in range(1, n_users + 1)])
+    db.session.execute(followers.insert(), [
+        {'follower_id': 1, 'followed_id': id}
+        for id in random.sample(range(2, n_users + 1), n_users // 10)])
+    db.session.execute(Post.__table__.insert(), [
+        {'body': 'post {} '.format(i) * 10,
+         'user_id': random.randint(1, n_users),
+         'timestamp': now - timedelta(seconds=i), 'language': 'en'}
+        for i in range(n_posts)])
+    db.session.commit()
+
+
+def measure(load, pages):
+    """Peak memory, objects in the session and time per page."""
+    user = User.query.get(1)
+    peak = size = 0
+    start = perf_counter()
+    for page in range(1, pages + 1):
+        tracemalloc.start()
+        items = load(user, page)
+        size = max(size, len(db.session.identity_map))
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        del items
+        db.session.expunge_all()
+        user = User.query.get(1)
+    return peak, size, 1000 * (perf_counter() - start) / pages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=100000)
+    parser.add_argument('--per-page', type=int, default=25)
+    parser.add_argument('--pages', type=int, default=200)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+
+    class BenchmarkConfig(Config):
+        SQLALCHEMY_DATABASE_URI = \
+            'sqlite:///' + os.path.join(tmpdir, 'benchmark.db')
+
+    def orm(user, page):
+        posts = user.followed_posts().paginate(
+            page, args.per_page, False).items
+        # The template reads the author of each post
+        return [(post, post.author) for post in posts]
+
+    def views(user, page):
+        return post_views(user.followed_posts()).paginate(
+            page, args.per_page, False).items
+
+    app = create_app(BenchmarkConfig)
+    with app.app_context():
+        db.create_all()
+        populate(args.users, args.posts)
+
+        print('{} posts per page, {} pages'.format(args.per_page, args.pages))
+        print('\n{:<12} {:>12} {:>10} {:>10}'.format(
+            'path', 'peak memory', 'objects', 'time'))
+        for name, load in [('orm', orm), ('read model', views)]:
+            peak, size, ms = measure(load, args.pages)
+            print('{:<12} {:>10.1f}kB {:>10} {:>8.2f}ms'.format(
+                name, peak / 1024, size, ms))
+
+        db.session.remove()
+        db.drop_all()
+
+    os.remove(os.path.join(tmpdir, 'benchmark.db'))
+    os.rmdir(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
+
+## fin.
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+## =========================================================
+## Benchmark: streamed rendering of the timeline
+##
+## Requests the home timeline with growing page sizes, rendered at
+## once and streamed (app/streaming.py), and compares the time to
+## the first byte of the body and the time to the last byte.
+##
+## The fragment cache is disabled, so that every post is rendered.
+##
+## Usage:
+##
+##   python benchmarks/streaming.py [--posts 20000]
+##                                  [--sizes 10,100,500,2000] [--runs 5]
+##
+## ---------------------------------------------------------
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from app import create_app, db
+from app.models import User, Post
+from config import Config
+
+
+def populate(n_posts):
+    now = datetime.utcnow()
+    user = User(username='john', email='john@example.com')
+    user.set_password('cat')
+    db.session.add(user)
+    db.session.commit()
+    db.session.execute(Post.__table__.insert(), [
+        {'body': 'post {} '.format(i) * random.randint(1, 10),
+         'user_id': user.id, 'language': 'en',
+         'timestamp': now - timedelta(seconds=i)}
+        for i in range(n_posts)])
+    db.session.commit()
+
+
+def measure(app, runs):
+    """Median time to the first and to the last byte in ms."""
+    client = app.test_client()
+    client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+    first, last = [], []
+    for _ in range(runs):
+        start = perf_counter()
+        response = client.get('/index', buffered=False)
+        chunks = iter(response.response)
+        next(chunks)
+        first.append(perf_counter() - start)
+        for _ in chunks:
+            pass
+        last.append(perf_counter() - start)
+        response.close()
+    return (1000 * sorted(first)[runs // 2], 1000 * sorted(last)[runs // 2])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--posts', type=int, default=20000)
+    parser.add_argument('--sizes', default='10,100,500,2000')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+
+    class BenchmarkConfig(Config):
+        SQLALCHEMY_DATABASE_URI = \
+            'sqlite:///' + os.path.join(tmpdir, 'benchmark.db')
+        WTF_CSRF_ENABLED = False
+        FRAGMENT_CACHE_SIZE = 0
+
+    app = create_app(BenchmarkConfig)
+    with app.app_context():
+        db.create_all()
+        populate(args.posts)
+
+    print('{:>8} {:>14} {:>14} {:>14} {:>14}'.format(
+        'posts', 'buffered ttfb', 'buffered last',
+        'streamed ttfb', 'streamed last'))
+    for size in [int(size) for size in args.sizes.split(',')]:
+        results = []
+        for views in ([], ['main.index']):
+            app.config['POSTS_PER_PAGE'] = size
+            app.config['STREAMING_VIEWS'] = views
+            results.extend(measure(app, args.runs))
+        print('{:>8} {:>12.1f}ms {:>12.1f}ms {:>12.1f}ms {:>12.1f}ms'.format(
+            size, *results))
+
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+    os.remove(os.path.join(tmpdir, 'benchmark.db'))
+    os.rmdir(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
+
+## fin.
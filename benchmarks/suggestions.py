@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+## =========================================================
+## Benchmark: "who to follow" suggestions
+##
+## Computes the suggestions of all users of a random follow graph
+## (app/suggestions.py) and refreshes them incrementally after a few
+## users have followed someone.
+##
+## The followed users are drawn from a skewed distribution, so that
+## some users have many more followers than others - as in a real
+## social graph, where the friends-of-friends rows of S = A·A get
+## much denser than with uniformly random follows.
+##
+## Usage:
+##
+##   python benchmarks/suggestions.py [--users 100000] [--follows 1000000]
+##                                    [--changes 1000]
+##
+## ---------------------------------------------------------
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from app import create_app, db
+from app.models import User, followers
+from app.suggestions import compute_suggestions
+from config import Config
+
+
+def skewed(n_users):
+    """A user id - small ids are followed more often."""
+    return min(n_users, int(random.paretovariate(1.0)))
+
+
+def populate(n_users, n_follows):
+    now = datetime.utcnow()
+    db.session.execute(User.__table__.insert(), [
+        {'id': i, 'username': 'user{}'.format(i),
+         'email': 'user{}@example.com'.format(i), 'follows_updated': now}
+        for i in range(1, n_users + 1)])
+    edges = set()
+    while len(edges) < n_follows:
+        follower = random.randint(1, n_users)
+        followed = skewed(n_users) if random.random() < 0.5 \
+            else random.randint(1, n_users)
+        if follower != followed:
+            edges.add((follower, followed))
+    db.session.execute(followers.insert(), [
+        {'follower_id': a, 'followed_id': b} for a, b in edges])
+    db.session.commit()
+
+
+def change(n_users, n_changes):
+    """Let some users follow someone (as another worker would)."""
+    changed = random.sample(range(1, n_users + 1), n_changes)
+    db.session.execute(followers.insert(), [
+        {'follower_id': id, 'followed_id': random.randint(1, n_users)}
+        for id in changed])
+    for i in range(0, n_changes, 500):
+        db.session.execute(User.__table__.update().where(
+            User.id.in_(changed[i:i + 500])).values(
+                follows_updated=datetime.utcnow()))
+    db.session.commit()
+
+
+def report(name, stats):
+    print('\n{}: {} follows, {} users refreshed, {} suggestions'.format(
+        name, stats['follows'], stats['users'], stats['suggestions']))
+    for step in ('load', 'select', 'multiply', 'store', 'total'):
+        print('  {:<10} {:8.3f}s'.format(step, stats[step]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--follows', type=int, default=1000000)
+    parser.add_argument('--changes', type=int, default=1000)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+
+    class BenchmarkConfig(Config):
+        SQLALCHEMY_DATABASE_URI = \
+            'sqlite:///' + os.path.join(tmpdir, 'benchmark.db')
+
+    app = create_app(BenchmarkConfig)
+    with app.app_context():
+        db.create_all()
+        populate(args.users, args.follows)
+
+        report('full', compute_suggestions(full=True))
+
+        change(args.users, args.changes)
+        report('incremental', compute_suggestions())
+
+        db.session.remove()
+        db.drop_all()
+
+    os.remove(os.path.join(tmpdir, 'benchmark.db'))
+    os.rmdir(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
+
+## fin.
@@ -27,6 +27,11 @@ while true; do
 
 done
 
+# Fill in the data of the migrations in the background
+# (see app/backfills.py): the schema changes above stay fast, the
+# backfills are throttled and resume where a previous run has stopped.
+flask backfill run &
+
 # Compile the language translations
 flask translate compile
 
@@ -35,11 +40,14 @@ flask translate compile
 # The process running the script will be replaced by the gunicorn process:
 # When this process terminates the Docker container does as well.
 # 
-# Docker appends anything that is written to stdout or stderr to the
-# logs. Therefore gunicorn is configured to write access and error log
-# messages to stdout via '--access-logfile -' and '--error-logfile -'.
+# The production serving profile is defined in gunicorn.conf.py:
+# The application is preloaded in the gunicorn master, templates and
+# translation catalogs are prepared before the workers are forked and
+# each worker is warmed up before it accepts traffic.
+# Access and error log messages are written to stdout,
+# which Docker appends to the logs.
 # 
-exec gunicorn -b :5000 --access-logfile - --error-logfile - riji:app
+exec gunicorn -c gunicorn.conf.py riji:app
 
 ## =========================================================
 ## =========================================================
@@ -1,5 +1,6 @@
 
 import os
+from datetime import timedelta
 from dotenv import load_dotenv
 
 basedir = os.path.abspath(os.path.dirname(__file__))
@@ -16,6 +17,104 @@ class Config(object):
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
 
+    # Read replicas of the application database
+    # (comma separated list of database URIs)
+    # GET requests of the views decorated with @read_replica are
+    # answered from one of the replicas (see app/database.py).
+    SQLALCHEMY_REPLICAS = [uri for uri in (
+        os.environ.get('DATABASE_REPLICA_URLS') or ''
+    ).split(',') if uri]
+
+    # Archive of the old posts (see app/archive.py)
+    # Posts older than this number of days are moved to the archive
+    # by 'flask archive posts' (0: no archive):
+    POST_ARCHIVE_AFTER_DAYS = int(os.environ.get('POST_ARCHIVE_AFTER_DAYS') or 0)
+    # Database of the archive (the application database when not set):
+    ARCHIVE_DATABASE_URL = os.environ.get('ARCHIVE_DATABASE_URL')
+    # Number of posts moved per transaction:
+    POST_ARCHIVE_BATCH = 500
+
+    # Shards of the posts (see app/shards.py)
+    # (comma separated list of database URIs, e.g.
+    # 'sqlite:///shard0.db,sqlite:///shard1.db' for a local setup)
+    # The posts of user u are stored in shard u % len(POST_SHARDS).
+    POST_SHARDS = [uri for uri in (
+        os.environ.get('POST_SHARD_URLS') or ''
+    ).split(',') if uri]
+
+    # Number of seconds a user is sent to the primary database
+    # after one of her own commits, to make sure she sees what she wrote
+    REPLICA_READ_YOUR_WRITES_WINDOW = \
+        int(os.environ.get('REPLICA_READ_YOUR_WRITES_WINDOW') or 10)
+
+    # Writes which do not start the read-your-writes window
+    # (User.last_seen is written on every request)
+    REPLICA_IGNORED_ATTRIBUTES = ['last_seen']
+
+    # Engine profile
+    # Name of one of the profiles in DATABASE_ENGINE_PROFILES
+    # (Flask-SQLAlchemy defaults when not set).
+    DATABASE_ENGINE_PROFILE = os.environ.get('DATABASE_ENGINE_PROFILE')
+
+    # Engine profiles
+    # - dialect:        The database backend the profile is written for.
+    #                   The profile is ignored for other backends.
+    # - engine_options: Options passed to sqlalchemy.create_engine()
+    #                   (pool size, overflow, recycle time, pre-ping...).
+    # - on_connect:     Statements run on every new connection.
+    DATABASE_ENGINE_PROFILES = {
+        'sqlite-production': {
+            'dialect': 'sqlite',
+            'engine_options': {
+                # Keep the connections open instead of reconnecting
+                # (and running the pragmas) for every request
+                'poolclass':     'QueuePool',
+                'pool_size':     5,
+                'max_overflow':  10,
+                'connect_args':  {'check_same_thread': False},
+            },
+            'on_connect': [
+                # Readers do not block the writer and vice versa
+                'PRAGMA journal_mode=WAL',
+                # No fsync on every commit (safe in WAL mode)
+                'PRAGMA synchronous=NORMAL',
+                # Read the database through a 256MB memory map
+                'PRAGMA mmap_size=268435456',
+                # Wait up to 5s for a lock instead of failing with
+                # 'database is locked'
+                'PRAGMA busy_timeout=5000',
+            ],
+        },
+        'mysql-production': {
+            'dialect': 'mysql',
+            'engine_options': {
+                'pool_size':     10,
+                'max_overflow':  20,
+                'pool_timeout':  10,
+                'pool_recycle':  1800,
+                'pool_pre_ping': True,
+            },
+            'on_connect': [
+                # Abort SELECT statements running longer than 5s
+                'SET SESSION MAX_EXECUTION_TIME=5000',
+            ],
+        },
+        'postgresql-production': {
+            'dialect': 'postgresql',
+            'engine_options': {
+                'pool_size':     10,
+                'max_overflow':  20,
+                'pool_timeout':  10,
+                'pool_recycle':  1800,
+                'pool_pre_ping': True,
+            },
+            'on_connect': [
+                # Abort statements running longer than 5s
+                'SET statement_timeout = 5000',
+            ],
+        },
+    }
+
     # No need to notify the application
     # every time a change is about to be made in the database.
     SQLALCHEMY_TRACK_MODIFICATIONS = False
@@ -41,7 +140,216 @@ class Config(object):
     # Elasticsearch
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
 
+    # Asynchronous serving of /translate and /search (see app/aio.py)
+    # Threads of a worker running the Flask parts of the requests:
+    AIO_THREADS = int(os.environ.get('AIO_THREADS') or 8)
+    # Connections of a worker to each service:
+    AIO_POOL_SIZE = int(os.environ.get('AIO_POOL_SIZE') or 100)
+    # Requests to an endpoint a worker waits on at the same time:
+    AIO_MAX_CONCURRENT = int(os.environ.get('AIO_MAX_CONCURRENT') or 1000)
+    # Deadlines of the calls of the services in seconds:
+    AIO_TRANSLATE_TIMEOUT = \
+        float(os.environ.get('AIO_TRANSLATE_TIMEOUT') or 10)
+    AIO_SEARCH_TIMEOUT = float(os.environ.get('AIO_SEARCH_TIMEOUT') or 5)
+
+    # Expose the metrics of the application at /metrics
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED') is not None
+
     # Page layout
     POSTS_PER_PAGE = 10
 
+    # Pages streamed while they are rendered (see app/streaming.py)
+    # Endpoints of the streamed views (comma separated list, e.g.
+    # 'main.index,main.explore,main.user,main.search'):
+    STREAMING_VIEWS = [view for view in (
+        os.environ.get('STREAMING_VIEWS') or '').split(',') if view]
+    # Number of posts fetched from the database at once:
+    STREAMING_BATCH = 100
+    # Minimal number of characters sent at once:
+    STREAMING_CHUNK_SIZE = 8192
+
+    # Avatars (see app/avatars)
+    # Sizes of the avatars served - other sizes are rounded up:
+    AVATAR_SIZES = [32, 64, 128, 256, 512]
+    # Directory of the on-disk cache of the avatars:
+    AVATAR_CACHE_DIR = os.environ.get('AVATAR_CACHE_DIR') or \
+        os.path.join(basedir, 'cache', 'avatars')
+    # Avatar service the avatars are fetched from, falling back to the
+    # identicons when it has none (identicons only when not set), e.g.
+    # Gravatar: https://www.gravatar.com/avatar/{hash}?d=404&s={size}
+    AVATAR_UPSTREAM = os.environ.get('AVATAR_UPSTREAM')
+    # Seconds the avatars of the upstream service are cached:
+    AVATAR_UPSTREAM_MAX_AGE = 24 * 60 * 60
+    # Seconds to wait for the upstream service:
+    AVATAR_UPSTREAM_TIMEOUT = 2
+
+    # In-process index of the follow graph (see app/graph.py)
+    FOLLOW_GRAPH = os.environ.get('FOLLOW_GRAPH') is not None
+    # Number of updated users kept apart before the index is rebuilt:
+    FOLLOW_GRAPH_COMPACT = 10000
+    # Timelines of users following less users than this are queried
+    # with the ids of the followed users instead of a subquery:
+    FOLLOW_GRAPH_INLINE_IDS = 500
+
+    # "Who to follow" suggestions (see app/suggestions.py)
+    # Number of suggestions computed for each user:
+    SUGGESTIONS_PER_USER = 20
+    # Number of suggestions shown:
+    SUGGESTIONS_SHOWN = 5
+
+    # New posts in the home timeline (see app/updates.py)
+    # Seconds between two checks of the browser for new posts:
+    NEW_POSTS_POLL_INTERVAL = 60
+    # Maximal number of new post ids returned:
+    NEW_POSTS_MAX_IDS = 50
+    # Push the new posts to the browsers with server-sent events
+    # (needs an asynchronous worker class, see gunicorn.conf.py):
+    NEW_POSTS_STREAM = os.environ.get('NEW_POSTS_STREAM') is not None
+    # Number of new posts buffered by each worker:
+    NEW_POSTS_STREAM_BUFFER = 1000
+    # Seconds between two polls of the posts of the other workers
+    # (0 disables the poller):
+    NEW_POSTS_STREAM_POLL = 2
+    # Seconds a post may be committed after its timestamp and still be
+    # found by the poller (each poll reads that many seconds again):
+    NEW_POSTS_STREAM_OVERLAP = 10
+    # Seconds between two keepalive messages of the stream:
+    NEW_POSTS_STREAM_HEARTBEAT = 15
+
+    # JSON API (see app/api)
+    # Lifetime of the access tokens (signed with JWT_SECRET_KEY,
+    # falling back to SECRET_KEY):
+    JWT_ACCESS_TOKEN_EXPIRES = timedelta(
+        hours=int(os.environ.get('JWT_ACCESS_TOKEN_HOURS') or 24))
+    # Maximal number of posts returned at once:
+    API_MAX_PAGE_SIZE = 100
+    # Responses of at least API_GZIP_MIN_SIZE bytes are gzip
+    # compressed for clients accepting it:
+    API_GZIP_MIN_SIZE = 1024
+    API_GZIP_LEVEL = 6
+
+    # Password hashing (see app/passwords.py)
+    # werkzeug hash method and cost - the hashes of other parameters
+    # are replaced when their users log in:
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or \
+        'pbkdf2:sha256:150000'
+    PASSWORD_SALT_LENGTH = 16
+    # Processes hashing the passwords of each worker
+    # (0 hashes in the worker itself - which a sync worker has to, see
+    # gunicorn.conf.py):
+    PASSWORD_HASH_PROCESSES = int(os.environ.get('PASSWORD_HASH_PROCESSES')
+                                  or 0)
+    # Maximal number of passwords hashed by each worker at the same time:
+    PASSWORD_HASH_CONCURRENCY = 2
+    # Seconds a request waits for its turn before it is rejected:
+    PASSWORD_HASH_TIMEOUT = 5
+
+    # Rate limits (see app/limits.py)
+    # Token bucket of each client per endpoint: refilled with 'rate'
+    # tokens per second, holding up to 'burst' tokens - only for the
+    # requests with one of the 'methods' when given.  With 'field', a
+    # second bucket is kept per value of the form field and address
+    # (the username tried from an address, whatever the client):
+    RATE_LIMITS = {
+        'auth.login':          {'rate': 1 / 6, 'burst': 10,
+                                'methods': ['POST'], 'field': 'username'},
+        'api.get_token':       {'rate': 1 / 6, 'burst': 10},
+        'main.index':          {'rate': 1 / 6, 'burst': 10,
+                                'methods': ['POST']},
+        'api.create_post':     {'rate': 1 / 6, 'burst': 10},
+        'main.translate_text': {'rate': 1 / 2, 'burst': 20},
+        'main.search':         {'rate': 1,     'burst': 30},
+        'api.search':          {'rate': 1,     'burst': 30},
+        'auth.available':      {'rate': 1,     'burst': 30},
+        'avatars.avatar':      {'rate': 10,    'burst': 300},
+    }
+    # Store of the buckets: 'local' (in each worker) or 'memcached'
+    # (shared by the workers, on MEMCACHED_SERVER):
+    RATE_LIMIT_STORE = os.environ.get('RATE_LIMIT_STORE') or 'local'
+    # Number of buckets kept in each worker:
+    RATE_LIMIT_LOCAL_BUCKETS = 100000
+    # Number of reverse proxies in front of the application whose
+    # X-Forwarded-For header is trusted - the clients are told apart
+    # by their IP address (0: no proxy, use the address connecting):
+    PROXY_FIX_X_FOR = int(os.environ.get('PROXY_FIX_X_FOR') or 0)
+    # Admission control: maximal number of requests to an endpoint
+    # served by a worker at the same time (switched off for gunicorn's
+    # sync workers, which serve one request at a time):
+    ADMISSION_LIMITS = {
+        'auth.login':          8,
+        'api.get_token':       8,
+        'main.translate_text': 4,
+        'main.search':         8,
+        'api.search':          8,
+    }
+    # Seconds after which rejected clients should try again:
+    ADMISSION_RETRY_AFTER = 5
+
+    # Task queue in the database (see app/tasks.py)
+    # Queue emails and search index updates for 'flask worker'
+    # instead of doing them in the web workers:
+    TASK_QUEUE = os.environ.get('TASK_QUEUE') is not None
+    # Seconds a claimed task is reserved for its worker:
+    TASK_VISIBILITY_TIMEOUT = 300
+    # Attempts before a task is marked as failed:
+    TASK_MAX_ATTEMPTS = 5
+    # Seconds before the first retry of a failed task (doubled for
+    # each further attempt, up to TASK_RETRY_MAX_DELAY):
+    TASK_RETRY_BACKOFF = 10
+    TASK_RETRY_MAX_DELAY = 3600
+    # Seconds a worker sleeps when there are no tasks:
+    TASK_POLL_INTERVAL = 1
+    # Seconds the done tasks are kept for the statistics:
+    TASK_KEEP_DONE = 24 * 60 * 60
+
+    # Shared cache daemon used by the caches of all worker processes
+    # as 'host:port' (only in-process caches when not set)
+    MEMCACHED_SERVER = os.environ.get('MEMCACHED_SERVER')
+    MEMCACHED_TTL = 24 * 60 * 60
+
+    # Cache of the rendered posts (see app/fragments.py)
+    # Number of fragments kept in each worker (0 disables the cache):
+    FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE') or 10000)
+    # Number of fragments fetched from the cache at once:
+    FRAGMENT_CACHE_BATCH = 50
+
+    # Snapshot of the explore feed (see app/explore.py)
+    # Number of pages kept in the snapshot (0 disables the snapshot):
+    EXPLORE_SNAPSHOT_PAGES = int(os.environ.get('EXPLORE_SNAPSHOT_PAGES') or 5)
+    # Maximal age of the snapshot in seconds:
+    EXPLORE_SNAPSHOT_TTL = int(os.environ.get('EXPLORE_SNAPSHOT_TTL') or 10)
+
+    # Availability of usernames and email addresses
+    # (see app/availability.py)
+    # Number of users the filters are sized for (at least twice the
+    # number of users when they are loaded):
+    AVAILABILITY_CAPACITY = int(os.environ.get('AVAILABILITY_CAPACITY') or
+                                100000)
+    # Share of the free names the filters take for used:
+    AVAILABILITY_ERROR_RATE = 0.01
+    # Seconds between the reads of the users registered by the other
+    # workers (0: never):
+    AVAILABILITY_REFRESH = 10
+
+    # Trending posts and tags on the explore page (see app/trending.py)
+    # Number of posts and of tags shown (0 disables the counting):
+    TRENDING_SIZE = int(os.environ.get('TRENDING_SIZE') or 5)
+    # Seconds after which an event counts half:
+    TRENDING_HALF_LIFE = int(os.environ.get('TRENDING_HALF_LIFE') or
+                             6 * 60 * 60)
+    # Seconds between the writes of the counts of a worker to the
+    # database (0 disables the writing thread):
+    TRENDING_FLUSH_INTERVAL = int(os.environ.get('TRENDING_FLUSH_INTERVAL')
+                                  or 30)
+
+    # Production serving profile (see gunicorn.conf.py and app/warmup.py)
+    # Directory of the on-disk Jinja bytecode cache
+    # (no bytecode cache when not set):
+    JINJA_BYTECODE_CACHE_DIR = os.environ.get('JINJA_BYTECODE_CACHE_DIR')
+    # Requests sent to each worker before it accepts traffic
+    # (comma separated list of urls):
+    WARMUP_URLS = [url for url in (
+        os.environ.get('WARMUP_URLS') or '/auth/login,/auth/register'
+    ).split(',') if url]
+
 ## fin.
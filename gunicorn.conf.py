@@ -0,0 +1,120 @@
+## =========================================================
+## gunicorn.conf.py
+##
+## Production serving profile for the riji application.
+##
+## Usage:
+##
+##   gunicorn -c gunicorn.conf.py riji:app
+##
+## or with /translate and /search served on an event loop
+## (see app/aio.py):
+##
+##   gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:app
+##
+## ---------------------------------------------------------
+##
+## - The application is loaded once in the gunicorn master
+##   process ('preload_app') and the workers are forked from it,
+##   sharing the memory of the preloaded application copy-on-write.
+##
+## - Before forking, all templates are precompiled (into the Jinja
+##   bytecode cache on disk when JINJA_BYTECODE_CACHE_DIR is set)
+##   and the translation catalogs of all languages in
+##   Config.LANGUAGES are loaded (see app/warmup.py).
+##
+## - Each worker runs the warmup requests listed in WARMUP_URLS
+##   before it starts accepting traffic.
+##
+## - With the server-sent event stream of new posts enabled
+##   (NEW_POSTS_STREAM), every browser showing the timeline keeps a
+##   connection open.  A 'sync' worker is blocked by each of them -
+##   run 'gevent' workers instead (GUNICORN_WORKER_CLASS=gevent):
+##   the event loop of a single worker serves thousands of idle
+##   connections (up to GUNICORN_WORKER_CONNECTIONS).
+##
+## - A 'sync' worker serves one request at a time: the admission
+##   control of app/limits.py is switched off for it (it would never
+##   reject a request), and it cannot offload the password hashing
+##   (PASSWORD_HASH_PROCESSES, see app/passwords.py) - it would wait
+##   for the hash anyway.
+##
+## ---------------------------------------------------------
+
+import os
+
+bind = ':5000'
+
+workers = int(os.environ.get('GUNICORN_WORKERS') or 2)
+
+# Worker class: 'sync' or 'gevent'
+# The gevent workers patch the standard library (threads, sockets,
+# locks) when they start, so that blocking calls only block the
+# current greenlet.
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS') or 'sync'
+
+# Maximal number of simultaneous connections of a gevent worker
+worker_connections = \
+    int(os.environ.get('GUNICORN_WORKER_CONNECTIONS') or 1000)
+
+# Docker appends anything that is written to stdout or stderr to the
+# logs - so write access and error log messages to stdout.
+accesslog = '-'
+errorlog = '-'
+
+# Load the application in the master process before forking the
+# workers.
+preload_app = True
+
+
+def flask_app(app):
+    """The Flask application - also when served by the ASGI
+    application of asgi.py.
+    """
+    return getattr(app, 'flask_app', app)
+
+
+def serves_concurrently(cfg):
+    """Does a worker of the configured class serve several requests
+    at a time?  ('sync' with more than one thread is 'gthread'.)
+    """
+    from gunicorn.workers.sync import SyncWorker
+    return not issubclass(cfg.worker_class, SyncWorker)
+
+
+def when_ready(server):
+    """Called in the master process after the (preloaded) application
+    has been loaded and before the workers are forked.
+    """
+    from app import limits, passwords, warmup
+    app = flask_app(server.app.wsgi())
+    concurrent = serves_concurrently(server.cfg)
+    limits.check_concurrency(app, concurrent)
+    passwords.check_concurrency(app, concurrent)
+    warmup.prepare(app)
+
+
+def post_fork(server, worker):
+    """Called in each worker right after it has been forked.
+
+    Database connections must not be shared between processes.
+    Drop all connections the master might have opened while loading
+    the application - to any of the databases (see app/database.py) -
+    the worker will open its own ones.
+
+    """
+    from app.database import dispose_engines
+    app = flask_app(server.app.wsgi())
+    with app.app_context():
+        dispose_engines(app)
+
+
+def post_worker_init(worker):
+    """Called in each worker after it has loaded the application and
+    before it starts accepting traffic.
+    """
+    from app import warmup
+    warmup.warmup(flask_app(worker.wsgi))
+
+
+## fin.
@@ -0,0 +1,36 @@
+"""64 bit post ids in the tag and mention tables
+
+Revision ID: b7e3d1a4c920
+Revises: 6d309c54ddf6
+Create Date: 2026-10-19 06:40:12.418532
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e3d1a4c920'
+down_revision = '6d309c54ddf6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The ids of the posts stored in the shards do not fit into 32 bits
+    # (batch mode: SQLite copies the tables)
+    for table in ('post_tag', 'post_mention'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column('post_id', existing_type=sa.Integer(),
+                                  type_=sa.BigInteger(),
+                                  existing_nullable=False,
+                                  autoincrement=False)
+
+
+def downgrade():
+    for table in ('post_tag', 'post_mention'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column('post_id', existing_type=sa.BigInteger(),
+                                  type_=sa.Integer(),
+                                  existing_nullable=False,
+                                  autoincrement=False)
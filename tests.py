@@ -9,9 +9,48 @@
 ## ---------------------------------------------------------
 
 from datetime import datetime, timedelta
+import asyncio
+import gzip
+import importlib.util
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
-from app import create_app, db
-from app.models import User, Post
+from threading import Thread
+from time import sleep, time
+from flask import g
+from flask_babel import get_translations
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import generate_password_hash
+from app import create_app, db, mail, passwords, updates, warmup
+from app.availability import BloomFilter
+from app.backfills import BACKFILLS, BackfillBusy, hash_emails, run_backfill
+from app.cache import SingleFlight
+from app.conditional import author_version
+from app.database import dispose_engines
+from app.email import send_email
+from app.explore import explore_posts
+from app.fragments import post_fragments
+from app.limits import Admission, LocalBucketStore, MemcachedBucketStore, \
+    check_concurrency
+from app.models import User, Post, ArchivedPost, BackfillProgress, \
+    Suggestion, TrendingScore, followers, email_hash, post_tags
+from app.passwords import PasswordHasher
+from app.readmodels import PostView, post_views
+from app.shards import add_post, create_shards, paginate_sharded, \
+    rebalance, shard_engine, shard_post
+from app.suggestions import compute_suggestions
+from app.tags import extract_tags, extract_mentions, tagged_posts, \
+    mentioning_posts
+from app.tasks import task, enqueue, claim, finish, work_once, queue_stats
+from app.trending import ERA_HALF_LIVES, TrendingCounters, era_of, \
+    forward_score, record_translation
+from app.archive import archive_posts, posts_by_id
+from app.transfer import open_file, export_data, import_data
 from config import Config
 
 
@@ -26,6 +65,9 @@ class TestConfig(Config):
     # for testing.
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
 
+    # No flusher threads - the tests flush the trending counts
+    TRENDING_FLUSH_INTERVAL = 0
+
 
 class UserModelCase(unittest.TestCase):
 
@@ -73,9 +115,13 @@ class UserModelCase(unittest.TestCase):
 
     def test_avatar(self):
         u = User(username='john', email='john@example.com')
-        self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/'
-                                         'd4c74594d841139328695756648b6bd6'
-                                         '?d=identicon&s=128'))
+        self.assertEqual(u.email_hash, 'd4c74594d841139328695756648b6bd6')
+        with self.app.test_request_context():
+            self.assertEqual(u.avatar(128), ('/avatar/'
+                                             'd4c74594d841139328695756648b6bd6'
+                                             '/128'))
+            # Rounded up to the next size in AVATAR_SIZES
+            self.assertEqual(u.avatar(70), u.avatar(128))
 
     def test_follow(self):
         u1 = User(username='john', email='john@example.com')
@@ -138,6 +184,1832 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+
+class WarmupCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_precompile_templates(self):
+        n = warmup.precompile_templates(self.app)
+        self.assertGreater(n, 0)
+        self.assertIn('_post.html', self.app.jinja_env.list_templates())
+
+    def test_preloaded_translations(self):
+        self.assertEqual(warmup.load_translations(self.app),
+                         len(TestConfig.LANGUAGES))
+        with self.app.test_request_context(
+                headers={'Accept-Language': 'es'}):
+            warmup.use_preloaded_translations()
+            self.assertIs(get_translations(), self.app.babel_catalogs['es'])
+
+    def test_warmup_requests(self):
+        results = warmup.run_warmup_requests(self.app)
+        self.assertEqual([url for url, _, _ in results],
+                         TestConfig.WARMUP_URLS)
+        self.assertTrue(all(status == 200 for _, status, _ in results))
+
+
+class ReadReplicaCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+        # A primary database and a read replica in two SQLite files
+        class ReplicaConfig(TestConfig):
+            WTF_CSRF_ENABLED = False
+            SQLALCHEMY_DATABASE_URI = \
+                'sqlite:///' + os.path.join(self.tmpdir, 'primary.db')
+            SQLALCHEMY_REPLICAS = [
+                'sqlite:///' + os.path.join(self.tmpdir, 'replica.db')]
+
+        self.app = create_app(ReplicaConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+        # Both databases contain the same user but different posts
+        replica = db.get_engine(bind='replica_0')
+        db.create_all()
+        db.Model.metadata.create_all(replica)
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.add(Post(body='from primary', author=u))
+        db.session.commit()
+        replica.execute(User.__table__.insert(), id=u.id, username=u.username,
+                        email=u.email, password_hash=u.password_hash)
+        replica.execute(Post.__table__.insert(), body='from replica',
+                        user_id=u.id, timestamp=datetime.utcnow())
+
+        self.client = self.app.test_client()
+        self.client.post('/auth/login',
+                         data={'username': 'john', 'password': 'cat'})
+
+    def tearDown(self):
+        db.session.remove()
+        self.app_context.pop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_reads_from_replica(self):
+        response = self.client.get('/explore')
+        self.assertIn(b'from replica', response.data)
+        self.assertNotIn(b'from primary', response.data)
+
+    def test_read_your_writes(self):
+        self.client.post('/index', data={'post': 'my new post'})
+        response = self.client.get('/explore')
+        self.assertIn(b'my new post', response.data)
+        self.assertIn(b'from primary', response.data)
+
+    def test_dispose_engines(self):
+        # All engines drop the connections opened before forking
+        binds = [None, 'replica_0', 'archive']
+        pools = [db.get_engine(bind=bind).pool for bind in binds]
+        dispose_engines(self.app)
+        for bind, pool in zip(binds, pools):
+            self.assertIsNot(db.get_engine(bind=bind).pool, pool, bind)
+
+
+class EngineProfileCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+        class ProfileConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = \
+                'sqlite:///' + os.path.join(self.tmpdir, 'app.db')
+            DATABASE_ENGINE_PROFILE = 'sqlite-production'
+            METRICS_ENABLED = True
+
+        self.app = create_app(ProfileConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_pragmas(self):
+        self.assertEqual(
+            db.session.execute('PRAGMA journal_mode').scalar(), 'wal')
+        self.assertEqual(
+            db.session.execute('PRAGMA busy_timeout').scalar(), 5000)
+
+    def test_pool_metrics(self):
+        User.query.all()
+        db.session.remove()
+        metrics = self.app.test_client().get('/metrics').get_json()
+        primary = metrics['database']['primary']
+        self.assertEqual(primary['pool'], 'InstrumentedQueuePool')
+        self.assertGreaterEqual(primary['checkouts'], 1)
+        self.assertEqual(primary['in_use'], 0)
+        self.assertEqual(primary['capacity'], 15)
+
+
+class FragmentCacheCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.u = User(username='john', email='john@example.com')
+        self.p = Post(body='hello', author=self.u)
+        db.session.add_all([self.u, self.p])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def render(self):
+        with self.app.test_request_context():
+            self.app.preprocess_request()
+            return ''.join(post_fragments([self.p]))
+
+    def test_cached_fragment(self):
+        html = self.render()
+        self.assertIn('hello', html)
+        self.assertEqual(self.app.fragment_cache.misses, 1)
+        self.assertEqual(self.render(), html)
+        self.assertEqual(self.app.fragment_cache.hits, 1)
+
+    def test_profile_change(self):
+        self.render()
+        self.u.username = 'johnny'
+        db.session.commit()
+        self.assertIn('johnny', self.render())
+        self.assertEqual(self.app.fragment_cache.misses, 2)
+
+    def test_post_change(self):
+        self.render()
+        self.p.body = 'changed'
+        db.session.commit()
+        self.assertEqual(len(self.app.fragment_cache.local), 0)
+        self.assertIn('changed', self.render())
+
+
+class ExploreSnapshotCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        u = User(username='john', email='john@example.com')
+        now = datetime.utcnow()
+        self.posts = [Post(body='post {}'.format(i), author=u,
+                           timestamp=now + timedelta(seconds=i))
+                      for i in range(25)]
+        db.session.add_all(self.posts)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_snapshot_pages(self):
+        snapshot = self.app.explore_snapshot
+        page1 = explore_posts(1, 10)
+        page3 = explore_posts(3, 10)
+        self.assertEqual([p.id for p in page1.items],
+                         [p.id for p in self.posts[:-11:-1]])
+        self.assertEqual([p.id for p in page3.items],
+                         [p.id for p in self.posts[4::-1]])
+        self.assertTrue(page1.has_next)
+        self.assertFalse(page3.has_next)
+        self.assertEqual(snapshot.rebuilds, 1)
+
+        # Stale snapshots are rebuilt
+        snapshot.ttl = 0
+        explore_posts(1, 10)
+        self.assertEqual(snapshot.rebuilds, 2)
+
+    def test_single_flight(self):
+        flight = SingleFlight()
+        calls = []
+
+        def rebuild():
+            calls.append(1)
+            sleep(0.2)
+            return len(calls)
+
+        results = []
+        threads = [Thread(target=lambda: results.append(
+            flight.do('key', rebuild))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, [1] * 5)
+
+
+class ConditionalGetCase(unittest.TestCase):
+
+    def setUp(self):
+
+        class ConditionalConfig(TestConfig):
+            WTF_CSRF_ENABLED = False
+
+        self.app = create_app(ConditionalConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username='john', email='john@example.com')
+        self.john.set_password('cat')
+        self.susan = User(username='susan', email='susan@example.com')
+        db.session.add_all([self.john, self.susan,
+                            Post(body='hello', author=self.susan)])
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/auth/login',
+                         data={'username': 'john', 'password': 'cat'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def revalidate(self, url):
+        etag = self.client.get(url).headers['ETag'].strip('"')
+        return self.client.get(url, headers={'If-None-Match': etag})
+
+    def test_not_modified(self):
+        for url in ('/index', '/explore', '/user/susan'):
+            response = self.revalidate(url)
+            self.assertEqual(response.status_code, 304, url)
+            self.assertEqual(response.data, b'')
+
+    def test_new_post(self):
+        etag = self.client.get('/explore').headers['ETag'].strip('"')
+        db.session.add(Post(body='news', author=self.susan))
+        db.session.commit()
+        response = self.client.get('/explore',
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_follow(self):
+        etag = self.client.get('/index').headers['ETag'].strip('"')
+        self.client.get('/follow/susan')
+        self.client.get('/index')  # the flashed message
+        response = self.client.get('/index',
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'hello', response.data)
+
+    def test_author_profile(self):
+        self.client.get('/follow/susan')
+        for url in ('/index', '/explore'):
+            self.client.get(url)  # the flashed message
+            etag = self.client.get(url).headers['ETag'].strip('"')
+            self.susan.about_me = 'about ' + url
+            db.session.commit()
+            response = self.client.get(url,
+                                       headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200, url)
+
+    def test_if_modified_since(self):
+        response = self.client.get('/explore')
+        self.assertIsNone(response.last_modified)
+        response = self.client.get('/explore', headers={
+            'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_own_profile(self):
+        # Each request updates last_seen - shown to the minute only
+        self.john.last_seen = datetime(2020, 1, 1, 12, 0, 10)
+        db.session.commit()
+        version = author_version('john')
+        self.john.last_seen = datetime(2020, 1, 1, 12, 0, 50)
+        db.session.commit()
+        self.assertEqual(author_version('john'), version)
+        self.john.last_seen = datetime(2020, 1, 1, 12, 1, 0)
+        db.session.commit()
+        self.assertNotEqual(author_version('john'), version)
+
+        response = self.revalidate('/user/john')
+        self.assertEqual(response.status_code, 304)
+
+class ApiCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        john = User(username='john', email='john@example.com')
+        john.set_password('cat')
+        self.susan = User(username='susan', email='susan@example.com')
+        now = datetime.utcnow()
+        db.session.add_all([john, self.susan] + [
+            Post(body='post {}'.format(i), author=self.susan,
+                 timestamp=now - timedelta(seconds=i // 2))
+            for i in range(5)])
+        db.session.commit()
+        self.client = self.app.test_client()
+        token = self.client.post('/api/v1/tokens', json={
+            'username': 'john', 'password': 'cat'}).get_json()
+        self.headers = {
+            'Authorization': 'Bearer ' + token['access_token']}
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def get(self, url, **headers):
+        headers.update(self.headers)
+        return self.client.get(url, headers=headers)
+
+    def test_token_required(self):
+        self.assertEqual(self.client.get('/api/v1/explore').status_code, 401)
+        response = self.client.post('/api/v1/tokens', json={
+            'username': 'john', 'password': 'dog'})
+        self.assertEqual(response.status_code, 401)
+
+    def test_cursor_pagination(self):
+        bodies = []
+        feed = '/api/v1/users/susan/posts?limit=2&fields=body'
+        url = feed
+        while url:
+            page = self.get(url).get_json()
+            self.assertTrue(all(list(item) == ['body']
+                                for item in page['items']))
+            bodies += [item['body'] for item in page['items']]
+            url = page['next_cursor'] and \
+                feed + '&cursor=' + page['next_cursor']
+        # Posts with the same timestamp are ordered by id
+        self.assertEqual(bodies, ['post {}'.format(i)
+                                  for i in (1, 0, 3, 2, 4)])
+        self.assertEqual(self.get('/api/v1/explore?fields=foo').status_code,
+                         400)
+
+    def test_follow_and_post(self):
+        self.assertEqual(self.get('/api/v1/timeline').get_json()['items'], [])
+        response = self.client.post('/api/v1/users/susan/follow',
+                                    headers=self.headers)
+        self.assertEqual(response.get_json()['following'], True)
+        response = self.client.post('/api/v1/posts', headers=self.headers,
+                                    json={'body': 'hi'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.get_json()['author'], 'john')
+        items = self.get('/api/v1/timeline').get_json()['items']
+        self.assertEqual(len(items), 6)
+        self.assertEqual(items[0]['body'], 'hi')
+
+    def test_gzip_and_etag(self):
+        self.app.config['API_GZIP_MIN_SIZE'] = 0
+        response = self.get('/api/v1/explore', **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        payload = json.loads(gzip.decompress(response.data).decode('utf-8'))
+        self.assertEqual(len(payload['items']), 5)
+        response = self.get('/api/v1/explore',
+                            **{'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+class NewPostsCase(unittest.TestCase):
+
+    def setUp(self):
+
+        class NewPostsConfig(TestConfig):
+            WTF_CSRF_ENABLED = False
+            NEW_POSTS_STREAM = True
+            NEW_POSTS_STREAM_POLL = 0
+
+        self.app = create_app(NewPostsConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username='john', email='john@example.com')
+        self.john.set_password('cat')
+        self.susan = User(username='susan', email='susan@example.com')
+        db.session.add_all([self.john, self.susan,
+                            Post(body='old', author=self.susan)])
+        self.john.follow(self.susan)
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/auth/login',
+                         data={'username': 'john', 'password': 'cat'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_new_posts_since(self):
+        since = updates.format_since(self.john.followed_posts().first())
+        url = '/new_posts?since=' + since
+        self.assertEqual(self.client.get(url).get_json()['count'], 0)
+        post = Post(body='new', author=self.susan)
+        db.session.add(post)
+        db.session.commit()
+        response = self.client.get(url).get_json()
+        self.assertEqual(response, {'count': 1, 'ids': [str(post.id)]})
+
+    def test_stream(self):
+        hub = updates.get_hub(self.app)
+        stream = updates.event_stream(hub, {self.susan.id}, hub.sequence, 0)
+        self.assertTrue(next(stream).startswith('retry:'))
+        self.assertEqual(next(stream), ': keepalive\n\n')
+        db.session.add_all([Post(body='mine', author=self.john),
+                            Post(body='news', author=self.susan)])
+        db.session.commit()
+        self.assertIn('"ids": ["3"]', next(stream))
+        self.assertEqual(hub.stats()['subscribers'], 1)
+        stream.close()
+        self.assertEqual(hub.stats()['subscribers'], 0)
+
+    def test_poller(self):
+        hub = updates.get_hub(self.app)
+        poller = updates.PostPoller(self.app, hub, 0, 10)
+        poller.poll()
+        self.assertEqual(hub.wait(0, 0)[0], [])
+
+        # Posts committed by other workers (not through the session),
+        # the second one a few seconds after its timestamp was set
+        table = Post.__table__
+        now = datetime.utcnow()
+        db.session.execute(table.insert().values(
+            id=100, body='news', user_id=self.susan.id, timestamp=now))
+        db.session.commit()
+        poller.poll()
+        db.session.execute(table.insert().values(
+            id=50, body='late', user_id=self.susan.id,
+            timestamp=now - timedelta(seconds=5)))
+        db.session.commit()
+        poller.poll()
+        poller.poll()
+        entries, _ = hub.wait(0, 0)
+        self.assertEqual([id for _, id, _ in entries], [100, 50])
+
+class FollowGraphCase(unittest.TestCase):
+
+    def setUp(self):
+
+        class GraphConfig(TestConfig):
+            FOLLOW_GRAPH = True
+
+        self.app = create_app(GraphConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.users = [User(username=name, email=name + '@example.com')
+                      for name in ('john', 'susan', 'mary', 'david')]
+        db.session.add_all(self.users)
+        db.session.commit()
+        john, susan, mary, david = self.users
+        john.follow(susan)
+        john.follow(mary)
+        mary.follow(susan)
+        db.session.commit()
+        self.graph = self.app.follow_graph
+        self.graph.load()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_queries(self):
+        john, susan, mary, david = self.users
+        self.assertTrue(john.is_following(susan))
+        self.assertFalse(susan.is_following(john))
+        self.assertEqual(john.followed_ids(), [susan.id, mary.id])
+        self.assertEqual(susan.followers_count(), 2)
+        self.assertEqual(david.followed_count(), 0)
+        self.assertEqual(sorted(john.followed_authors()),
+                         [john.id, susan.id, mary.id])
+        stats = self.graph.stats()
+        self.assertEqual(stats['edges'], 3)
+        self.assertGreater(stats['memory_bytes'], 0)
+
+    def test_committed_follows(self):
+        john, susan, mary, david = self.users
+        self.graph.compact_threshold = 1
+        # Loaded long after the follows of setUp()
+        self.graph.loaded_at = datetime.utcnow()
+        david.follow(john)
+        john.unfollow(mary)
+        db.session.commit()
+        self.assertEqual(self.graph.syncs, 0)
+        self.assertTrue(david.is_following(john))
+        self.assertFalse(john.is_following(mary))
+        self.assertEqual(john.followers_count(), 1)
+        self.assertEqual(mary.followers_count(), 0)
+        self.assertEqual(self.graph.syncs, 0)
+
+    def test_follows_of_other_workers(self):
+        john, susan, mary, david = self.users
+        self.assertFalse(david.is_following(mary))
+
+        # Another worker: the table changes without the graph knowing
+        db.session.execute(followers.insert().values(
+            follower_id=david.id, followed_id=mary.id))
+        db.session.execute(User.__table__.update().where(
+            User.id.in_([david.id, mary.id])).values(
+                follows_updated=datetime.utcnow() + timedelta(seconds=1)))
+        db.session.commit()
+        db.session.expire_all()
+
+        self.assertTrue(david.is_following(mary))
+        self.assertEqual(mary.followers_count(), 2)
+
+class SuggestionsCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.users = [User(username=name, email=name + '@example.com')
+                      for name in ('john', 'susan', 'mary', 'david', 'ann')]
+        db.session.add_all(self.users)
+        db.session.commit()
+        john, susan, mary, david, ann = self.users
+        john.follow(susan)
+        john.follow(mary)
+        susan.follow(david)
+        mary.follow(david)
+        mary.follow(ann)
+        mary.follow(john)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_friends_of_friends(self):
+        john, susan, mary, david, ann = self.users
+        stats = compute_suggestions(full=True)
+        self.assertEqual(stats['users'], 5)
+        # david is followed by both users john follows, ann by one;
+        # john does not get suggested to himself
+        self.assertEqual(john.suggested_users(5), [david, ann])
+        self.assertEqual(susan.suggested_users(5), [])
+        john.follow(david)
+        db.session.commit()
+        self.assertEqual(john.suggested_users(5), [ann])
+
+    def test_incremental_refresh(self):
+        john, susan, mary, david, ann = self.users
+        compute_suggestions(full=True)
+        self.assertEqual(compute_suggestions()['users'], 0)
+
+        # Refresh ann and everyone following her or susan
+        susan.follow(ann)
+        db.session.commit()
+        stats = compute_suggestions()
+        self.assertEqual(stats['users'], 4)
+        self.assertEqual(Suggestion.query.filter_by(
+            user_id=john.id, suggested_id=ann.id).one().score, 2)
+
+class AvatarCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+        class AvatarConfig(TestConfig):
+            AVATAR_CACHE_DIR = self.cache_dir
+
+        self.app = create_app(AvatarConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        db.session.add(User(username='john', email='john@example.com'))
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.digest = 'd4c74594d841139328695756648b6bd6'
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.cache_dir)
+
+    def test_identicon(self):
+        response = self.client.get('/avatar/{}/64'.format(self.digest))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'image/png')
+        self.assertTrue(response.data.startswith(b'\x89PNG'))
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertTrue(os.path.exists(os.path.join(
+            self.cache_dir, 'identicon', '64', 'd4', self.digest)))
+
+        # Deterministic
+        other = self.app.test_client().get('/avatar/{}/64'.format(self.digest))
+        self.assertEqual(other.data, response.data)
+
+    def test_invalid_requests(self):
+        for url in ('/avatar/{}/65'.format(self.digest), '/avatar/xyz/64'):
+            self.assertEqual(self.client.get(url).status_code, 404, url)
+
+    def test_unknown_hash(self):
+        # Rendered, but not stored
+        unknown = email_hash('nobody@example.com')
+        response = self.client.get('/avatar/{}/64'.format(unknown))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data.startswith(b'\x89PNG'))
+        self.assertFalse(os.path.exists(os.path.join(
+            self.cache_dir, 'identicon', '64', unknown[:2], unknown)))
+
+
+class ReadModelCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.u = User(username='john', email='john@example.com')
+        db.session.add_all([Post(body='post {}'.format(i), author=self.u,
+                                 language='en') for i in range(3)])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_post_views(self):
+        id = self.u.id
+        db.session.expunge_all()
+        user = User.query.get(id)
+        posts = post_views(user.posts.order_by(Post.id.desc())).all()
+        self.assertEqual([p.body for p in posts],
+                         ['post 2', 'post 1', 'post 0'])
+        self.assertIsInstance(posts[0], PostView)
+        self.assertEqual(posts[0].author.username, 'john')
+
+        # Nothing but the user has been loaded into the session
+        self.assertEqual(list(db.session.identity_map.values()), [user])
+
+        # Rendered like the posts
+        with self.app.test_request_context():
+            g.locale = 'en'
+            html = ''.join(post_fragments(posts))
+            self.assertIn(user.avatar(70), html)
+        self.assertIn('post 2', html)
+
+
+class StreamingCase(unittest.TestCase):
+
+    def setUp(self):
+
+        class StreamingConfig(TestConfig):
+            WTF_CSRF_ENABLED = False
+            STREAMING_VIEWS = ['main.index']
+            STREAMING_BATCH = 2
+            STREAMING_CHUNK_SIZE = 100000
+            POSTS_PER_PAGE = 5
+
+        self.app = create_app(StreamingConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        now = datetime.utcnow()
+        db.session.add_all([Post(body='post {}'.format(i), author=u,
+                                 timestamp=now + timedelta(seconds=i))
+                            for i in range(7)])
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/auth/login',
+                         data={'username': 'john', 'password': 'cat'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_streamed_page(self):
+        response = self.client.get('/index', buffered=False)
+        self.assertNotIn('Content-Length', response.headers)
+        chunks = [chunk.decode('utf-8') for chunk in response.response]
+        response.close()
+
+        # The navigation is flushed before the posts
+        self.assertEqual(len(chunks), 2)
+        self.assertIn('navbar', chunks[0])
+        self.assertNotIn('post 6', chunks[0])
+
+        page = ''.join(chunks)
+        self.assertIn('post 6', page)
+        self.assertIn('post 2', page)
+        self.assertNotIn('post 1<', page)
+        self.assertIn('/index?page=2', page)
+
+    def test_buffered_page(self):
+        response = self.client.get('/user/john?page=2')
+        self.assertIn('Content-Length', response.headers)
+        self.assertIn(b'post 1', response.data)
+
+
+class LimitsCase(unittest.TestCase):
+
+    def setUp(self):
+
+        class LimitsConfig(TestConfig):
+            WTF_CSRF_ENABLED = False
+            RATE_LIMITS = {'auth.login': {'rate': 0.01, 'burst': 2,
+                                          'methods': ['POST'],
+                                          'field': 'username'}}
+            ADMISSION_LIMITS = {'main.explore': 0}
+            PROXY_FIX_X_FOR = 1
+
+        self.app = create_app(LimitsConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_rate_limit(self):
+        data = {'username': 'john', 'password': 'cat'}
+        for _ in range(2):
+            self.assertEqual(
+                self.client.post('/auth/login', data=data).status_code, 302)
+        response = self.client.post('/auth/login', data=data)
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response.headers['Retry-After']), 90)
+
+        # Other clients and other methods are not limited
+        self.assertEqual(self.client.get('/auth/login').status_code, 200)
+        other = self.app.test_client()
+        response = other.post('/auth/login',
+                              data={'username': 'susan', 'password': 'cat'},
+                              environ_base={'REMOTE_ADDR': '10.0.0.2'})
+        self.assertEqual(response.status_code, 302)
+
+        self.assertEqual(self.app.limiter.stats()['rate_limited'],
+                         {'auth.login': 1})
+
+    def test_field_limit(self):
+        user = User(username='john', email='john@example.com')
+        user.set_password('dog')
+        db.session.add(user)
+        db.session.commit()
+
+        # Someone guessing the password of john
+        data = {'username': 'john', 'password': 'cat'}
+        for _ in range(2):
+            self.assertEqual(
+                self.client.post('/auth/login', data=data).status_code, 302)
+        self.assertEqual(
+            self.client.post('/auth/login', data=data).status_code, 429)
+
+        # ... but do not lock the user out from the other addresses
+        other = self.app.test_client()
+        response = other.post('/auth/login',
+                              data={'username': 'john', 'password': 'dog'},
+                              environ_base={'REMOTE_ADDR': '10.0.0.3'})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.location.endswith('/index'))
+
+    def test_proxy(self):
+        # The clients are told apart by the address the proxy has seen
+        for username, address in (('john', '10.0.0.2'),
+                                  ('susan', '10.0.0.3'),
+                                  ('mary', '10.0.0.2')):
+            response = self.client.post(
+                '/auth/login', data={'username': username, 'password': 'x'},
+                headers={'X-Forwarded-For': address})
+            self.assertEqual(response.status_code, 302)
+        response = self.client.post(
+            '/auth/login', data={'username': 'bob', 'password': 'x'},
+            headers={'X-Forwarded-For': '10.0.0.2'})
+        self.assertEqual(response.status_code, 429)
+
+    def test_admission(self):
+        response = self.client.get('/explore')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '5')
+        self.assertEqual(self.app.limiter.stats()['shed'],
+                         {'main.explore': 1})
+
+        admission = Admission()
+        self.assertTrue(admission.enter('search', 1))
+        self.assertFalse(admission.enter('search', 1))
+        admission.leave('search')
+        self.assertTrue(admission.enter('search', 1))
+
+        # Not with workers serving one request at a time
+        check_concurrency(self.app, True)
+        self.assertEqual(self.client.get('/explore').status_code, 503)
+        check_concurrency(self.app, False)
+        self.assertEqual(self.client.get('/explore').status_code, 302)
+
+    def test_shared_store_fallback(self):
+        local = LocalBucketStore(10)
+        store = MemcachedBucketStore('127.0.0.1:1', local)
+        self.assertEqual(store.take('key', 1, 1), 0)
+        self.assertGreater(store.take('key', 1, 1), 0)
+
+
+class PasswordsCase(unittest.TestCase):
+
+    def setUp(self):
+
+        class PasswordsConfig(TestConfig):
+            PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+            PASSWORD_HASH_CONCURRENCY = 1
+            PASSWORD_HASH_TIMEOUT = 0.01
+
+        self.app = create_app(PasswordsConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_rehash_on_login(self):
+        u = User(username='susan', email='susan@example.com')
+        u.password_hash = generate_password_hash('cat', 'pbkdf2:sha1:500')
+        db.session.add(u)
+        db.session.commit()
+
+        self.assertFalse(u.check_password('dog'))
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha1:500$'))
+        self.assertTrue(u.check_password('cat'))
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+        self.assertFalse(passwords.password_hasher(self.app).needs_rehash(
+            u.password_hash))
+        self.assertTrue(u.check_password('cat'))
+        self.assertEqual(passwords.password_hasher(self.app).stats()['rehashes'], 1)
+
+    def test_concurrency_cap(self):
+        hasher = passwords.password_hasher(self.app)
+        hasher._slots.acquire()
+        with self.assertRaises(ServiceUnavailable):
+            hasher.hash('cat')
+        hasher._slots.release()
+        self.assertTrue(hasher.verify(hasher.hash('cat'), 'cat'))
+        self.assertEqual(hasher.stats()['rejected'], 1)
+
+    def test_process_pool(self):
+        hasher = PasswordHasher('pbkdf2:sha256:1000', 16, 1, 1, 5)
+        pwhash = hasher.hash('cat')
+        self.assertTrue(hasher.verify(pwhash, 'cat'))
+        self.assertFalse(hasher.verify(pwhash, 'dog'))
+        hasher.pool().shutdown()
+
+    @unittest.skipUnless(importlib.util.find_spec('gevent'),
+                         'gevent is not installed')
+    def test_gevent(self):
+        # The other greenlets of a gevent worker run while the passwords
+        # are hashed in the pool (in a fresh interpreter - the patching
+        # cannot be undone)
+        script = '\n'.join([
+            'from gevent import monkey; monkey.patch_all()',
+            'import os',
+            'import gevent',
+            'from tests import TestConfig',
+            'from app import create_app, passwords',
+            'class Config(TestConfig):',
+            '    PASSWORD_HASH_METHOD = "pbkdf2:sha256:1000000"',
+            '    PASSWORD_HASH_PROCESSES = 1',
+            '    PASSWORD_HASH_CONCURRENCY = 1',
+            '    PASSWORD_HASH_TIMEOUT = 60',
+            'hasher = passwords.password_hasher(create_app(Config))',
+            'ticks = []',
+            'def tick():',
+            '    while True:',
+            '        ticks.append(1)',
+            '        gevent.sleep(0.01)',
+            'gevent.spawn(tick)',
+            'logins = [gevent.spawn(hasher.hash, "cat") for _ in range(2)]',
+            'gevent.joinall(logins, raise_error=True)',
+            'assert len(ticks) > 10, ticks',
+            'os._exit(0)',
+        ])
+        subprocess.run([sys.executable, '-W', 'ignore', '-c', script],
+                       check=True, timeout=60,
+                       cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    def test_sync_workers(self):
+        passwords.check_concurrency(self.app, False)
+        self.app.config['PASSWORD_HASH_PROCESSES'] = 2
+        passwords.check_concurrency(self.app, True)
+        with self.assertRaises(RuntimeError):
+            passwords.check_concurrency(self.app, False)
+
+
+calls = []
+
+
+@task('test_task')
+def record_call(value, fail=False):
+    calls.append(value)
+    if fail:
+        raise ValueError(value)
+
+
+class TaskQueueCase(unittest.TestCase):
+
+    def setUp(self):
+
+        class TaskConfig(TestConfig):
+            TASK_QUEUE = True
+            TASK_MAX_ATTEMPTS = 2
+            METRICS_ENABLED = True
+
+        self.app = create_app(TaskConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        del calls[:]
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_run_tasks(self):
+        enqueue('test_task', value=1)
+        enqueue('test_task', value=2)
+        db.session.commit()
+        self.assertEqual(work_once(10), 2)
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual(work_once(10), 0)
+        self.assertEqual(queue_stats()['all']['done'], 2)
+        response = self.app.test_client().get('/metrics/tasks')
+        self.assertIn(b'test_task', response.data)
+
+    def test_retries(self):
+        queued = enqueue('test_task', value=1, fail=True)
+        db.session.commit()
+        self.assertEqual(work_once(10), 1)
+        db.session.refresh(queued)
+        self.assertEqual((queued.state, queued.attempts), ('queued', 1))
+        self.assertGreater(queued.run_at, datetime.utcnow())
+
+        # Not run before the backoff has passed
+        self.assertEqual(work_once(10), 0)
+        queued.run_at = datetime.utcnow()
+        db.session.commit()
+        self.assertEqual(work_once(10), 1)
+        db.session.refresh(queued)
+        self.assertEqual(queued.state, 'failed')
+        self.assertIn('ValueError', queued.error)
+
+    def test_visibility_timeout(self):
+        queued = enqueue('test_task', value=1)
+        db.session.commit()
+        token, tasks = claim(10, 60)
+        self.assertEqual(len(tasks), 1)
+        self.assertEqual(claim(10, 60), (None, []))
+
+        # The worker has died
+        queued.claimed_until = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+        self.assertEqual(work_once(10), 1)
+        finish(queued.id, token, state='queued')
+        db.session.refresh(queued)
+        self.assertEqual((queued.state, queued.attempts), ('done', 2))
+
+    def test_queued_email(self):
+        with self.app.test_request_context():
+            send_email('subject', 'from@example.com', ['to@example.com'],
+                       'text', '<p>html</p>')
+        db.session.commit()
+        with mail.record_messages() as outbox:
+            self.assertEqual(work_once(10), 1)
+        self.assertEqual([m.subject for m in outbox], ['subject'])
+
+class TransferCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.tmpdir)
+
+    def populate(self):
+        users = [User(username=name, email=name + '@example.com')
+                 for name in ('john', 'susan', 'mary')]
+        db.session.add_all(users)
+        db.session.commit()
+        users[0].follow(users[1])
+        users[1].follow(users[2])
+        db.session.add_all([Post(body='post {}'.format(i), author=users[i % 3])
+                            for i in range(5)])
+        db.session.commit()
+
+    def reimport(self, path, **kwargs):
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        with open_file(path, 'r') as lines:
+            return import_data(lines, **kwargs)
+
+    def test_round_trip(self):
+        self.populate()
+        path = os.path.join(self.tmpdir, 'data.ndjson.gz')
+        with open_file(path, 'w') as out:
+            counts = export_data(out, chunk=2)
+        self.assertEqual(counts, {'user': 3, 'post': 5, 'post_archive': 0,
+                                  'followers': 2})
+        with gzip.open(path, 'rt') as f:
+            self.assertEqual(json.loads(f.readline())['table'], 'user')
+
+        self.assertEqual(self.reimport(path, batch=3), counts)
+        john = User.query.filter_by(username='john').first()
+        self.assertEqual([u.username for u in john.followed],  ['susan'])
+        self.assertEqual(Post.query.count(), 5)
+        self.assertIsInstance(Post.query.first().timestamp, datetime)
+
+    def test_resume(self):
+        self.populate()
+        path = os.path.join(self.tmpdir, 'data.ndjson')
+        with open_file(path, 'w') as out:
+            export_data(out)
+
+        # The import failed after the first 4 lines had been committed
+        with open(path) as f:
+            head = f.readlines()[:4]
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        import_data(head)
+        with open(path) as lines:
+            counts = import_data(lines, offset=4)
+        self.assertEqual(counts, {'user': 0, 'post': 4, 'post_archive': 0,
+                                  'followers': 2})
+        self.assertEqual(Post.query.count(), 5)
+
+    def test_tags(self):
+        self.populate()
+        susan = User.query.filter_by(username='susan').first()
+        db.session.add(Post(body='#Flask with @susan', author=susan))
+        db.session.commit()
+        path = os.path.join(self.tmpdir, 'data.ndjson')
+        with open_file(path, 'w') as out:
+            export_data(out)
+
+        self.reimport(path, batch=2)
+        susan = User.query.filter_by(username='susan').first()
+        for posts, _ in (tagged_posts('flask', None, 10),
+                         mentioning_posts(susan, None, 10)):
+            self.assertEqual([post.body for post in posts],
+                             ['#Flask with @susan'])
+
+class ArchiveCase(unittest.TestCase):
+
+    def setUp(self):
+
+        class ArchiveConfig(TestConfig):
+            WTF_CSRF_ENABLED = False
+            POST_ARCHIVE_AFTER_DAYS = 30
+            POSTS_PER_PAGE = 3
+            EXPLORE_SNAPSHOT_PAGES = 0
+
+        self.app = create_app(ArchiveConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+
+        # posts 0-3 are old, posts 4-6 are recent
+        now = datetime.utcnow()
+        db.session.add_all([Post(body='post {}'.format(i), author=u,
+                                 timestamp=now - timedelta(days=60 - 10 * i))
+                            for i in range(7)])
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/auth/login',
+                         data={'username': 'john', 'password': 'cat'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def page(self, url):
+        return [body for body in ('post {}'.format(i) for i in range(7))
+                if body + '<' in self.client.get(url).data.decode('utf-8')]
+
+    def test_archive_posts(self):
+        self.assertEqual(archive_posts(30, 3), 4)
+        self.assertEqual(Post.query.count(), 3)
+        self.assertEqual(ArchivedPost.query.count(), 4)
+        self.assertEqual(archive_posts(30, 3), 0)
+
+        # The pages past the hot posts are read from the archive
+        for url in ('/index', '/explore', '/user/john'):
+            self.assertEqual(self.page(url + '?page=1'),
+                             ['post 4', 'post 5', 'post 6'])
+            self.assertEqual(self.page(url + '?page=2'),
+                             ['post 1', 'post 2', 'post 3'])
+            self.assertEqual(self.page(url + '?page=3'), ['post 0'])
+
+        posts = posts_by_id([1, 7])
+        self.assertEqual((posts[1].body, posts[7].body), ('post 0', 'post 6'))
+
+    def test_interrupted_run(self):
+        # The first batch has been copied but not deleted
+        db.session.execute(ArchivedPost.__table__.insert(), [
+            {'id': 1, 'body': 'post 0', 'user_id': 1,
+             'timestamp': datetime.utcnow() - timedelta(days=60)}],
+            mapper=ArchivedPost)
+        db.session.commit()
+        self.assertEqual(archive_posts(30, 3), 4)
+        self.assertEqual(ArchivedPost.query.count(), 4)
+
+    def test_transfer(self):
+        archive_posts(30, 3)
+        out = io.StringIO()
+        counts = export_data(out)
+        self.assertEqual(counts, {'user': 1, 'post': 3, 'post_archive': 4,
+                                  'followers': 0})
+
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        self.assertEqual(import_data(out.getvalue().splitlines()), counts)
+        self.assertEqual(ArchivedPost.query.count(), 4)
+        self.assertEqual(self.page('/explore?page=3'), ['post 0'])
+
+class ShardCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = self.create_app(3)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        create_shards()
+
+        self.users = [User(username=name, email=name + '@example.com')
+                      for name in ('john', 'susan', 'mary')]
+        self.users[0].set_password('cat')
+        db.session.add_all(self.users)
+        db.session.commit()
+        self.users[0].follow(self.users[1])
+        db.session.commit()
+
+    def create_app(self, count):
+        shards = ['sqlite:///' + os.path.join(self.tmpdir,
+                                              'shard{}.db'.format(i))
+                  for i in range(count)]
+
+        class ShardConfig(TestConfig):
+            WTF_CSRF_ENABLED = False
+            POST_SHARDS = shards
+            POSTS_PER_PAGE = 3
+            NEW_POSTS_STREAM_POLL = 0
+
+        return create_app(ShardConfig)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.tmpdir)
+
+    def page(self, client, url):
+        return [body for body in ('post {}'.format(i) for i in range(6))
+                if body + '<' in client.get(url).data.decode('utf-8')]
+
+    def test_scatter_gather(self):
+        client = self.app.test_client()
+        client.post('/auth/login',
+                    data={'username': 'john', 'password': 'cat'})
+        for i in range(6):
+            with self.app.test_request_context():
+                add_post(self.users[i % 3], 'post {}'.format(i))
+            sleep(0.002)
+
+        # Each user's posts are in her shard only
+        for shard in range(3):
+            with shard_engine(shard).connect() as connection:
+                self.assertEqual(
+                    {user_id for user_id, in connection.execute(
+                        db.select([shard_post.c.user_id]))},
+                    {self.users[shard - 1].id})
+
+        self.assertEqual(self.page(client, '/index'),
+                         ['post 1', 'post 3', 'post 4'])
+        self.assertEqual(self.page(client, '/index?page=2'), ['post 0'])
+        self.assertEqual(self.page(client, '/explore?page=2'),
+                         ['post 0', 'post 1', 'post 2'])
+
+        # The first explore pages are read from the snapshot - only
+        # the posts shown are looked up by id (a query per shard)
+        queries = self.app.shard_pool.queries
+        self.assertEqual(client.get('/explore').status_code, 200)
+        self.assertEqual(self.app.explore_snapshot.rebuilds, 1)
+        self.assertEqual(self.app.shard_pool.queries, queries + 3)
+        self.assertEqual(self.page(client, '/user/susan'),
+                         ['post 1', 'post 4'])
+        response = client.post('/index', data={'post': 'post 5'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(paginate_sharded([self.users[0].id], 1, 3).total, 3)
+
+    def test_rebalance(self):
+        now = datetime.utcnow()
+        db.session.add_all([Post(body='post {}'.format(i),
+                                 author=self.users[i % 3],
+                                 timestamp=now + timedelta(seconds=i))
+                            for i in range(6)])
+        db.session.commit()
+        self.assertEqual(rebalance(4)['primary'], 6)
+        self.assertEqual(Post.query.count(), 0)
+
+        # Posts stored in a shard without their tags
+        add_post(self.users[2], '#late post')
+
+        # A fourth shard has been added
+        db.session.remove()
+        app = self.create_app(4)
+        with app.app_context():
+            db.create_all()
+            create_shards()
+            moved = rebalance(4)
+            self.assertEqual(moved, {'primary': 0, 'shard_0': 3, 'shard_1': 0,
+                                     'shard_2': 0, 'shard_3': 0})
+            self.assertEqual([tag for tag, in db.session.execute(
+                db.select([post_tags.c.tag]))], ['late'])
+
+            counts = []
+            for shard in range(4):
+                with shard_engine(shard).connect() as connection:
+                    counts.append(connection.execute(db.select(
+                        [db.func.count()]).select_from(shard_post)).scalar())
+            self.assertEqual(counts, [0, 2, 2, 3])
+
+    def test_transfer(self):
+        now = datetime.utcnow()
+        db.session.add(Post(body='post 0', author=self.users[0],
+                            timestamp=now))
+        db.session.commit()
+        for i in range(1, 4):
+            add_post(self.users[i % 3], 'post {}'.format(i))
+        out = io.StringIO()
+        self.assertEqual(export_data(out)['post'], 4)
+
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        for shard in range(3):
+            shard_post.drop(shard_engine(shard))
+        create_shards()
+        lines = out.getvalue().splitlines()
+        self.assertEqual(import_data(lines)['post'], 4)
+
+        # The posts are imported into the shards of their authors -
+        # an import resumed after a failure skips the stored ones
+        import_data(lines, offset=lines.index(
+            next(line for line in lines if '"post"' in line)))
+        self.assertEqual(Post.query.count(), 0)
+        self.assertEqual(paginate_sharded(None, 1, 10).total, 4)
+
+    def test_write_path(self):
+        hub = updates.get_hub(self.app)
+        client = self.app.test_client()
+        client.post('/auth/login',
+                    data={'username': 'john', 'password': 'cat'})
+        client.post('/index', data={'post': '#flask with @susan'})
+        token = client.post('/api/v1/tokens', json={
+            'username': 'john', 'password': 'cat'}).get_json()
+        headers = {'Authorization': 'Bearer ' + token['access_token']}
+        response = client.post('/api/v1/posts', headers=headers,
+                               json={'body': 'more #flask'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.get_json()['author'], 'john')
+
+        # Both posts are in the shard of the author only
+        self.assertEqual(Post.query.count(), 0)
+        with shard_engine(self.users[0].id % 3).connect() as connection:
+            ids = [id for id, in connection.execute(db.select(
+                [shard_post.c.id]).order_by(shard_post.c.id))]
+        self.assertEqual(len(ids), 2)
+
+        # The work of the session hooks has been done
+        posts, _ = tagged_posts('flask', None, 10)
+        self.assertEqual([post.body for post in posts],
+                         ['more #flask', '#flask with @susan'])
+        posts, _ = mentioning_posts(self.users[1], None, 10)
+        self.assertEqual([post.id for post in posts], ids[:1])
+        self.assertEqual(self.app.trending.stats()['events'], 2)
+        entries, _ = hub.wait(0, 0)
+        self.assertEqual([id for _, id, _ in entries], ids)
+
+        # The new posts and the API feeds read the shards
+        with self.app.test_request_context():
+            self.assertEqual(updates.new_posts(self.users[0], None, 10),
+                             (2, ids[::-1]))
+        items = client.get('/api/v1/timeline?fields=body',
+                           headers=headers).get_json()['items']
+        self.assertEqual(items, [{'body': 'more #flask'},
+                                 {'body': '#flask with @susan'}])
+
+        # The ids above 2**53 are sent as strings
+        self.assertGreater(ids[0], 2 ** 53)
+        items = client.get('/api/v1/timeline?fields=id',
+                           headers=headers).get_json()['items']
+        self.assertEqual(items, [{'id': str(id)} for id in ids[::-1]])
+        self.assertIsInstance(post_tags.c.post_id.type, db.BigInteger)
+
+class BackfillCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        db.session.execute(User.__table__.insert(), [
+            {'username': 'user{}'.format(i),
+             'email': 'User{}@example.com'.format(i)} for i in range(25)])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_batches(self):
+        ranges = []
+        job = BACKFILLS['email_hash']
+        hashed = run_backfill(job, 10, 0, progress=lambda position, rows:
+                              ranges.append((position, rows)))
+        self.assertEqual(hashed, 25)
+        self.assertEqual(ranges, [(10, 10), (20, 20), (25, 25)])
+        self.assertEqual(User.query.get(3).email_hash,
+                         email_hash('user2@example.com'))
+        self.assertIsNotNone(BackfillProgress.query.get('email_hash').finished)
+        self.assertEqual(run_backfill(job, 10, 0), 0)
+
+    def test_resume(self):
+        def interrupted(low, high):
+            if low >= 10:
+                raise RuntimeError('interrupted')
+            return hash_emails(low, high)
+        job = BACKFILLS['email_hash']
+        with self.assertRaises(RuntimeError):
+            run_backfill(job._replace(function=interrupted), 10, 0)
+        db.session.rollback()
+        self.assertEqual(BackfillProgress.query.get('email_hash').position, 10)
+
+        # The lease of the interrupted runner has to expire first
+        with self.assertRaises(BackfillBusy):
+            run_backfill(job, 10, 0)
+        BackfillProgress.query.get('email_hash').claimed_until = \
+            datetime.utcnow()
+        db.session.commit()
+        self.assertEqual(run_backfill(job, 10, 0), 15)
+        self.assertEqual(BackfillProgress.query.get('email_hash').rows, 25)
+
+    def test_cached_fragments(self):
+        db.session.add(Post(body='Hola, me llamo Juan y vivo en Madrid '
+                                 'con mi familia desde hace muchos años.',
+                            author=User.query.get(1)))
+        db.session.commit()
+
+        def render():
+            with self.app.test_request_context():
+                self.app.preprocess_request()
+                return ''.join(post_fragments(post_views(Post.query)))
+
+        html = render()
+        self.assertIn(email_hash(''), html)
+        self.assertNotIn('translate(', html)
+
+        # The fragments cached before the backfills are not used
+        run_backfill(BACKFILLS['email_hash'], 10, 0)
+        run_backfill(BACKFILLS['post_language'], 10, 0)
+        html = render()
+        self.assertIn(email_hash('user0@example.com'), html)
+        self.assertIn('translate(', html)
+
+class TagCase(unittest.TestCase):
+
+    def setUp(self):
+
+        class TagConfig(TestConfig):
+            WTF_CSRF_ENABLED = False
+
+        self.app = create_app(TagConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username='john', email='john@example.com')
+        self.john.set_password('cat')
+        self.susan = User(username='susan', email='susan@example.com')
+        db.session.add_all([self.john, self.susan])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_extract(self):
+        body = '#Flask and #python, not #1 or a#b - @susan, john@mail.com'
+        self.assertEqual(extract_tags(body), {'flask', 'python'})
+        self.assertEqual(extract_mentions(body), {'susan'})
+
+    def test_written_posts(self):
+        now = datetime.utcnow()
+        posts = [Post(body='#flask {} @john @nobody'.format(i),
+                      author=self.susan,
+                      timestamp=now - timedelta(minutes=i))
+                 for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+
+        page, last = tagged_posts('flask', None, 2)
+        self.assertEqual([post.id for post in page],
+                         [posts[0].id, posts[1].id])
+        page, last = tagged_posts('flask', (last.timestamp, last.id), 2)
+        self.assertEqual([post.id for post in page],
+                         [posts[2].id, posts[3].id])
+        page, last = tagged_posts('flask', (last.timestamp, last.id), 2)
+        self.assertEqual([post.id for post in page], [posts[4].id])
+        self.assertIsNone(last)
+        self.assertEqual(len(mentioning_posts(self.john, None, 10)[0]), 5)
+
+        # Edited and deleted posts
+        posts[0].body = '#python'
+        db.session.delete(posts[1])
+        db.session.commit()
+        self.assertEqual(len(tagged_posts('flask', None, 10)[0]), 3)
+        self.assertEqual(len(tagged_posts('python', None, 10)[0]), 1)
+
+        client = self.app.test_client()
+        client.post('/auth/login',
+                    data={'username': 'john', 'password': 'cat'})
+        response = client.get('/tag/Flask')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'#flask 4', response.data)
+        self.assertEqual(client.get('/tag/1').status_code, 404)
+        self.assertIn(b'#flask 2 @john', client.get('/mentions').data)
+
+    def test_backfill(self):
+        db.session.execute(Post.__table__.insert(), [
+            {'body': '#old post {}'.format(i), 'user_id': self.john.id,
+             'timestamp': datetime.utcnow()} for i in range(5)])
+        db.session.commit()
+        self.assertEqual(tagged_posts('old', None, 10)[0], [])
+        self.assertEqual(run_backfill(BACKFILLS['post_tags'], 2, 0), 5)
+        self.assertEqual(len(tagged_posts('old', None, 10)[0]), 5)
+        self.assertEqual(db.session.query(db.func.count()).select_from(
+            post_tags).scalar(), 5)
+
+class TrendingCase(unittest.TestCase):
+
+    def setUp(self):
+
+        class TrendingConfig(TestConfig):
+            WTF_CSRF_ENABLED = False
+
+        self.app = create_app(TrendingConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username='john', email='john@example.com')
+        self.john.set_password('cat')
+        self.susan = User(username='susan', email='susan@example.com')
+        self.hello = Post(body='hello', author=self.susan)
+        db.session.add_all([self.john, self.susan, self.hello])
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/auth/login',
+                         data={'username': 'john', 'password': 'cat'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_decay(self):
+        half_life = 3600
+        start = era_of(time(), half_life) * half_life * ERA_HALF_LIVES
+        era, score = forward_score(1, start, half_life)
+        self.assertEqual(score, 1)
+        self.assertEqual(forward_score(1, start + 2 * half_life,
+                                       half_life), (era, 4))
+
+        # Two events an hour ago count as much as one now
+        counters = TrendingCounters(self.app, 3, half_life, 0)
+        counters.record('tag', 'old', now=start)
+        counters.record('tag', 'old', now=start)
+        counters.record('tag', 'new', now=start + half_life)
+        counters.record('tag', 'newest', now=start + half_life)
+        counters.record('tag', 'newest', now=start + half_life)
+        counters.flush(now=start + half_life)
+        self.assertEqual(dict(counters.top('tag')),
+                         {'newest': 4, 'new': 2, 'old': 2})
+
+        # The scores of the previous era are scaled into the next one
+        counters.record('tag', 'new',
+                        now=start + (ERA_HALF_LIVES - 1) * half_life)
+        later = start + ERA_HALF_LIVES * half_life
+        counters.record('tag', 'new', now=later)
+        counters.flush(now=later)
+        self.assertEqual([key for key, _ in counters.top('tag')],
+                         ['new', 'newest', 'old'])
+        self.assertAlmostEqual(counters.top('tag')[0][1], 1.5)
+        counters.flush(now=later + ERA_HALF_LIVES * half_life)
+        self.assertEqual(counters.top('tag'), [('new', 1.5 * 2.0 ** -64)])
+        self.assertEqual(TrendingScore.query.count(), 1)
+
+    def test_events(self):
+        self.client.post('/index', data={'post': '#flask #python'})
+        self.client.post('/index', data={'post': 'more #flask'})
+        self.client.get('/follow/susan')
+        self.app.trending.flush()
+        self.assertEqual([key for key, _ in self.app.trending.top('tag')],
+                         ['flask', 'python'])
+        self.assertEqual(self.app.trending.top('post'),
+                         [(str(self.hello.id), self.app.trending.top(
+                             'post')[0][1])])
+
+        response = self.client.get('/explore')
+        self.assertIn(b'Trending tags', response.data)
+        self.assertIn(b'/tag/python', response.data)
+
+    def test_translations(self):
+        counters = self.app.trending
+        with self.app.test_request_context():
+            record_translation(self.john, self.hello.id + 1)
+            for _ in range(3):
+                record_translation(self.john, self.hello.id)
+            record_translation(self.susan, self.hello.id)
+        self.assertEqual(counters.events, 2)
+        self.assertEqual(counters.stats()['seen'], 2)
+
+        # Counted again after the half-life
+        now = time() + counters.half_life + 1
+        self.assertTrue(counters.first_seen((self.john.id, self.hello.id),
+                                            now=now))
+        self.assertEqual(counters.stats()['seen'], 1)
+
+class AvailabilityCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        db.session.add_all([User(username='john', email='john@example.com'),
+                            User(username='susan',
+                                 email='susan@example.com')])
+        db.session.commit()
+        self.index = self.app.availability
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_filter(self):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add('user{}'.format(i))
+        self.assertTrue(all('user{}'.format(i) in bloom
+                            for i in range(1000)))
+        false_positives = sum('other{}'.format(i) in bloom
+                              for i in range(1000))
+        self.assertLess(false_positives, 30)
+
+    def test_checks(self):
+        self.assertTrue(self.index.username_available('nobody'))
+        self.assertEqual(self.index.queries, 0)
+        self.assertFalse(self.index.username_available('john'))
+        self.assertTrue(self.index.username_available('JOHN'))
+        self.assertFalse(self.index.email_available('susan@example.com'))
+        self.assertTrue(self.index.email_available('nobody@example.com'))
+        self.assertEqual(self.index.queries, 3)
+
+        # Registered and renamed by this worker
+        db.session.add(User(username='mary', email='mary@example.com'))
+        User.query.filter_by(username='john').first().username = 'johnny'
+        db.session.commit()
+        self.assertFalse(self.index.username_available('mary'))
+        self.assertFalse(self.index.username_available('johnny'))
+        queries = self.index.queries
+        self.assertTrue(self.index.username_available('john'))
+        self.assertEqual(self.index.queries, queries)
+
+        # Registered by another worker
+        db.session.execute(User.__table__.insert().values(
+            username='david', email='david@example.com'))
+        db.session.commit()
+        self.index._loaded -= self.app.config['AVAILABILITY_REFRESH'] + 1
+        self.assertFalse(self.index.username_available('david'))
+        self.assertEqual(self.index.sorted_names.count('david'), 1)
+
+    def test_endpoint(self):
+        client = self.app.test_client()
+        response = client.get('/auth/available?username=susan')
+        self.assertEqual(response.get_json(),
+                         {'username': 'susan', 'available': False})
+        response = client.get('/auth/available?email=susan@example.com')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(client.get('/auth/available').status_code, 400)
+
+        # The email address is checked when the form is submitted
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        response = client.post('/auth/register', data={
+            'username': 'mary', 'email': 'susan@example.com',
+            'password': 'cat', 'password2': 'cat'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Please use a different email address.',
+                      response.data)
+
+
+@unittest.skipUnless(importlib.util.find_spec('aiohttp') and
+                     importlib.util.find_spec('asgiref'),
+                     'aiohttp and asgiref are not installed')
+class AioCase(unittest.TestCase):
+
+    class AioConfig(TestConfig):
+        WTF_CSRF_ENABLED = False
+        AIO_SEARCH_TIMEOUT = 0.5
+
+    def setUp(self):
+        from app.aio import AsyncApp
+        self.app = create_app(self.AioConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        user = User(username='john', email='john@example.com')
+        user.set_password('cat')
+        db.session.add(user)
+        db.session.commit()
+        self.posts = [Post(body='post {}'.format(i), author=user)
+                      for i in range(3)]
+        db.session.add_all(self.posts)
+        db.session.commit()
+        self.asgi = AsyncApp(self.app)
+
+    def tearDown(self):
+        self.asgi.executor.shutdown()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    async def request(self, method, path, body=b'', cookie=None):
+        """Send a request to the ASGI application - returns status,
+        headers and body of the response.
+        """
+        path, _, query = path.partition('?')
+        headers = [(b'host', b'localhost')]
+        if body:
+            headers.append((b'content-type',
+                            b'application/x-www-form-urlencoded'))
+            headers.append((b'content-length', str(len(body)).encode()))
+        if cookie:
+            headers.append((b'cookie', cookie.encode()))
+        scope = {'type': 'http', 'asgi': {'version': '3.0'},
+                 'http_version': '1.1', 'method': method, 'scheme': 'http',
+                 'path': path, 'raw_path': path.encode(), 'root_path': '',
+                 'query_string': query.encode(), 'headers': headers,
+                 'server': ('localhost', 80), 'client': ('127.0.0.1', 1)}
+        messages = [{'type': 'http.request', 'body': body}]
+        sent = []
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            await asyncio.sleep(3600)
+
+        async def send(message):
+            sent.append(message)
+
+        await self.asgi(scope, receive, send)
+        headers = {}
+        for name, value in sent[0]['headers']:
+            headers.setdefault(name.decode(), []).append(value.decode())
+        return sent[0]['status'], headers, b''.join(
+            message.get('body', b'') for message in sent[1:])
+
+    async def login(self):
+        status, headers, _ = await self.request(
+            'POST', '/auth/login', b'username=john&password=cat')
+        self.assertEqual(status, 302)
+        return '; '.join(cookie.split(';')[0]
+                         for cookie in headers['set-cookie'])
+
+    async def search_service(self, delay):
+        """A fake Elasticsearch answering after 'delay' seconds."""
+        from aiohttp import web
+        ids = [post.id for post in self.posts[:2]]
+
+        async def search(request):
+            await asyncio.sleep(delay)
+            return web.json_response({'hits': {
+                'total': {'value': len(ids), 'relation': 'eq'},
+                'hits': [{'_id': str(id)} for id in ids]}})
+
+        service = web.Application()
+        service.router.add_route('*', '/post/_search', search)
+        runner = web.AppRunner(service)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.app.config['ELASTICSEARCH_URL'] = \
+            'http://127.0.0.1:{}'.format(port)
+        return runner
+
+    def test_passthrough(self):
+        async def run():
+            status, _, body = await self.request('GET', '/auth/login')
+            self.assertEqual(status, 200)
+            self.assertIn(b'Sign In', body)
+            status, headers, _ = await self.request('GET', '/search?q=x')
+            self.assertEqual(status, 302)
+            self.assertIn('/auth/login', headers['location'][0])
+            await self.asgi.services.close()
+        asyncio.run(run())
+
+    def test_search(self):
+        async def run():
+            runner = await self.search_service(0)
+            try:
+                cookie = await self.login()
+                status, _, body = await self.request(
+                    'GET', '/search?q=post', cookie=cookie)
+                self.assertEqual(status, 200)
+                self.assertIn(b'post 0', body)
+                self.assertIn(b'post 1', body)
+                self.assertNotIn(b'post 2', body)
+                status, headers, _ = await self.request(
+                    'GET', '/search?q=', cookie=cookie)
+                self.assertEqual(status, 302)
+                self.assertIn('/explore', headers['location'][0])
+            finally:
+                await self.asgi.services.close()
+                await runner.cleanup()
+        asyncio.run(run())
+        self.assertEqual(self.asgi.stats()['served'], {'search': 2})
+
+    def test_deadline(self):
+        async def run():
+            runner = await self.search_service(2)
+            try:
+                cookie = await self.login()
+                status, _, _ = await self.request(
+                    'GET', '/search?q=post', cookie=cookie)
+                self.assertEqual(status, 504)
+            finally:
+                await self.asgi.services.close()
+                await runner.cleanup()
+        asyncio.run(run())
+        self.assertEqual(self.asgi.stats()['timeouts'], {'search': 1})
+
+    def test_translate_not_configured(self):
+        async def run():
+            cookie = await self.login()
+            status, _, body = await self.request(
+                'POST', '/translate',
+                b'text=Hallo&source_language=de&target_language=en'
+                b'&post_id=1', cookie=cookie)
+            self.assertEqual(status, 200)
+            self.assertIn('not configured',
+                          json.loads(body.decode())['text'])
+            await self.asgi.services.close()
+        asyncio.run(run())
+
+    def test_overload(self):
+        async def run():
+            self.asgi.in_flight['search'] = self.asgi.max_concurrent
+            status, headers, _ = await self.request('GET', '/search?q=x')
+            self.assertEqual(status, 503)
+            self.assertIn('retry-after', headers)
+        asyncio.run(run())
+
 ## =========================================================
 ## main
 ## ---------------------------------------------------------